@@ -1,13 +1,18 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
-import plotly.express as px
 from datetime import datetime, timedelta
 from streamlit_autorefresh import st_autorefresh
-from distance import estimate_co2_saved, estimate_delta_time
+from distance import estimate_trips_batch, estimate_co2_saved_batch, estimate_delta_time_batch
 from dateutil.relativedelta import relativedelta
-import csp
-import poll
+from trip_window import get_trip_window
+from heatmap_tiles import get_heatmap_tiles
+from trip_aggregates import get_trip_aggregates
+from rider_index import get_rider_index
+from co2_channel import Co2Channel
+import os
+import time
+from csp_bike.metrics import metrics, profiling, load_dump, METRICS_DIR
 
 # RUN APP COMMAND - python3 -m streamlit run MainPage.py
 st.set_page_config(
@@ -19,67 +24,95 @@ st.set_page_config(
 
 NUM_TO_MONTH = {1: 'January',2: 'February', 3: 'March', 4: 'April', 5: 'May', 6: 'June', 7: 'July', 8: 'August', 9: 'September', 10: 'October', 11: 'November', 12: 'December'}
 FEED_LENGTH = 30
-GOAL_CO2 = 1260783
-START_CO2 = 978171.3
+TRIP_FILE = './data/202403-citibike-tripdata_1.csv'
+# None bins the heatmap by start station, 6-7 bins by geohash cell
+HEATMAP_GEOHASH_PRECISION = None
+# CSP_BIKE_DEBUG_PANEL=1 or ?debug=1 shows timings and cache stats at the bottom of the page
+DEBUG_PANEL = os.environ.get('CSP_BIKE_DEBUG_PANEL', '') == '1'
+render_start = time.perf_counter()
+render_profile = profiling('dashboard').start()
 refresh_tick_count = st_autorefresh(interval=30000, limit=100)
 
-def get_nyc_heatmap(df):
-    fig = px.density_mapbox(df, lat='start_lat', lon='start_lng', z='riders', radius=8,
-                            center=dict(lat=40.75651, lon=-73.98319), zoom=11,
-                            mapbox_style="carto-positron")
-    fig.update_layout(height=600)
-    return fig
-
-def get_heatmap(csv_file, curr_timestamp):
-    df = pd.read_csv(csv_file, delimiter=',')
-
-    df = df[['started_at', 'ended_at', 'start_station_id', 'end_station_id', 'start_lat', 'start_lng', 'end_lat', 'end_lng']]
-
-    df['started_at'] = pd.to_datetime(df['started_at']) #dt.round('H')
-    df['ended_at'] = pd.to_datetime(df['ended_at']) #dt.round('H')
-
-    df['start_station_id'] = df['start_station_id'].astype(str)
-    df['end_station_id'] = df['end_station_id'].astype(str)
-
-    df = df[(df['start_station_id'] != 'nan') & (df['end_station_id'] != 'nan')]
-
-    df = df.dropna()
-
-    cutoff_timestamp = curr_timestamp - timedelta(hours=1)
-    df = df[(df['started_at'] >= cutoff_timestamp) & (df['started_at'] <= curr_timestamp)]
-
-    df_heat = df.groupby(['start_station_id']).first().reset_index('start_station_id')
-    df_heat['riders'] = df.groupby(['start_station_id']).size().reset_index('start_station_id')[0]
-
-    return df_heat
+HEATMAP_LAYOUT = dict(
+    height=600,
+    mapbox=dict(style='carto-positron', center=dict(lat=40.75651, lon=-73.98319), zoom=11),
+    margin=dict(l=0, r=0, t=0, b=0),
+    coloraxis=dict(colorscale='Plasma', cmin=0),
+    # keeps the user's pan/zoom and lets the browser restyle just the trace on refresh
+    uirevision='heatmap',
+)
 
-def get_feed_data(df, n, curr_timestamp):
-    feed_df = df[df['ended_at'] <= curr_timestamp]
-    feed_df = feed_df.sort_values(by='ended_at').tail(n)
+def get_nyc_heatmap(tiles, counts):
+    # every cell is always sent, so between refreshes only z differs; the payload
+    # is bounded by the number of cells, not the number of trips
+    import plotly.graph_objects as go
+    trace = go.Densitymapbox(lat=tiles.cell_lat.round(5), lon=tiles.cell_lng.round(5), z=counts,
+                             radius=8, coloraxis='coloraxis', hoverinfo='z')
+    return go.Figure(data=[trace], layout=HEATMAP_LAYOUT)
+
+# Figures and feed rows are cached across reruns. Each cached function takes the
+# trip file's mtime as an argument only so that it is part of the cache key: a
+# rewritten file misses instead of serving results computed from the old one.
+
+@st.cache_data(max_entries=48, show_spinner=False)
+def get_heatmap(csv_file, csv_mtime, hour):
+    # riders per cell over the hour before `hour`, a row of the month's pre-aggregated tiles
+    tiles = get_heatmap_tiles(csv_file, HEATMAP_GEOHASH_PRECISION)
+    return get_nyc_heatmap(tiles, tiles.hour(hour))
+
+def get_feed_data(csv_file, n, curr_timestamp):
+    # last n finished trips, by binary search over the precomputed ended_at order
+    return get_trip_window(csv_file).last_finished(n, curr_timestamp)
+
+@st.cache_data(max_entries=48, show_spinner=False)
+def get_feed(csv_file, csv_mtime, n, curr_timestamp):
+    # the feed rows with their CO2 and commute time estimates
+    feed_df = get_feed_data(csv_file, n, curr_timestamp)
+    estimates = estimate_trips_batch(feed_df)
+    return feed_df, estimate_co2_saved_batch(feed_df, estimates), estimate_delta_time_batch(feed_df, estimates)
 
-    return feed_df
 selected_date = datetime(2024, 3, 27, 9, 8, 26) + timedelta(hours=refresh_tick_count)
-df = get_heatmap('./data/202403-citibike-tripdata_1.csv', selected_date)
+trip_file_mtime = os.stat(TRIP_FILE).st_mtime_ns
+with metrics.timer('dashboard.get_heatmap'):
+    heatmap_fig = get_heatmap(TRIP_FILE, trip_file_mtime, selected_date.replace(minute=0, second=0, microsecond=0))
 
 #Estimate the amount of CO2 currently emitted this month
 total_seconds = 31 * 24 * 60 * 60
 current_timestamp = (selected_date - datetime(selected_date.year, selected_date.month, 1)).total_seconds()
 percentage = current_timestamp / total_seconds
 
+# CO2 saved this month before today, and this month's goal, from the ingested trip
+# files; the supervisor (or python trip_aggregates.py) writes the checkpoints
+with metrics.timer('dashboard.trip_aggregates'):
+    trip_aggregates = get_trip_aggregates()
+    START_CO2 = trip_aggregates.month_to_date(selected_date) if trip_aggregates is not None else None
+    GOAL_CO2 = trip_aggregates.goal(selected_date) if trip_aggregates is not None else None
+    GOAL_BASIS = trip_aggregates.goal_basis(selected_date) if trip_aggregates is not None else None
+
 # Get the feed information
-feed_df = get_feed_data(df, FEED_LENGTH, selected_date)
-amt_of_CO2_saved = []
-bike_car_commute_times = []
-for i, row in feed_df.iterrows():
-    ori_lat, ori_lng, dest_lat, dest_lng = row['start_lat'], row['start_lng'], row['end_lat'], row['end_lng']
-    amt_of_CO2_saved.append(estimate_co2_saved(ori_lat, ori_lng, dest_lat, dest_lng))
-    bike_car_commute_times.append(estimate_delta_time(ori_lat, ori_lng, dest_lat, dest_lng))
-
-#Get live csp data from txt file
-with open('./co2_saved.txt', 'r') as file:
-    # Read the first line of the file into a string
-    co2_30_sec_total = float(file.readline())
-    co2_saved_total_live = float(file.readline())
+with metrics.timer('dashboard.get_feed_data'):
+    feed_df, amt_of_CO2_saved, bike_car_commute_times = get_feed(TRIP_FILE, trip_file_mtime, FEED_LENGTH,
+                                                                 selected_date)
+
+#Get live csp data from the poller's shared-memory channel
+co2_30_sec_total = 0.0
+co2_saved_total_live = 0.0
+with metrics.timer('dashboard.co2_channel'):
+    co2_channel = Co2Channel.open()
+    if co2_channel is not None:
+        latest = co2_channel.latest()
+        if latest is not None:
+            co2_30_sec_total = float(latest['delta_co2'])
+            co2_saved_total_live = float(latest['total_co2'])
+
+# The signed-in rider's totals and rank this month
+with metrics.timer('dashboard.rider_index'):
+    rider_id = st.query_params.get('rider')
+    rider = get_rider_index().rider(rider_id) if rider_id else None
+
+def ordinal(n):
+    suffix = 'th' if 10 <= n % 100 <= 20 else {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th')
+    return str(n) + suffix
 
 # UI BELOW
 
@@ -88,15 +121,24 @@ col = st.columns((2.5, 4, 2), gap='large')
 with col[0]:
     st.write('### 🚲 Live Heatmap of People Using CitiBike')
     st.write('#### Time: :orange[' + datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ']')
-    st.plotly_chart(get_nyc_heatmap(df), use_container_width=True)
+    with metrics.timer('dashboard.heatmap_chart'):
+        st.plotly_chart(heatmap_fig, use_container_width=True)
 with col[1]:
     with st.container():
         st.markdown("""
                     # NYC Amount of CO₂ Saved
                     """)
-        st.progress(percentage, text="For the Month of April 2024")
-        st.write("🍃 Total Amount of CO₂ saved: *" + str(round(START_CO2 + co2_saved_total_live, 1)) + "* kilograms (**" + str(round(percentage * 100, 1)) + "%** of the way there!)")
-        st.write("🎯 Goal Amount of CO₂ to save this month: *" + str(GOAL_CO2) + "* kilograms")
+        st.progress(percentage, text="For the Month of " + NUM_TO_MONTH[selected_date.month] + " " + str(selected_date.year))
+        if START_CO2 is None:
+            st.write("🍃 Monthly totals are not ready yet, the trip files are still being ingested.")
+        else:
+            st.write("🍃 Total Amount of CO₂ saved: *" + str(round(START_CO2 + co2_saved_total_live, 1)) + "* kilograms (**" + str(round(percentage * 100, 1)) + "%** of the way there!)")
+        # last month's total to beat, or this month's projection in the first month of data
+        if GOAL_CO2 is not None:
+            projected = " (projected from this month's daily rate so far)" if GOAL_BASIS == 'projected' else ""
+            st.write("🎯 Goal Amount of CO₂ to save this month: *" + str(round(GOAL_CO2)) + "* kilograms" + projected)
+        elif START_CO2 is not None:
+            st.write("🎯 No goal for this month yet: there is no trip data for last month or for a full day of this one.")
     st.write("## 🏢 Live Feed of New York CitiBikers")
     with st.container(height=420, border=True):
         # REPLACE WITH CSP DATA
@@ -107,8 +149,8 @@ with col[1]:
                     st.markdown('<div style="text-align: right;">+🍃: ' + str(round(co2_30_sec_total, 2)) + ' kg of CO₂', unsafe_allow_html=True)
         for i in range(FEED_LENGTH):
             with st.container(border=True):
-                st.markdown("👤 *Anonymous* just rode for " + str(bike_car_commute_times[i]['bike']) + " minutes, saving :green[**" + str(round(amt_of_CO2_saved[i], 3)) + " kg of CO₂**]:")
-                st.markdown('<div style="text-align: right;">+🍃: ' + str(round(amt_of_CO2_saved[i], 3)) + ' kg of CO₂, saved ' + str(bike_car_commute_times[i]['drive'] - bike_car_commute_times[i]['bike']) + ' min compared to car</div>', unsafe_allow_html=True)
+                st.markdown("👤 *Anonymous* just rode for " + str(bike_car_commute_times['bike'][i]) + " minutes, saving :green[**" + str(round(amt_of_CO2_saved[i], 3)) + " kg of CO₂**]:")
+                st.markdown('<div style="text-align: right;">+🍃: ' + str(round(amt_of_CO2_saved[i], 3)) + ' kg of CO₂, saved ' + str(bike_car_commute_times['drive'][i] - bike_car_commute_times['bike'][i]) + ' min compared to car</div>', unsafe_allow_html=True)
 with col[2]:
     with st.container():
         st.write('''
@@ -120,14 +162,41 @@ with col[2]:
         ''')
     with st.container(height=410, border=True):
         st.write("### 🧍 Your contribution")
-        st.write("""
+        if rider is None:
+            st.write("Open this page with *?rider=* and your rider ID to see how much you've saved.")
+        else:
+            st.write("""
                 **This month, you've saved...**
-                - 🍃 CO2: 7.12 kg
-                - 🕒 Time saved: 16 minutes
+                - 🍃 CO2: """ + str(round(rider['month_co2'], 2)) + """ kg
+                - 🕒 Time saved: """ + str(int(rider['month_time'])) + """ minutes
                  
                 **All time, you've saved...**
-                - 🍃 CO2: 53.4 kg
-                - 🕒 Time saved: 109 minutes
+                - 🍃 CO2: """ + str(round(rider['total_co2'], 1)) + """ kg
+                - 🕒 Time saved: """ + str(int(rider['total_time'])) + """ minutes
                  """)
-        st.write("You are in the :red[**95th percentile**]: of CitiBike users for being environmently friendly this month!")
-
+            if rider['month_rides']:
+                st.write("You are in the :red[**" + ordinal(int(rider['month_percentile'])) + " percentile**]: of CitiBike users for being environmently friendly this month!")
+
+render_profile.stop()
+metrics.record('dashboard.render', time.perf_counter() - render_start)
+
+def show_metrics(snapshot):
+    if snapshot['timers']:
+        st.dataframe(pd.DataFrame(snapshot['timers']).T.round(3), use_container_width=True)
+    st.json({k: snapshot[k] for k in ('counters', 'gauges', 'sources')}, expanded=False)
+
+if DEBUG_PANEL or st.query_params.get('debug') == '1':
+    with st.expander('Debug: timings and cache stats', expanded=True):
+        st.write('#### Dashboard')
+        show_metrics(metrics.snapshot())
+        st.write('#### Poller')
+        poller_metrics = load_dump(os.path.join(METRICS_DIR, 'poll.json'))
+        if poller_metrics is None:
+            st.write('No metrics from the poller yet.')
+        else:
+            show_metrics(poller_metrics)
+        # restarts, heartbeats and queue depths, when running under supervisor.py
+        supervisor_metrics = load_dump(os.path.join(METRICS_DIR, 'supervisor.json'))
+        if supervisor_metrics is not None:
+            st.write('#### Supervisor')
+            show_metrics(supervisor_metrics)
@@ -0,0 +1,370 @@
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# Benchmarks for the trip-estimation and dashboard data paths.
+#
+#   python -m benchmarks.run --scale 1x --scale 10x
+#
+# Each benchmark reports throughput, p50/p99 latency and peak traced memory,
+# and the run is saved as JSON under benchmarks/results so the next run can
+# be compared against it.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import synthetic
+from benchmarks.fake_maps import FakeTransport
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+DATA_DIR = './data/benchmarks'
+SNAPSHOTS = 200
+
+
+def measure(fn, repeat, items=1, warmup=1):
+    for _ in range(warmup):
+        fn()
+
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+
+    # peak memory on a separate run, tracemalloc slows everything down
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = np.array(latencies)
+    return {
+        'repeat': repeat,
+        'items': items,
+        'mean_s': float(latencies.mean()),
+        'p50_s': float(np.percentile(latencies, 50)),
+        'p99_s': float(np.percentile(latencies, 99)),
+        'throughput_per_s': float(items / latencies.mean()) if latencies.mean() > 0 else float('inf'),
+        'peak_mem_mb': peak / 2 ** 20,
+    }
+
+
+def summarize(latencies, items_per_call=1):
+    latencies = np.asarray(latencies)
+    return {
+        'repeat': len(latencies),
+        'items': items_per_call,
+        'mean_s': float(latencies.mean()),
+        'p50_s': float(np.percentile(latencies, 50)),
+        'p99_s': float(np.percentile(latencies, 99)),
+        'throughput_per_s': float(items_per_call / latencies.mean()) if latencies.mean() > 0 else float('inf'),
+        'peak_mem_mb': None,
+    }
+
+
+class Environment:
+    # synthetic inputs for one scale, with every network dependency replaced by a local fake
+    def __init__(self, scale, data_dir, base_trips):
+        self.scale = scale
+        self.data_dir = os.path.join(data_dir, scale)
+        self.num_trips = int(base_trips * synthetic.SCALES[scale])
+        self.stations = synthetic.make_stations()
+        self.trip_file = synthetic.write_trip_csv(os.path.join(self.data_dir, 'tripdata.csv'), self.num_trips,
+                                                  self.stations)
+
+        import trip_store
+        trip_store.CACHE_DIR = os.path.join(self.data_dir, 'cache')
+
+        # station metadata from the synthetic feed instead of the live one
+        from csp_bike import StationMetadata, get_station_metadata_cache
+        self.metadata = StationMetadata.from_feed(synthetic.station_information(self.stations))
+        get_station_metadata_cache().pin(self.metadata)
+
+        # the Maps client is only built on first use, which the fake batcher below pre-empts
+        import distance
+        import station_matrix
+        from maps_batch import DistanceMatrixBatcher
+
+        distance.maps_batcher = DistanceMatrixBatcher(FakeTransport(), requests_per_second=None)
+        matrix = station_matrix.StationMatrix(self.stations['station_id'], self.stations['lat'],
+                                              self.stations['lon'], path=os.path.join(self.data_dir, 'station_matrix'))
+        # half the origins filled, so lookups exercise both the matrix and the fallback
+        half = len(self.stations) // 2
+        lats, lngs = matrix.lats, matrix.lngs
+        straight = distance.estimate_lat_lng_to_km_batch(lats[:half, None], lngs[:half, None], lats[None, :], lngs[None, :])
+        matrix.values[:, :half, :] = np.stack([station_matrix.fallback_estimate(straight)[k] for k in range(4)])
+        station_matrix._station_matrix = matrix
+
+
+def bench_trip_load(env, repeat):
+    import trip_store
+
+    def cold():
+        cache_file = trip_store.columnar_cache_file(env.trip_file)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        trip_store.clear_cache()
+        trip_store.load_trips(env.trip_file)
+
+    def warm():
+        trip_store.clear_cache()
+        trip_store.load_trips(env.trip_file)
+
+    return {
+        'trip_load_csv': measure(cold, max(1, repeat // 10), items=env.num_trips, warmup=0),
+        'trip_load_columnar': measure(warm, repeat, items=env.num_trips),
+    }
+
+
+def bench_dashboard(env, repeat):
+    # the work MainPage.get_heatmap / get_feed_data do per refresh (window and tiles)
+    from trip_window import get_trip_window
+    from heatmap_tiles import get_heatmap_tiles
+
+    window = get_trip_window(env.trip_file)
+    tiles = get_heatmap_tiles(env.trip_file)
+    start = datetime.datetime(2024, 3, 2)
+    ticks = iter(range(10 ** 9))
+
+    def heatmap():
+        window.heatmap(start + datetime.timedelta(hours=next(ticks) % (24 * 28)))
+
+    def heatmap_tiles():
+        tiles.heatmap(start + datetime.timedelta(hours=next(ticks) % (24 * 28)))
+
+    def feed():
+        window.last_finished(30, start + datetime.timedelta(hours=next(ticks) % (24 * 28)))
+
+    return {
+        'get_heatmap': measure(heatmap, repeat),
+        'get_heatmap_tiles': measure(heatmap_tiles, repeat),
+        'get_feed_data': measure(feed, repeat, items=30),
+    }
+
+
+def bench_bike_df(env, repeat):
+    import bike_tracking
+    import trip_store
+
+    df = trip_store.load_trips(env.trip_file)
+    return {
+        'get_bike_df': measure(lambda: bike_tracking.get_bike_df(df, out_file=None), max(1, repeat // 10),
+                               items=len(df)),
+    }
+
+
+def bench_estimates(env, repeat):
+    import distance
+    import trip_store
+
+    df = trip_store.load_trips(env.trip_file)
+    feed = df.tail(30)
+    rows = list(zip(feed['start_lat'], feed['start_lng'], feed['end_lat'], feed['end_lng']))
+
+    def scalar():
+        for row in rows:
+            distance.estimate_co2_saved(*row)
+
+    return {
+        'estimate_co2_saved': measure(scalar, repeat, items=len(rows)),
+        'estimate_co2_saved_batch': measure(lambda: distance.estimate_co2_saved_batch(df), max(1, repeat // 10),
+                                            items=len(df)),
+    }
+
+
+def bench_station_status(env, repeat):
+    import json
+    import httpx
+    import pandas as pd
+    from csp_bike import gbfs, get_station_status, get_station_status_columns, station_status_columns
+    from csp_bike.stations import _station_status_records
+
+    bodies = synthetic.station_status_bodies(env.stations, 8)
+    calls = iter(range(10 ** 9))
+
+    def handler(request):
+        return httpx.Response(200, content=bodies[next(calls) % len(bodies)],
+                              headers={'Content-Type': 'application/json'})
+
+    # parse only: the stdlib-json dict path this replaced, the orjson one and typed columns
+    def parse_stdlib():
+        _station_status_records(json.loads(bodies[next(calls) % len(bodies)]))
+
+    def parse_dicts():
+        _station_status_records(gbfs.loads(bodies[next(calls) % len(bodies)]))
+
+    def parse_columns():
+        station_status_columns(gbfs.loads(bodies[next(calls) % len(bodies)]), env.metadata.index)
+
+    # through to a DataFrame, the way get_station_status_df builds one
+    def df_dicts():
+        pd.json_normalize(_station_status_records(gbfs.loads(bodies[next(calls) % len(bodies)])))
+
+    def df_columns():
+        station_status_columns(gbfs.loads(bodies[next(calls) % len(bodies)]), env.metadata.index).df()
+
+    gbfs._client = gbfs.GBFSClient(transport=httpx.MockTransport(handler))
+    return {
+        'get_station_status': measure(get_station_status, repeat, items=len(env.stations)),
+        'get_station_status_columns': measure(get_station_status_columns, repeat, items=len(env.stations)),
+        'parse_station_status_stdlib': measure(parse_stdlib, repeat, items=len(env.stations)),
+        'parse_station_status_dicts': measure(parse_dicts, repeat, items=len(env.stations)),
+        'parse_station_status_columns': measure(parse_columns, repeat, items=len(env.stations)),
+        'station_status_df_dicts': measure(df_dicts, repeat, items=len(env.stations)),
+        'station_status_df_columns': measure(df_columns, repeat, items=len(env.stations)),
+    }
+
+
+def bench_approximate_trips(env, repeat):
+    import csp
+    from csp import ts
+    import poll
+
+    records = []
+    for k, doc in enumerate(synthetic.station_status_snapshots(env.stations, SNAPSHOTS)):
+        for record in doc['data']['stations']:
+            record['total_bikes_available'] = record['num_bikes_available']
+            record['num_bikes_available'] -= record['num_ebikes_available']
+            record.pop('vehicle_types_available')
+        records.append(doc['data']['stations'])
+    start = datetime.datetime(2024, 3, 27, 9)
+    curve = [(start + datetime.timedelta(seconds=28 * k), snapshot) for k, snapshot in enumerate(records)]
+
+    tick_times = []
+
+    @csp.node
+    def stamp(x: ts[float]):
+        if csp.ticked(x):
+            tick_times.append(time.perf_counter())
+
+    @csp.graph
+    def graph():
+        deltas = poll.station_deltas(csp.curve([dict], curve))
+        stamp(poll.approximate_trips(deltas, station_metadata=env.metadata, publish=False))
+
+    latencies = []
+    for _ in range(max(1, repeat // 10)):
+        tick_times.clear()
+        begin = time.perf_counter()
+        csp.run(graph, starttime=start, endtime=curve[-1][0])
+        # the first tick includes graph start-up and the full initial snapshot
+        latencies.extend(np.diff([begin] + tick_times)[1:])
+    return {'approximate_trips_tick': summarize(latencies)}
+
+
+# what each process imports before it can do any work; MainPage itself needs streamlit,
+# so the dashboard's set is the project modules it imports
+STARTUP_IMPORTS = {
+    'dashboard': 'import csp_bike.metrics, distance, trip_window, heatmap_tiles, trip_aggregates, rider_index, '
+                 'co2_channel',
+    'poller': 'import poll',
+}
+
+
+def bench_startup(env, repeat):
+    # wall time of a fresh interpreter importing each process's modules, without a Maps API key
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environ = {k: v for k, v in os.environ.items() if k != 'GOOGLE_MAPS_API_KEY'}
+    results = {}
+    for name, statement in STARTUP_IMPORTS.items():
+        latencies = []
+        for _ in range(max(1, repeat // 10)):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', statement], cwd=root, env=environ, check=True)
+            latencies.append(time.perf_counter() - start)
+        results['startup_' + name] = summarize(latencies)
+    return results
+
+
+BENCHMARKS = {
+    'trip_load': bench_trip_load,
+    'dashboard': bench_dashboard,
+    'bike_df': bench_bike_df,
+    'estimates': bench_estimates,
+    'station_status': bench_station_status,
+    'approximate_trips': bench_approximate_trips,
+    'startup': bench_startup,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latest_result(scale):
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    files = sorted(f for f in os.listdir(RESULTS_DIR) if f.startswith(scale + '-') and f.endswith('.json'))
+    return os.path.join(RESULTS_DIR, files[-1]) if files else None
+
+
+def print_results(results, previous=None):
+    previous = previous or {}
+    print('%-26s %12s %12s %12s %14s %10s %8s' % ('benchmark', 'p50 ms', 'p99 ms', 'mean ms', 'items/s', 'peak MB', 'vs prev'))
+    for name, result in results.items():
+        change = ''
+        if name in previous:
+            change = '%.2fx' % (result['p50_s'] / previous[name]['p50_s']) if previous[name]['p50_s'] else ''
+        peak = '%.1f' % result['peak_mem_mb'] if result['peak_mem_mb'] is not None else '-'
+        print('%-26s %12.3f %12.3f %12.3f %14.0f %10s %8s' % (
+            name, result['p50_s'] * 1e3, result['p99_s'] * 1e3, result['mean_s'] * 1e3,
+            result['throughput_per_s'], peak, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the trip-estimation and dashboard data paths')
+    parser.add_argument('--scale', action='append', choices=sorted(synthetic.SCALES), help='default: 1x')
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--base-trips', type=int, default=synthetic.TRIPS_PER_MONTH, help='trips at 1x')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--compare', help='result file to compare against (default: latest for the scale)')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    for scale in args.scale or ['1x']:
+        print('== %s ==' % scale)
+        env = Environment(scale, args.data_dir, args.base_trips)
+
+        results = {}
+        for name in args.only or BENCHMARKS:
+            results.update(BENCHMARKS[name](env, args.repeat))
+
+        previous_file = args.compare or latest_result(scale)
+        previous = None
+        if previous_file and os.path.exists(previous_file):
+            with open(previous_file, 'r') as f:
+                previous = json.load(f)['results']
+        print_results(results, previous)
+
+        if not args.no_save:
+            os.makedirs(RESULTS_DIR, exist_ok=True)
+            now = datetime.datetime.now()
+            path = os.path.join(RESULTS_DIR, '%s-%s.json' % (scale, now.strftime('%Y%m%d-%H%M%S')))
+            with open(path, 'w') as f:
+                json.dump({
+                    'timestamp': now.isoformat(),
+                    'git_revision': git_revision(),
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'scale': scale,
+                    'num_trips': env.num_trips,
+                    'results': results,
+                }, f, indent=2)
+            print('saved', path)
+
+
+if __name__ == '__main__':
+    main()
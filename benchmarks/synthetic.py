@@ -0,0 +1,134 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Synthetic Citi Bike inputs: trip CSVs in the monthly tripdata layout and
+# GBFS station_information / station_status documents, at a given scale.
+
+# one monthly tripdata file part holds about a million trips
+TRIPS_PER_MONTH = 1_000_000
+NUM_STATIONS = 2000
+SCALES = {'1x': 1, '10x': 10, '100x': 100}
+
+# roughly Manhattan, Brooklyn and Queens
+LAT_RANGE = (40.63, 40.82)
+LNG_RANGE = (-74.03, -73.88)
+
+TRIP_CSV_COLUMNS = ['ride_id', 'rideable_type', 'started_at', 'ended_at', 'start_station_name', 'start_station_id',
+                    'end_station_name', 'end_station_id', 'start_lat', 'start_lng', 'end_lat', 'end_lng',
+                    'member_casual']
+
+
+def make_stations(num_stations=NUM_STATIONS, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'station_id': ['%d.%02d' % (4000 + i, i % 100) for i in range(num_stations)],
+        'name': ['Station %d' % i for i in range(num_stations)],
+        'lat': rng.uniform(*LAT_RANGE, num_stations),
+        'lon': rng.uniform(*LNG_RANGE, num_stations),
+        'capacity': rng.integers(15, 60, num_stations),
+    })
+
+
+def make_trips(num_trips, stations=None, month='2024-03', seed=0):
+    # trips between random stations, start times spread over the month,
+    # durations lognormal around 12 minutes
+    stations = make_stations() if stations is None else stations
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(month + '-01')
+    seconds = int((start + pd.offsets.MonthBegin(1) - start).total_seconds())
+
+    started_at = start + pd.to_timedelta(np.sort(rng.integers(0, seconds, num_trips)), unit='s')
+    duration = pd.to_timedelta(np.clip(rng.lognormal(np.log(720), 0.5, num_trips), 60, 6 * 3600), unit='s')
+    ori = rng.integers(0, len(stations), num_trips)
+    dest = rng.integers(0, len(stations), num_trips)
+
+    # a few percent of e-bike trips have no station, like the real data
+    no_station = rng.random(num_trips) < 0.02
+    station_ids = stations['station_id'].to_numpy().astype(object)
+    start_ids = station_ids[ori].copy()
+    start_ids[no_station] = None
+
+    return pd.DataFrame({
+        'ride_id': np.char.mod('%016X', rng.integers(0, 2 ** 62, num_trips)),
+        'rideable_type': np.where(rng.random(num_trips) < 0.3, 'electric_bike', 'classic_bike'),
+        'started_at': started_at,
+        'ended_at': started_at + duration,
+        'start_station_name': stations['name'].to_numpy()[ori],
+        'start_station_id': start_ids,
+        'end_station_name': stations['name'].to_numpy()[dest],
+        'end_station_id': station_ids[dest],
+        'start_lat': stations['lat'].to_numpy()[ori],
+        'start_lng': stations['lon'].to_numpy()[ori],
+        'end_lat': stations['lat'].to_numpy()[dest],
+        'end_lng': stations['lon'].to_numpy()[dest],
+        'member_casual': np.where(rng.random(num_trips) < 0.8, 'member', 'casual'),
+    }, columns=TRIP_CSV_COLUMNS)
+
+
+def write_trip_csv(path, num_trips, stations=None, seed=0, chunk_size=1_000_000):
+    # written in chunks so 100x scales do not need the whole month in memory
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if os.path.exists(path):
+        return path
+    tmp_path = path + '.tmp'
+    stations = make_stations() if stations is None else stations
+    for i, start in enumerate(range(0, num_trips, chunk_size)):
+        df = make_trips(min(chunk_size, num_trips - start), stations, seed=seed + i)
+        df.to_csv(tmp_path, mode='w' if i == 0 else 'a', header=(i == 0), index=False,
+                  date_format='%Y-%m-%d %H:%M:%S.%f')
+    os.replace(tmp_path, path)
+    return path
+
+
+def station_information(stations):
+    return {
+        'last_updated': 1711500000,
+        'ttl': 60,
+        'data': {'stations': [
+            {'station_id': station_id, 'name': name, 'lat': float(lat), 'lon': float(lon), 'capacity': int(capacity)}
+            for station_id, name, lat, lon, capacity in
+            zip(stations['station_id'], stations['name'], stations['lat'], stations['lon'], stations['capacity'])
+        ]},
+    }
+
+
+def station_status_snapshots(stations, num_snapshots, changes_per_snapshot=40, seed=0, start=1711500000, interval=28):
+    # station_status documents in poll order; each poll a few stations gain or lose bikes
+    rng = np.random.default_rng(seed)
+    capacity = stations['capacity'].to_numpy()
+    bikes = rng.integers(0, capacity + 1)
+    for k in range(num_snapshots):
+        changed = rng.choice(len(stations), changes_per_snapshot, replace=False)
+        bikes[changed] = np.clip(bikes[changed] + rng.integers(-3, 4, changes_per_snapshot), 0, capacity[changed])
+        ebikes = bikes // 4
+        yield {
+            'last_updated': start + k * interval,
+            'ttl': 60,
+            'data': {'stations': [
+                {
+                    'station_id': station_id,
+                    'num_bikes_available': int(b),
+                    'num_ebikes_available': int(e),
+                    'num_docks_available': int(c - b),
+                    'num_docks_disabled': 0,
+                    'num_bikes_disabled': 0,
+                    'is_installed': 1,
+                    'is_renting': 1,
+                    'is_returning': 1,
+                    'last_reported': start + k * interval,
+                    'vehicle_types_available': [
+                        {'vehicle_type_id': '1', 'count': int(b - e)},
+                        {'vehicle_type_id': '2', 'count': int(e)},
+                    ],
+                }
+                for station_id, b, e, c in zip(stations['station_id'], bikes, ebikes, capacity)
+            ]},
+        }
+
+
+def station_status_bodies(stations, num_snapshots, **kwargs):
+    # raw JSON bytes, as the HTTP client would receive them
+    return [json.dumps(doc).encode() for doc in station_status_snapshots(stations, num_snapshots, **kwargs)]
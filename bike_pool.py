@@ -0,0 +1,119 @@
+import math
+from collections import deque
+from datetime import timedelta
+
+import distance
+
+# Bikes currently out on a trip, indexed by where and when they were checked
+# out. Checkouts live in a uniform grid over projected station coordinates so
+# finding the ones that could have reached a station is a radius query, and
+# a time-ordered queue lets stale checkouts be expired in bulk.
+
+KM_PER_DEG_LAT = 110.574
+KM_PER_DEG_LNG = 111.320
+# latitude the grid is projected around (midtown Manhattan)
+ORIGIN_LAT = 40.75651
+
+# fastest reasonable biking speed in the city is 20 km/h
+MAX_SPEED_KMH = 20
+# checkouts older than this are assumed to have been returned unseen
+MAX_TRIP_AGE = timedelta(hours=1)
+
+STATION_ID, LAT, LNG, TIME, COUNT, CELL = range(6)
+
+
+class BikePool:
+    def __init__(self, cell_km=1.0, max_speed_kmh=MAX_SPEED_KMH, max_age=MAX_TRIP_AGE):
+        self.cell_km = cell_km
+        self.max_speed_kmh = max_speed_kmh
+        self.max_age = max_age
+        self._cos_lat = math.cos(math.radians(ORIGIN_LAT))
+
+        # entry id -> [station_id, lat, lng, time, count, cell]
+        self.entries = {}
+        # cell -> {entry id: time}
+        self.cells = {}
+        # (time, entry id) in checkout order, for bulk expiry
+        self.by_time = deque()
+        self.num_bikes = 0
+        self._next_id = 0
+
+    def __len__(self):
+        return self.num_bikes
+
+    def _project(self, lat, lng):
+        # km east/north of the grid origin
+        return lng * KM_PER_DEG_LNG * self._cos_lat, lat * KM_PER_DEG_LAT
+
+    def _cell(self, lat, lng):
+        x, y = self._project(lat, lng)
+        return int(math.floor(x / self.cell_km)), int(math.floor(y / self.cell_km))
+
+    def check_out(self, station_id, lat, lng, time, count):
+        entry_id = self._next_id
+        self._next_id += 1
+        cell = self._cell(lat, lng)
+        self.entries[entry_id] = [station_id, lat, lng, time, count, cell]
+        self.cells.setdefault(cell, {})[entry_id] = time
+        self.by_time.append((time, entry_id))
+        self.num_bikes += count
+        return entry_id
+
+    def _remove(self, entry_id):
+        entry = self.entries.pop(entry_id)
+        cell = self.cells[entry[CELL]]
+        del cell[entry_id]
+        if not cell:
+            del self.cells[entry[CELL]]
+        self.num_bikes -= entry[COUNT]
+        return entry
+
+    def expire(self, now):
+        # drop every checkout older than max_age, returns the number of bikes dropped
+        cutoff = now - self.max_age
+        expired = 0
+        while self.by_time and self.by_time[0][0] < cutoff:
+            _, entry_id = self.by_time.popleft()
+            if entry_id in self.entries:
+                expired += self._remove(entry_id)[COUNT]
+        return expired
+
+    def candidates(self, lat, lng, now):
+        # ids of checkouts that could have been ridden to (lat, lng) by `now`
+        if not self.entries:
+            return []
+
+        oldest = self.by_time[0][0]
+        radius_km = max(0.0, (now - oldest).total_seconds() / 3600 * self.max_speed_kmh)
+        cx, cy = self._cell(lat, lng)
+        reach = int(math.ceil(radius_km / self.cell_km))
+
+        found = []
+        if (2 * reach + 1) ** 2 > len(self.cells):
+            # radius covers more cells than are occupied, just walk the occupied ones
+            cells = self.cells.items()
+        else:
+            cells = ((cell, self.cells[cell]) for cell in
+                     ((x, y) for x in range(cx - reach, cx + reach + 1) for y in range(cy - reach, cy + reach + 1))
+                     if cell in self.cells)
+
+        for (x, y), cell_entries in cells:
+            # skip cells that no checkout in them could have left early enough to cross
+            gap_x = max(0, abs(x - cx) - 1) * self.cell_km
+            gap_y = max(0, abs(y - cy) - 1) * self.cell_km
+            if math.hypot(gap_x, gap_y) > radius_km:
+                continue
+            for entry_id, time in cell_entries.items():
+                entry = self.entries[entry_id]
+                if distance.is_trip_possible(entry[LAT], entry[LNG], lat, lng, time, now):
+                    found.append(entry_id)
+        return found
+
+    def take(self, entry_id):
+        # take one bike from a checkout, returns (station_id, lat, lng, time, bikes left)
+        entry = self.entries[entry_id]
+        entry[COUNT] -= 1
+        self.num_bikes -= 1
+        if entry[COUNT] == 0:
+            self._remove(entry_id)
+        return entry[STATION_ID], entry[LAT], entry[LNG], entry[TIME], entry[COUNT]
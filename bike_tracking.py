@@ -1,45 +1,65 @@
+import os
 import numpy as np
 import pandas as pd
 import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+from trip_store import load_trips, read_columnar, write_columnar
 
-def get_df():
-    df = pd.read_csv('./data/202403-citibike-tripdata_1.csv')
-    df = df[['started_at', 'ended_at', 'start_station_id', 'end_station_id', 'start_lat', 'start_lng', 'end_lat', 'end_lng']]
-
-    df['started_at'] = pd.to_datetime(df['started_at']).dt.round('H')
-    df['ended_at'] = pd.to_datetime(df['ended_at']).dt.round('H')
+BIKE_DF_FILE = 'data/bike_net_change.parquet'
 
-    df['start_station_id'] = df['start_station_id'].astype(str)
-    df['end_station_id'] = df['end_station_id'].astype(str)
+def get_df():
+    df = load_trips().copy()
 
-    df = df[(df['start_station_id'] != 'nan') & (df['end_station_id'] != 'nan')]
+    df['started_at'] = df['started_at'].dt.round('h')
+    df['ended_at'] = df['ended_at'].dt.round('h')
 
-    df = df.dropna()
     return df
 
-def get_bike_df(df):
-    ### IF ALREADY SAVED: JUST LOAD CSV BECAUSE THIS TAKES A LONG TIME
+def get_bike_events(df):
+    # every trip is a departure (-1) at its start station and an arrival (+1) at its end station
+    departures = pd.DataFrame({
+        'station_id': df['start_station_id'].astype(str),
+        'timestamp': df['started_at'].dt.round('min'),
+        'net_change': np.int64(-1),
+    })
+    arrivals = pd.DataFrame({
+        'station_id': df['end_station_id'].astype(str),
+        'timestamp': df['ended_at'].dt.round('min'),
+        'net_change': np.int64(1),
+    })
+    events = pd.concat([departures, arrivals], ignore_index=True)
+    events['station_id'] = events['station_id'].astype('category')
+    return events
 
-    df['start_time'] = df['started_at'].dt.round('min').dt.time
-    df['end_time'] = df['ended_at'].dt.round('min').dt.time
+def net_bikes_by_station(events):
+    # net change per station per minute, and the running number of net bikes
+    df_bike = events.groupby(['station_id', 'timestamp'], observed=True, sort=True)['net_change'].sum().reset_index()
+    df_bike['num_net_bikes'] = df_bike.groupby('station_id', observed=True)['net_change'].cumsum()
+    return df_bike
 
-    stations = df['start_station_id'].unique()
-    df_bikes = {station: None for station in stations}
-    for station in stations:
-        df_station = df[(df['start_station_id'] == station) | (df['end_station_id'] == station)]
-        df_station['net_change'] = df_station.apply(lambda x: -1 if x['start_station_id'] == station else 1, axis=1)
-        df_station['timestamp'] = df_station.apply(lambda x: x['start_time'] if x['start_station_id'] == station else x['end_time'], axis=1)
+def get_bike_df(df, processes=1, out_file=BIKE_DF_FILE):
+    events = get_bike_events(df)
 
-        df_station = df_station.groupby('timestamp')['net_change'].mean().reset_index('timestamp')
-        df_station.sort_values(by='timestamp')
-        df_station['num_net_bikes'] = df_station['net_change'].cumsum()
+    if processes > 1:
+        # stations are independent, so split them across cores
+        partition = events['station_id'].cat.codes.to_numpy() % processes
+        parts = [events[partition == i] for i in range(processes)]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            df_bike = pd.concat(list(executor.map(net_bikes_by_station, parts)), ignore_index=True)
+        df_bike = df_bike.sort_values(['station_id', 'timestamp'], ignore_index=True)
+    else:
+        df_bike = net_bikes_by_station(events)
 
-        df_bikes[station] = df_station
-    
-    df_bike = pd.concat(df_bikes).reset_index().rename(columns={'level_0': 'station_id'})
-    df_bike.to_csv('data/bike_net_change.csv')
+    if out_file:
+        write_columnar(df_bike, out_file)
 
     return df_bike
 
+def load_bike_df(df=None, processes=1, out_file=BIKE_DF_FILE):
+    # reuse the saved result if there is one, otherwise build and save it
+    if os.path.exists(out_file):
+        return read_columnar(out_file)
+    return get_bike_df(get_df() if df is None else df, processes=processes, out_file=out_file)
+
 def graph_station(df_bike, station):
-    df_bike[df_bike['station'] == station].plot(x='timestamp', y='num_net_bikes')
\ No newline at end of file
+    df_bike[df_bike['station_id'] == station].plot(x='timestamp', y='num_net_bikes')
@@ -0,0 +1,155 @@
+import os
+from datetime import datetime
+
+import numpy as np
+
+# Publish channel from the csp graph (poll.py) to the dashboard (MainPage.py).
+# A fixed-layout memory-mapped ring buffer: one writer appends records of
+# (timestamp, delta CO2, cumulative CO2, bikes in pool, per-station bike
+# counts), readers map the same file and copy records out with no parsing.
+#
+# Each slot carries its own sequence number, written odd before the record
+# and even after it (a seqlock), so a reader that races the writer notices
+# the torn record and retries instead of returning a half-written value.
+
+CHANNEL_FILE = './data/co2_channel.bin'
+MAGIC = b'CO2RING1'
+
+# two days of 28-second polls
+DEFAULT_CAPACITY = 6200
+# stations are addressed by their interned metadata index
+DEFAULT_NUM_STATIONS = 4096
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('capacity', '<u4'),
+    ('num_stations', '<u4'),
+    ('seq', '<u8'),
+])
+HEADER_SIZE = 64
+
+READ_RETRIES = 100
+
+SUMMARY_FIELDS = ['seq', 'timestamp', 'delta_co2', 'total_co2', 'bikes_in_pool']
+
+
+def record_dtype(num_stations):
+    return np.dtype([
+        ('seq', '<u8'),
+        ('timestamp', '<f8'),
+        ('delta_co2', '<f8'),
+        ('total_co2', '<f8'),
+        ('bikes_in_pool', '<i8'),
+        ('station_counts', '<i4', (num_stations,)),
+    ])
+
+
+class Co2Channel:
+    def __init__(self, path, mode):
+        self.path = path
+        self.header = np.memmap(path, dtype=HEADER_DTYPE, mode=mode, shape=(1,))
+        if self.header['magic'][0] != MAGIC:
+            raise ValueError('%s is not a CO2 channel file' % path)
+        self.capacity = int(self.header['capacity'][0])
+        self.num_stations = int(self.header['num_stations'][0])
+        self.records = np.memmap(path, dtype=record_dtype(self.num_stations), mode=mode,
+                                 offset=HEADER_SIZE, shape=(self.capacity,))
+
+    @classmethod
+    def create(cls, path=CHANNEL_FILE, capacity=DEFAULT_CAPACITY, num_stations=DEFAULT_NUM_STATIONS):
+        # open for writing, reusing an existing file with the same layout so
+        # history survives a poller restart
+        if os.path.exists(path):
+            try:
+                channel = cls(path, 'r+')
+                if channel.capacity == capacity and channel.num_stations == num_stations:
+                    return channel
+            except ValueError:
+                pass
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        size = HEADER_SIZE + capacity * record_dtype(num_stations).itemsize
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.truncate(size)
+        header = np.memmap(tmp_path, dtype=HEADER_DTYPE, mode='r+', shape=(1,))
+        header['magic'] = MAGIC
+        header['capacity'] = capacity
+        header['num_stations'] = num_stations
+        header['seq'] = 0
+        header.flush()
+        del header
+        os.replace(tmp_path, path)
+        return cls(path, 'r+')
+
+    @classmethod
+    def open(cls, path=CHANNEL_FILE):
+        # open for reading, None if the poller has not created the channel yet
+        if not os.path.exists(path):
+            return None
+        return cls(path, 'r')
+
+    def __len__(self):
+        return min(int(self.header['seq'][0]), self.capacity)
+
+    def publish(self, timestamp, delta_co2, total_co2, bikes_in_pool, station_counts=None):
+        n = int(self.header['seq'][0])
+        slot = n % self.capacity
+        record = self.records[slot:slot + 1]
+
+        record['seq'] = 2 * n + 1
+        record['timestamp'] = timestamp.timestamp() if isinstance(timestamp, datetime) else timestamp
+        record['delta_co2'] = delta_co2
+        record['total_co2'] = total_co2
+        record['bikes_in_pool'] = bikes_in_pool
+        if station_counts is not None:
+            counts = np.asarray(station_counts)[:self.num_stations]
+            record['station_counts'][0, :len(counts)] = counts
+            record['station_counts'][0, len(counts):] = 0
+        record['seq'] = 2 * n + 2
+
+        self.header['seq'] = n + 1
+
+    def _read(self, n):
+        # copy out record n, or None if it has been overwritten
+        slot = n % self.capacity
+        for _ in range(READ_RETRIES):
+            before = int(self.records['seq'][slot])
+            record = self.records[slot].copy()
+            after = int(self.records['seq'][slot])
+            if before == after and before % 2 == 0:
+                return record if before == 2 * n + 2 else None
+        return None
+
+    def latest(self):
+        # most recent record as a numpy structured scalar, None if nothing published
+        for _ in range(READ_RETRIES):
+            seq = int(self.header['seq'][0])
+            if seq == 0:
+                return None
+            record = self._read(seq - 1)
+            if record is not None:
+                return record
+        return None
+
+    def latest_total(self, default=0.0):
+        # cumulative CO2 of the most recent record
+        latest = self.latest()
+        return float(latest['total_co2']) if latest is not None else default
+
+    def history(self, n=None, with_stations=False):
+        # up to the last n records, oldest first, as a structured array; torn
+        # or already overwritten records are dropped
+        seq = int(self.header['seq'][0])
+        count = min(seq, self.capacity, self.capacity if n is None else n)
+        index = np.arange(seq - count, seq, dtype=np.uint64)
+        slots = (index % self.capacity).astype(np.int64)
+
+        before = self.records['seq'][slots]
+        records = (self.records if with_stations else self.records[SUMMARY_FIELDS])[slots]
+        after = self.records['seq'][slots]
+        return records[(before == after) & (before == 2 * index + 2)]
+
+    def flush(self):
+        self.records.flush()
+        self.header.flush()
@@ -1,5 +1,36 @@
-# from .csv import CSVAdapter
-# from .historical import *
 from .stations import *
+from .status_columns import *
+from .gbfs import *
+from .metadata import *
 from .endpoints import *
-# from .webapp import *
\ No newline at end of file
+
+# The modules below need csp, which takes seconds to import; they load on first
+# use of one of their names, so importing the package for the GBFS client,
+# station metadata or metrics stays cheap. Keep this in step with each module's
+# __all__.
+_LAZY_NAMES = {
+    "ARCHIVE_FILE": "archive",
+    "ArchiveReplay": "archive",
+    "SnapshotArchive": "archive",
+    "SnapshotWriter": "archive",
+    "CSVAdapter": "csv",
+    "StationStatusReplay": "csv",
+    "trip_station_metadata": "csv",
+    "StationDelta": "structs",
+    "GBFSPollerManager": "multi_poll",
+    "SnapshotQueueManager": "pipeline",
+    "enqueue_snapshots": "pipeline",
+    "heartbeat": "pipeline",
+    "put_latest": "pipeline",
+    "queue_depth": "pipeline",
+}
+
+
+def __getattr__(name):
+    module_name = _LAZY_NAMES.get(name)
+    if module_name is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    import importlib
+
+    value = globals()[name] = getattr(importlib.import_module("." + module_name, __name__), name)
+    return value
@@ -0,0 +1,261 @@
+import json
+import os
+import struct
+import time
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np
+
+__all__ = (
+    "ARCHIVE_FILE",
+    "ArchiveReplay",
+    "SnapshotArchive",
+    "SnapshotWriter",
+)
+
+# Append-only archive of station_status snapshots.
+#
+#   <path>           chunks of up to CHUNK_SNAPSHOTS snapshots; each chunk is a
+#                    fixed header followed by zlib-compressed int64 timestamps
+#                    and an int16 (snapshots, stations, FIELDS) array
+#   <path>.idx       one fixed-size record per chunk (first ts, last ts, offset,
+#                    count), so a reader binary-searches the time index and
+#                    decodes only the chunks from the seek point onwards
+#   <path>.stations  station ids in index order; ids are only ever appended,
+#                    so older chunks with fewer stations stay valid
+#
+# Stations are addressed by the interned metadata index (station_index).
+#
+# Only ArchiveReplay needs csp; it is built on first use, so the supervisor and
+# other processes that only need the path or the reader don't import csp.
+
+# every live station_status snapshot is appended here
+ARCHIVE_FILE = "./data/station_status.gbfsarc"
+
+FIELDS = ("num_bikes_available", "num_ebikes_available", "num_docks_available")
+CHUNK_SNAPSHOTS = 32
+# seconds a snapshot may wait in the writer's buffer, which bounds what a killed
+# process loses; at the 28s poll interval that makes chunks of 5 or 6 snapshots
+FLUSH_INTERVAL = 120.0
+
+CHUNK_MAGIC = b"GBFSCHNK"
+# magic, snapshot count, station count, compressed payload size
+CHUNK_HEADER = struct.Struct("<8sIIQ")
+INDEX_DTYPE = np.dtype([("first", "<i8"), ("last", "<i8"), ("offset", "<u8"), ("count", "<u4"), ("pad", "<u4")])
+
+
+def _to_micros(timestamp):
+    if isinstance(timestamp, datetime):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return int(timestamp.timestamp() * 1_000_000)
+    return int(timestamp)
+
+
+def _from_micros(micros):
+    return datetime.fromtimestamp(micros / 1_000_000, tz=timezone.utc).replace(tzinfo=None)
+
+
+class SnapshotWriter:
+    def __init__(self, path, chunk_snapshots=CHUNK_SNAPSHOTS, level=6, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.chunk_snapshots = chunk_snapshots
+        self.level = level
+        self.flush_interval = flush_interval
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        self.station_ids = []
+        if os.path.exists(path + ".stations"):
+            with open(path + ".stations", "r") as f:
+                self.station_ids = json.load(f)
+        self._data = open(path, "ab")
+        self._index = open(path + ".idx", "ab")
+
+        self._times = []
+        self._snapshots = []
+        # monotonic time the oldest buffered snapshot was appended
+        self._buffered_since = None
+        # the last station order seen by append, and its archive positions
+        self._synced_ids = None
+        self._positions = None
+
+    def _sync_station_ids(self, station_ids):
+        # archive position of each station in the caller's interned order.
+        # Ids the archive has not seen are appended; known ids keep their
+        # position even if the caller's order changed, so older chunks stay valid
+        station_ids = list(station_ids)
+        if station_ids == self._synced_ids:
+            return self._positions
+        positions = {station_id: i for i, station_id in enumerate(self.station_ids)}
+        new_ids = [station_id for station_id in dict.fromkeys(station_ids) if station_id not in positions]
+        if new_ids:
+            positions.update((station_id, len(self.station_ids) + k) for k, station_id in enumerate(new_ids))
+            self.station_ids = self.station_ids + new_ids
+            tmp_file = self.path + ".stations.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(self.station_ids, f)
+            os.replace(tmp_file, self.path + ".stations")
+        self._synced_ids = station_ids
+        self._positions = np.array([positions[station_id] for station_id in station_ids], dtype=np.int64)
+        return self._positions
+
+    def append(self, timestamp, records, station_ids):
+        # records: station_status dicts carrying station_index into station_ids
+        positions = self._sync_station_ids(station_ids)
+        snapshot = np.full((len(self.station_ids), len(FIELDS)), -1, dtype=np.int16)
+        for record in records:
+            i = record.get("station_index", -1)
+            if 0 <= i < len(positions):
+                snapshot[positions[i]] = [record.get(field, 0) for field in FIELDS]
+        if not self._snapshots:
+            self._buffered_since = time.monotonic()
+        self._times.append(_to_micros(timestamp))
+        self._snapshots.append(snapshot)
+        if (len(self._snapshots) >= self.chunk_snapshots
+                or time.monotonic() - self._buffered_since >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if not self._snapshots:
+            return
+        num_stations = max(len(snapshot) for snapshot in self._snapshots)
+        data = np.full((len(self._snapshots), num_stations, len(FIELDS)), -1, dtype=np.int16)
+        for k, snapshot in enumerate(self._snapshots):
+            data[k, :len(snapshot)] = snapshot
+        times = np.asarray(self._times, dtype=np.int64)
+
+        payload = zlib.compress(times.tobytes() + data.tobytes(), self.level)
+        offset = self._data.tell()
+        self._data.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(times), num_stations, len(payload)))
+        self._data.write(payload)
+        self._data.flush()
+
+        # index entry last, so a reader never sees an entry for a partial chunk
+        entry = np.array([(times[0], times[-1], offset, len(times), 0)], dtype=INDEX_DTYPE)
+        self._index.write(entry.tobytes())
+        self._index.flush()
+
+        self._times = []
+        self._snapshots = []
+        self._buffered_since = None
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+
+class SnapshotArchive:
+    def __init__(self, path):
+        self.path = path
+        self.station_ids = []
+        if os.path.exists(path + ".stations"):
+            with open(path + ".stations", "r") as f:
+                self.station_ids = json.load(f)
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            index = np.fromfile(self.path + ".idx", dtype=INDEX_DTYPE)
+            if len(index):
+                return index
+        except FileNotFoundError:
+            pass
+        # no index: rebuild it by hopping over the chunk headers
+        entries = []
+        with open(self.path, "rb") as f:
+            while True:
+                offset = f.tell()
+                header = f.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    break
+                magic, count, num_stations, size = CHUNK_HEADER.unpack(header)
+                if magic != CHUNK_MAGIC:
+                    break
+                times = np.frombuffer(zlib.decompressobj().decompress(f.read(size), count * 8)[:count * 8], dtype=np.int64)
+                entries.append((times[0], times[-1], offset, count, 0))
+        return np.array(entries, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return int(self.index["count"].sum())
+
+    def time_range(self):
+        if not len(self.index):
+            return None
+        return _from_micros(self.index["first"][0]), _from_micros(self.index["last"][-1])
+
+    def _read_chunk(self, f, entry):
+        f.seek(int(entry["offset"]))
+        magic, count, num_stations, size = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+        raw = zlib.decompress(f.read(size))
+        times = np.frombuffer(raw, dtype=np.int64, count=count)
+        data = np.frombuffer(raw, dtype=np.int16, offset=count * 8).reshape(count, num_stations, len(FIELDS))
+        return times, data
+
+    def read(self, start=None, end=None):
+        # yields (datetime, int16 array (stations, FIELDS)) from the first
+        # snapshot at or after start, decoding only the chunks it needs
+        start = _to_micros(start) if start is not None else None
+        end = _to_micros(end) if end is not None else None
+        first_chunk = int(np.searchsorted(self.index["last"], start, side="left")) if start is not None else 0
+        with open(self.path, "rb") as f:
+            for entry in self.index[first_chunk:]:
+                if end is not None and entry["first"] > end:
+                    return
+                times, data = self._read_chunk(f, entry)
+                for k in range(len(times)):
+                    if start is not None and times[k] < start:
+                        continue
+                    if end is not None and times[k] > end:
+                        return
+                    yield _from_micros(times[k]), data[k]
+
+    def read_records(self, start=None, end=None):
+        # like read, but each snapshot as station_status-style dicts
+        for timestamp, data in self.read(start, end):
+            present = np.flatnonzero(data[:, 0] >= 0)
+            yield timestamp, [
+                {
+                    "station_id": self.station_ids[i] if i < len(self.station_ids) else str(i),
+                    "station_index": int(i),
+                    "num_bikes_available": int(data[i, 0]),
+                    "num_ebikes_available": int(data[i, 1]),
+                    "num_docks_available": int(data[i, 2]),
+                    "total_bikes_available": int(data[i, 0]) + int(data[i, 1]),
+                }
+                for i in present
+            ]
+
+
+def _archive_replay():
+    from csp import ts
+    from csp.impl.pulladapter import PullInputAdapter
+    from csp.impl.wiring import py_pull_adapter_def
+
+    class ArchiveReplayImpl(PullInputAdapter):
+        # replays an archive into the graph in place of poll_data
+        def __init__(self, path: str):
+            self._path = path
+            self._records = None
+            super().__init__()
+
+        def start(self, starttime, endtime):
+            super().start(starttime, endtime)
+            self._records = SnapshotArchive(self._path).read_records(starttime, endtime)
+
+        def stop(self):
+            self._records = None
+
+        def next(self):
+            return next(self._records, None)
+
+    return py_pull_adapter_def("ArchiveReplay", ArchiveReplayImpl, ts[[dict]], path=str)
+
+
+def __getattr__(name):
+    global ArchiveReplay
+    if name != "ArchiveReplay":
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    ArchiveReplay = _archive_replay()
+    return ArchiveReplay
@@ -1,63 +1,184 @@
-# import csv as pycsv
-# from datetime import datetime
-
-# from csp import ts
-# from csp.impl.pulladapter import PullInputAdapter
-# from csp.impl.wiring import py_pull_adapter_def
-
-
-# class CSVAdapterImpl(PullInputAdapter):
-#     def __init__(self, filename: str, datetime_columns: list = None):
-#         if not datetime_columns:
-#             raise Exception("Must provide at least one datetime column")
-#         self._filename = filename
-#         self._datetime_columns = datetime_columns
-#         self._csv_reader = None
-#         self._first_row = None
-#         super().__init__()
-
-#     def start(self, starttime, endtime):
-#         super().start(starttime, endtime)
-#         self._csv_reader = pycsv.DictReader(open(self._filename, "r"))
-
-#         # fast forward to first record
-#         while True:
-#             try:
-#                 row = next(self._csv_reader)
-#                 time = datetime.strptime(
-#                     row[self._datetime_columns[0]], "%Y-%m-%d %H:%M:%S"
-#                 )
-
-#                 if time < starttime:
-#                     continue
-
-#                 for dtc in self._datetime_columns:
-#                     row[dtc] = datetime.strptime(row[dtc], "%Y-%m-%d %H:%M:%S")
-#                 self._first_row = row
-#                 break
-
-#             except StopIteration:
-#                 return
-
-#     def stop(self):
-#         self._csv_reader = None
-
-#     def next(self):
-#         if self._first_row is not None:
-#             ret = self._first_row[self._datetime_columns[0]], self._first_row
-#             self._first_row = None
-#         try:
-#             row = next(self._csv_reader)
-#             time = datetime.strptime(
-#                 row[self._datetime_columns[0]], "%Y-%m-%d %H:%M:%S"
-#             )
-#             for dtc in self._datetime_columns:
-#                 row[dtc] = datetime.strptime(row[dtc], "%Y-%m-%d %H:%M:%S")
-#             return time, row
-#         except StopIteration:
-#             return None
-
-
-# CSVAdapter = py_pull_adapter_def(
-#     "CSVAdapter", CSVAdapterImpl, ts[dict], filename=str, datetime_columns=list
-# )
\ No newline at end of file
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from csp import ts
+from csp.impl.pulladapter import PullInputAdapter
+from csp.impl.wiring import py_pull_adapter_def
+
+from trip_store import load_trips
+
+from .metadata import StationMetadata
+
+__all__ = (
+    "CSVAdapter",
+    "StationStatusReplay",
+    "trip_station_metadata",
+)
+
+# Historical inputs for running the csp graph with realtime=False.
+# CSVs are read in chunks with vectorized datetime parsing (or straight from
+# a Parquet cache), and records are handed to the engine from pre-built
+# arrays instead of one strptime per column per row. Trips come from
+# trip_store, so a replay shares its columnar cache with the dashboard.
+
+CHUNK_SIZE = 500_000
+
+
+def _read_chunks(filename, datetime_columns, usecols=None, chunksize=CHUNK_SIZE):
+    if filename.endswith(".parquet"):
+        yield pd.read_parquet(filename, columns=usecols)
+        return
+    for chunk in pd.read_csv(filename, usecols=usecols, chunksize=chunksize,
+                             dtype={"start_station_id": str, "end_station_id": str}):
+        for column in datetime_columns:
+            chunk[column] = pd.to_datetime(chunk[column], format="ISO8601")
+        yield chunk
+
+
+def trip_station_metadata(filename):
+    # station metadata derived from the trips themselves, for replays where the
+    # historical station ids do not match the live station_information feed
+    df = load_trips(filename)
+    coords = pd.concat([
+        df[["start_station_id", "start_lat", "start_lng"]].set_axis(["station_id", "lat", "lon"], axis=1),
+        df[["end_station_id", "end_lat", "end_lng"]].set_axis(["station_id", "lat", "lon"], axis=1),
+    ]).astype({"station_id": str}).groupby("station_id")[["lat", "lon"]].median()
+    stations = {
+        station_id: {"station_id": station_id, "lat": float(lat), "lon": float(lon)}
+        for station_id, lat, lon in zip(coords.index, coords["lat"], coords["lon"])
+    }
+    return StationMetadata(stations, list(stations))
+
+
+class CSVAdapterImpl(PullInputAdapter):
+    # one dict per row, timestamped by the first datetime column; the file is
+    # expected in time order (a trip_store Parquet cache is)
+    def __init__(self, filename: str, datetime_columns: list = None):
+        if not datetime_columns:
+            raise Exception("Must provide at least one datetime column")
+        self._filename = filename
+        self._datetime_columns = datetime_columns
+        self._chunks = None
+        self._rows = iter(())
+        self._times = iter(())
+        self._last_time = None
+        super().__init__()
+
+    def start(self, starttime, endtime):
+        super().start(starttime, endtime)
+        self._chunks = _read_chunks(self._filename, self._datetime_columns)
+
+    def stop(self):
+        self._chunks = None
+
+    def _next_chunk(self):
+        for chunk in self._chunks:
+            times = chunk[self._datetime_columns[0]]
+            chunk = chunk[(times >= self._start_time) & (times <= self._end_time)]
+            if len(chunk):
+                self._times = iter(chunk[self._datetime_columns[0]].dt.to_pydatetime())
+                self._rows = iter(chunk.to_dict("records"))
+                return True
+        return False
+
+    def next(self):
+        row = next(self._rows, None)
+        if row is None:
+            if self._chunks is None or not self._next_chunk():
+                return None
+            row = next(self._rows)
+        time = next(self._times)
+        # never step back in time, the engine requires ordered ticks
+        if self._last_time is not None and time < self._last_time:
+            time = self._last_time
+        self._last_time = time
+        return time, row
+
+
+CSVAdapter = py_pull_adapter_def(
+    "CSVAdapter", CSVAdapterImpl, ts[dict], filename=str, datetime_columns=list
+)
+
+
+class StationStatusReplayImpl(PullInputAdapter):
+    # Replays trips as station_status snapshots every `interval`: each trip is
+    # a departure (-1) at its start station and an arrival (+1) at its end
+    # station. The first snapshot lists every station, later ones only the
+    # stations whose counts changed during the interval, which is what
+    # station_deltas would have passed on anyway.
+    def __init__(self, filename: str, interval: timedelta):
+        self._filename = filename
+        self._interval = interval
+        super().__init__()
+
+    def start(self, starttime, endtime):
+        super().start(starttime, endtime)
+        df = load_trips(self._filename)
+
+        station_ids = pd.Categorical(np.concatenate([
+            df["start_station_id"].astype(str).to_numpy(),
+            df["end_station_id"].astype(str).to_numpy(),
+        ]))
+        times = np.concatenate([df["started_at"].to_numpy(), df["ended_at"].to_numpy()])
+        changes = np.concatenate([np.full(len(df), -1, dtype=np.int64), np.ones(len(df), dtype=np.int64)])
+
+        order = np.argsort(times, kind="stable")
+        self._codes = station_ids.codes[order].astype(np.int64)
+        self._times = times[order]
+        self._changes = changes[order]
+        self._station_ids = list(station_ids.categories)
+
+        # start every station with enough bikes that it never goes negative
+        running = pd.Series(self._changes).groupby(self._codes).cumsum()
+        lowest = running.groupby(self._codes).min().reindex(range(len(self._station_ids)), fill_value=0)
+        self._counts = -np.minimum(lowest.to_numpy(), 0)
+
+        t0 = np.datetime64(max(pd.Timestamp(starttime), pd.Timestamp(self._times[0])).to_datetime64()) \
+            if len(self._times) else np.datetime64(starttime)
+        self._tick_time = t0
+        self._step = np.timedelta64(self._interval)
+        self._end = np.datetime64(pd.Timestamp(endtime).to_datetime64())
+
+        # apply everything before the first snapshot
+        self._pos = int(np.searchsorted(self._times, t0, side="right"))
+        np.add.at(self._counts, self._codes[:self._pos], self._changes[:self._pos])
+        self._first = True
+
+    def _records(self, codes, timestamp):
+        last_reported = int(pd.Timestamp(timestamp).timestamp())
+        return [
+            {
+                "station_id": self._station_ids[code],
+                "num_bikes_available": int(self._counts[code]),
+                "num_ebikes_available": 0,
+                "num_docks_available": 0,
+                "total_bikes_available": int(self._counts[code]),
+                "last_reported": last_reported,
+            }
+            for code in codes
+        ]
+
+    def next(self):
+        if self._first:
+            self._first = False
+            return pd.Timestamp(self._tick_time).to_pydatetime(), self._records(range(len(self._station_ids)), self._tick_time)
+
+        while self._pos < len(self._times):
+            self._tick_time = self._tick_time + self._step
+            if self._tick_time > self._end:
+                return None
+            end = int(np.searchsorted(self._times, self._tick_time, side="right"))
+            if end == self._pos:
+                continue
+            codes = self._codes[self._pos:end]
+            np.add.at(self._counts, codes, self._changes[self._pos:end])
+            self._pos = end
+            return pd.Timestamp(self._tick_time).to_pydatetime(), self._records(np.unique(codes), self._tick_time)
+        return None
+
+
+StationStatusReplay = py_pull_adapter_def(
+    "StationStatusReplay", StationStatusReplayImpl, ts[[dict]], filename=str, interval=timedelta
+)
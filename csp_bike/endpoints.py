@@ -1,3 +1,30 @@
 CITIBIKE_STATION_INFORMATION = "https://gbfs.lyft.com/gbfs/2.3/bkn/en/station_information.json"
 CITIBIKE_STATION_STATUS = "https://gbfs.lyft.com/gbfs/2.3/bkn/en/station_status.json"
 CITIBIKE_VEHICLE_TYPE = "https://gbfs.lyft.com/gbfs/2.3/bkn/en/vehicle_types.json"
+
+# Other GBFS systems, by system id. Each maps to a url template with a {feed}
+# placeholder (station_information, station_status, vehicle_types, ...).
+LYFT_GBFS = "https://gbfs.lyft.com/gbfs/2.3/{system}/en/{feed}.json"
+
+DEFAULT_SYSTEM = "bkn"
+SYSTEMS = {
+    # Citi Bike, New York
+    "bkn": LYFT_GBFS.format(system="bkn", feed="{feed}"),
+    # Bay Wheels, San Francisco Bay Area
+    "bay": LYFT_GBFS.format(system="bay", feed="{feed}"),
+    # Divvy, Chicago
+    "chi": LYFT_GBFS.format(system="chi", feed="{feed}"),
+    # Capital Bikeshare, Washington DC
+    "dca": LYFT_GBFS.format(system="dca", feed="{feed}"),
+    # Bluebikes, Boston
+    "bos": LYFT_GBFS.format(system="bos", feed="{feed}"),
+}
+
+
+def register_system(system, url_template):
+    # url_template like "https://example.com/gbfs/en/{feed}.json"
+    SYSTEMS[system] = url_template
+
+
+def feed_url(system, feed):
+    return SYSTEMS[system].format(feed=feed)
@@ -0,0 +1,152 @@
+import hashlib
+import threading
+import time
+from datetime import timedelta
+
+import httpx
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    import json
+
+    loads = json.loads
+
+__all__ = (
+    "GBFSClient",
+    "get_gbfs_client",
+)
+
+# never poll faster than this, whatever the feed's ttl says
+MIN_FETCH_INTERVAL = timedelta(seconds=1)
+
+
+class _FeedState:
+    def __init__(self):
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self.last_updated = None
+        self.ttl = None
+        self.fetched_at = None
+        self.content = None
+        self.data = None
+        # parse function -> its result for the current body
+        self.parsed = {}
+        self.lock = threading.Lock()
+
+
+# Keep-alive client for GBFS feeds. Uses conditional requests (ETag /
+# If-Modified-Since), skips JSON parsing when the body is unchanged, and
+# exposes each feed's ttl so callers can schedule the next poll.
+class GBFSClient:
+    def __init__(self, http2=True, timeout=10.0, transport=None):
+        kwargs = dict(timeout=timeout, headers={"Accept-Encoding": "gzip, deflate"}, transport=transport)
+        try:
+            self.client = httpx.Client(http2=http2, **kwargs)
+        except ImportError:
+            # http2 needs the optional h2 package
+            self.client = httpx.Client(**kwargs)
+        self.feeds = {}
+        self.lock = threading.Lock()
+
+        self.num_requests = 0
+        self.num_not_modified = 0
+        self.num_unchanged = 0
+
+    def _feed(self, url):
+        with self.lock:
+            feed = self.feeds.get(url)
+            if feed is None:
+                feed = self.feeds[url] = _FeedState()
+        return feed
+
+    def fetch(self, url, parse=None):
+        # returns (result, changed); result is the decoded document, or
+        # parse(document) if given, and is
+        # reused as-is while the feed is unchanged. Results are cached per
+        # parse function, so pass the same function object on every call.
+        feed = self._feed(url)
+        with feed.lock:
+            headers = {}
+            if feed.etag:
+                headers["If-None-Match"] = feed.etag
+            if feed.last_modified:
+                headers["If-Modified-Since"] = feed.last_modified
+
+            response = self.client.get(url, headers=headers)
+            self.num_requests += 1
+            feed.fetched_at = time.time()
+
+            if response.status_code == 304 and feed.content is not None:
+                self.num_not_modified += 1
+                return self._result(feed, parse)
+            response.raise_for_status()
+
+            feed.etag = response.headers.get("ETag")
+            feed.last_modified = response.headers.get("Last-Modified")
+
+            # some CDNs ignore conditional headers, so compare the body too
+            digest = hashlib.blake2b(response.content, digest_size=16).digest()
+            if digest == feed.digest:
+                self.num_unchanged += 1
+                return self._result(feed, parse)
+
+            feed.digest = digest
+            feed.content = response.content
+            feed.data = None
+            feed.parsed = {}
+            return self._result(feed, parse)
+
+    def _result(self, feed, parse):
+        # (result, changed): changed is False when this parse already saw the current body
+        if parse in feed.parsed:
+            return feed.parsed[parse], False
+        if feed.data is None:
+            feed.data = loads(feed.content)
+        result = parse(feed.data) if parse is not None else feed.data
+        last_updated, ttl = feed.data.get("last_updated"), feed.data.get("ttl")
+        if last_updated is not None:
+            feed.last_updated = last_updated
+        if ttl is not None:
+            feed.ttl = ttl
+        feed.parsed[parse] = result
+        return result, True
+
+    def next_fetch_delay(self, url, default):
+        # how long to wait before polling url again, based on its ttl
+        feed = self.feeds.get(url)
+        if feed is None or feed.ttl is None or feed.fetched_at is None:
+            return default
+        # data is fresh until last_updated + ttl; if the publisher is late
+        # fall back to polling every ttl seconds from now
+        expires = (feed.last_updated or feed.fetched_at) + feed.ttl
+        delay = expires - time.time()
+        if delay <= 0:
+            delay = feed.ttl
+        return max(MIN_FETCH_INTERVAL, min(timedelta(seconds=delay), default))
+
+    def stats(self):
+        return {
+            "requests": self.num_requests,
+            "not_modified": self.num_not_modified,
+            "unchanged": self.num_unchanged,
+        }
+
+    def close(self):
+        self.client.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_gbfs_client():
+    # process-wide shared client
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GBFSClient()
+    return _client
@@ -0,0 +1,246 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import pandas as pd
+
+from .endpoints import CITIBIKE_STATION_INFORMATION, CITIBIKE_VEHICLE_TYPE, DEFAULT_SYSTEM, feed_url
+from .gbfs import get_gbfs_client
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "FeedCache",
+    "StationMetadata",
+    "get_station_metadata",
+    "get_station_metadata_cache",
+    "get_vehicle_cache",
+    "start_metadata_refresh",
+)
+
+# Static GBFS metadata (station_information, vehicle_types) cached with a TTL.
+# A refresh builds a new immutable value and swaps it in with one reference
+# assignment, so readers never see a half-built snapshot. Every refresh is
+# also written to a JSON snapshot on disk; other processes (the dashboard)
+# pick that up by mtime instead of fetching the feed themselves.
+
+SNAPSHOT_DIR = "./data/cache"
+DEFAULT_TTL = timedelta(hours=1)
+
+
+class StationMetadata:
+    # immutable snapshot of station_information with interned station indices;
+    # a station keeps its index across refreshes, new stations are appended
+    def __init__(self, stations, station_ids, last_updated=None):
+        self.stations = stations
+        self.station_ids = station_ids
+        self.index = {station_id: i for i, station_id in enumerate(station_ids)}
+        self.last_updated = last_updated
+        self._df = None
+
+    @classmethod
+    def from_feed(cls, data, previous=None):
+        stations = {station["station_id"]: station for station in data["data"]["stations"]}
+        # Let's remove the rental uris
+        for station in stations.values():
+            station.pop("rental_uris", None)
+
+        station_ids = list(previous.station_ids) if previous is not None else []
+        known = set(station_ids)
+        station_ids.extend(station_id for station_id in stations if station_id not in known)
+        return cls(stations, station_ids, data.get("last_updated"))
+
+    def df(self):
+        if self._df is None:
+            df = pd.json_normalize(list(self.stations.values()))
+            df["station_index"] = df["station_id"].map(self.index)
+            self._df = df
+        return self._df
+
+    def __len__(self):
+        return len(self.station_ids)
+
+
+class FeedCache:
+    def __init__(self, url, build, snapshot_file, ttl=DEFAULT_TTL):
+        self.url = url
+        self.build = build
+        self.snapshot_file = snapshot_file
+        self.ttl = ttl
+
+        self._value = None
+        self._loaded_at = 0.0
+        self._snapshot_mtime = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._pinned = False
+
+        self.num_hits = 0
+        self.num_snapshot_loads = 0
+        self.num_refreshes = 0
+        self.num_refresh_errors = 0
+
+    def get(self):
+        value = self._value
+        if value is not None and (self._thread is not None or self._pinned or not self._expired()):
+            self.num_hits += 1
+            return value
+        with self._lock:
+            if self._value is None or (self._thread is None and self._expired()):
+                # another process may have refreshed the snapshot already
+                if not self._load_snapshot() or self._expired():
+                    self._refresh_locked()
+            return self._value
+
+    def _expired(self):
+        if self._thread is None and self._snapshot_changed():
+            return True
+        return time.time() - self._loaded_at > self.ttl.total_seconds()
+
+    def _snapshot_changed(self):
+        try:
+            return os.stat(self.snapshot_file).st_mtime_ns > self._snapshot_mtime
+        except FileNotFoundError:
+            return False
+
+    def _load_snapshot(self):
+        try:
+            mtime = os.stat(self.snapshot_file).st_mtime_ns
+            with open(self.snapshot_file, "r") as f:
+                snapshot = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        self._value = self.build(snapshot["data"], snapshot.get("state"), self._value)
+        self._loaded_at = snapshot["fetched_at"]
+        self._snapshot_mtime = mtime
+        self.num_snapshot_loads += 1
+        return True
+
+    def _write_snapshot(self, data, state):
+        os.makedirs(os.path.dirname(self.snapshot_file), exist_ok=True)
+        tmp_file = "%s.%d.tmp" % (self.snapshot_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump({"fetched_at": self._loaded_at, "data": data, "state": state}, f)
+        os.replace(tmp_file, self.snapshot_file)
+        self._snapshot_mtime = os.stat(self.snapshot_file).st_mtime_ns
+
+    def _refresh_locked(self):
+        data, _ = get_gbfs_client().fetch(self.url)
+        value = self.build(data, None, self._value)
+        # atomic swap: readers see either the old or the new value
+        self._value = value
+        self._loaded_at = time.time()
+        self.num_refreshes += 1
+        try:
+            self._write_snapshot(data, getattr(value, "station_ids", None))
+        except OSError:
+            pass
+        return value
+
+    def refresh(self):
+        with self._lock:
+            return self._refresh_locked()
+
+    def pin(self, value):
+        # serve a fixed value and never refresh, for offline runs and benchmarks
+        self._value = value
+        self._pinned = True
+
+    def stats(self):
+        return {
+            "hits": self.num_hits,
+            "snapshot_loads": self.num_snapshot_loads,
+            "refreshes": self.num_refreshes,
+            "refresh_errors": self.num_refresh_errors,
+        }
+
+    def start(self):
+        # refresh in the background every ttl; get() then never blocks
+        if self._thread is not None:
+            return
+        self.get()
+
+        def run():
+            while not self._stop.wait(self.ttl.total_seconds()):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    # keep serving the previous value, retried after another ttl
+                    self.num_refresh_errors += 1
+                    log.warning("metadata refresh failed for %s: %s", self.url, e)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name="gbfs-metadata", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+
+def _build_station_metadata(data, station_ids, previous):
+    # station_ids from a snapshot are the interned order every process shares
+    if station_ids is not None:
+        previous = StationMetadata({}, station_ids)
+    return StationMetadata.from_feed(data, previous)
+
+
+def _build_vehicles(data, state, previous):
+    return {vehicle["vehicle_type_id"]: vehicle for vehicle in data["data"]["vehicle_types"]}
+
+
+_station_cache = FeedCache(
+    CITIBIKE_STATION_INFORMATION,
+    _build_station_metadata,
+    os.path.join(SNAPSHOT_DIR, "station_information.json"),
+)
+_vehicle_cache = FeedCache(
+    CITIBIKE_VEHICLE_TYPE,
+    _build_vehicles,
+    os.path.join(SNAPSHOT_DIR, "vehicle_types.json"),
+)
+
+# caches for other systems, created on first use
+_system_caches = {DEFAULT_SYSTEM: (_station_cache, _vehicle_cache)}
+_system_caches_lock = threading.Lock()
+
+
+def _system_cache(system):
+    system = system or DEFAULT_SYSTEM
+    caches = _system_caches.get(system)
+    if caches is None:
+        with _system_caches_lock:
+            caches = _system_caches.get(system)
+            if caches is None:
+                caches = _system_caches[system] = (
+                    FeedCache(feed_url(system, "station_information"), _build_station_metadata,
+                              os.path.join(SNAPSHOT_DIR, "station_information-%s.json" % system)),
+                    FeedCache(feed_url(system, "vehicle_types"), _build_vehicles,
+                              os.path.join(SNAPSHOT_DIR, "vehicle_types-%s.json" % system)),
+                )
+    return caches
+
+
+def get_station_metadata_cache(system=None):
+    return _system_cache(system)[0]
+
+
+def get_vehicle_cache(system=None):
+    return _system_cache(system)[1]
+
+
+def get_station_metadata(system=None):
+    return _system_cache(system)[0].get()
+
+
+def start_metadata_refresh(systems=None):
+    # run in the process that owns the refresh (the poller); the first fetch
+    # of every system's feeds happens concurrently
+    caches = [cache for system in systems or [DEFAULT_SYSTEM] for cache in _system_cache(system)]
+    with ThreadPoolExecutor(max_workers=min(len(caches), 16)) as executor:
+        list(executor.map(FeedCache.start, caches))
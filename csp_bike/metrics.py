@@ -0,0 +1,249 @@
+import cProfile
+import json
+import os
+import threading
+import time
+
+__all__ = (
+    "METRICS_DIR",
+    "MetricsRegistry",
+    "load_dump",
+    "metrics",
+    "profiling",
+)
+
+# Process-wide timing/counter registry for the hot paths (csp nodes, page
+# render, caches). Recording a sample is a perf_counter call and a few
+# attribute updates; set CSP_BIKE_METRICS=0 to turn recording off entirely.
+#
+# CSP_BIKE_PROFILE=cprofile (or =sample, with pyinstrument installed) makes
+# profiling() blocks write a profile to METRICS_DIR.
+
+METRICS_DIR = "./data/metrics"
+ENABLED = os.environ.get("CSP_BIKE_METRICS", "1") != "0"
+PROFILE = os.environ.get("CSP_BIKE_PROFILE", "")
+
+# recent samples kept per timer for percentiles
+RESERVOIR_SIZE = 1024
+
+
+class Timer:
+    __slots__ = ("count", "total", "max", "samples", "_next")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+        self._next = 0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if len(self.samples) < RESERVOIR_SIZE:
+            self.samples.append(seconds)
+        else:
+            self.samples[self._next] = seconds
+            self._next = (self._next + 1) % RESERVOIR_SIZE
+
+    def summary(self):
+        samples = sorted(self.samples)
+
+        def percentile(q):
+            return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1e3 if self.count else 0.0,
+            "p50_ms": percentile(0.50) * 1e3,
+            "p99_ms": percentile(0.99) * 1e3,
+            "max_ms": self.max * 1e3,
+            "total_s": self.total,
+        }
+
+
+class _Timing:
+    __slots__ = ("timer", "start")
+
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(time.perf_counter() - self.start)
+        return False
+
+
+class _NoTiming:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMING = _NoTiming()
+
+
+class MetricsRegistry:
+    def __init__(self, enabled=ENABLED):
+        self.enabled = enabled
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+        # name -> callable returning a dict, read at snapshot time (cache stats)
+        self.sources = {}
+        self.lock = threading.Lock()
+        # path -> time of its last maybe_dump
+        self._last_dump = {}
+
+    def _timer(self, name):
+        timer = self.timers.get(name)
+        if timer is None:
+            with self.lock:
+                timer = self.timers.setdefault(name, Timer())
+        return timer
+
+    def timer(self, name):
+        # with metrics.timer("stage"): ...
+        if not self.enabled:
+            return _NO_TIMING
+        return _Timing(self._timer(name))
+
+    def timed(self, name):
+        # decorator form of timer()
+        def decorator(fn):
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return fn(*args, **kwargs)
+            wrapper.__name__ = fn.__name__
+            wrapper.__wrapped__ = fn
+            return wrapper
+        return decorator
+
+    def record(self, name, seconds):
+        if self.enabled:
+            self._timer(name).record(seconds)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def register_source(self, name, fn):
+        self.sources[name] = fn
+
+    def register_cache(self, name, cached_fn):
+        # hit/miss counts of an lru_cache-wrapped function
+        def info():
+            stats = cached_fn.cache_info()
+            lookups = stats.hits + stats.misses
+            return {
+                "hits": stats.hits,
+                "misses": stats.misses,
+                "size": stats.currsize,
+                "hit_rate": stats.hits / lookups if lookups else 0.0,
+            }
+        self.register_source(name, info)
+
+    def snapshot(self):
+        sources = {}
+        for name, fn in list(self.sources.items()):
+            try:
+                sources[name] = fn()
+            except Exception as e:
+                sources[name] = {"error": str(e)}
+        return {
+            "pid": os.getpid(),
+            "time": time.time(),
+            "timers": {name: timer.summary() for name, timer in list(self.timers.items())},
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "sources": sources,
+        }
+
+    def dump_json(self, path):
+        # atomic write, so another process can read it at any time
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f, indent=1, default=str)
+        os.replace(tmp_path, path)
+
+    def maybe_dump(self, path, min_interval=10.0):
+        # for hot loops: dump at most every min_interval seconds
+        now = time.monotonic()
+        if now - self._last_dump.get(path, float("-inf")) >= min_interval:
+            self._last_dump[path] = now
+            self.dump_json(path)
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+
+metrics = MetricsRegistry()
+
+
+def load_dump(path):
+    # a snapshot dumped by another process, or None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class profiling:
+    # profile a block when CSP_BIKE_PROFILE is set, a no-op otherwise:
+    #   with profiling("name"): ...
+    # or start()/stop() around code that can't be indented, like a page script
+    def __init__(self, name, mode=PROFILE):
+        self.name = name
+        self.mode = mode
+        self.profiler = None
+
+    def start(self):
+        if self.mode == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.mode == "sample":
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                return self
+            self.profiler = Profiler()
+            self.profiler.start()
+        return self
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        if self.mode == "cprofile":
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(METRICS_DIR, self.name + ".prof"))
+        else:
+            self.profiler.stop()
+            with open(os.path.join(METRICS_DIR, self.name + ".html"), "w") as f:
+                f.write(self.profiler.output_html())
+        self.profiler = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
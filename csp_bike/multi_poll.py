@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import csp
+from csp import ts
+from csp.impl.adaptermanager import AdapterManagerImpl
+from csp.impl.pushadapter import PushInputAdapter
+from csp.impl.wiring import py_push_adapter_def
+
+from .endpoints import feed_url
+from .gbfs import get_gbfs_client
+from .metadata import get_station_metadata
+from .metrics import metrics
+from .stations import fetch_station_status
+
+__all__ = (
+    "GBFSPollerManager",
+)
+
+log = logging.getLogger(__name__)
+
+# Polls station_status for several GBFS systems from one process.
+#
+# A scheduler thread hands due fetches to a thread pool; every system has its
+# own schedule (from its feed's ttl) and at most one fetch in flight, so a slow
+# or failing operator is skipped and backed off without delaying the others.
+# Each system ticks its own push adapter in LAST_VALUE mode, so if the graph
+# falls behind only the newest snapshot per system is kept.
+#
+#   stations = GBFSPollerManager(["bkn", "bay"]).subscribe_all()   # {system: ts[[dict]]}
+
+DEFAULT_INTERVAL = timedelta(seconds=28)
+MAX_BACKOFF = timedelta(minutes=5)
+
+
+class GBFSPollerManager:
+    def __init__(self, systems, interval=DEFAULT_INTERVAL, max_workers=8):
+        self._systems = list(systems)
+        self._interval = interval
+        self._max_workers = max_workers
+
+    def subscribe(self, system, push_mode=csp.PushMode.LAST_VALUE):
+        if system not in self._systems:
+            self._systems.append(system)
+        return _station_status_adapter(self, system, push_mode=push_mode)
+
+    def subscribe_all(self, push_mode=csp.PushMode.LAST_VALUE):
+        # keyed basket of station_status snapshots, one edge per system
+        return {system: self.subscribe(system, push_mode) for system in self._systems}
+
+    def _create(self, engine, memo):
+        return GBFSPollerManagerImpl(engine, self)
+
+
+class _SystemState:
+    def __init__(self, system):
+        self.system = system
+        self.adapter = None
+        self.due = 0.0
+        self.in_flight = False
+        self.failures = 0
+
+
+class GBFSPollerManagerImpl(AdapterManagerImpl):
+    def __init__(self, engine, rep):
+        super().__init__(engine)
+        self._rep = rep
+        self._states = {system: _SystemState(system) for system in rep._systems}
+        self._executor = None
+        self._thread = None
+        self._wakeup = threading.Condition()
+        self._active = False
+
+    def register(self, system, adapter):
+        self._states.setdefault(system, _SystemState(system)).adapter = adapter
+
+    def process_next_sim_timeslice(self, now):
+        return None
+
+    def start(self, starttime, endtime):
+        self._executor = ThreadPoolExecutor(max_workers=min(self._rep._max_workers, len(self._states)),
+                                            thread_name_prefix="gbfs-poll")
+        # station_information for every system, concurrently, before the first status parse needs it
+        list(self._executor.map(get_station_metadata, self._states))
+        self._active = True
+        self._thread = threading.Thread(target=self._run, name="gbfs-poll-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._wakeup:
+            self._active = False
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self):
+        with self._wakeup:
+            while self._active:
+                now = time.time()
+                next_due = now + self._rep._interval.total_seconds()
+                for state in self._states.values():
+                    if state.adapter is None:
+                        continue
+                    if state.in_flight:
+                        # the previous fetch is still running; don't queue another behind it
+                        if now >= state.due:
+                            metrics.count("multi_poll.%s.skipped" % state.system)
+                            state.due = now + self._rep._interval.total_seconds()
+                        continue
+                    if now >= state.due:
+                        state.in_flight = True
+                        self._executor.submit(self._fetch, state)
+                    else:
+                        next_due = min(next_due, state.due)
+                self._wakeup.wait(max(0.0, next_due - time.time()))
+
+    def _fetch(self, state):
+        interval = self._rep._interval
+        try:
+            start = time.perf_counter()
+            records, changed = fetch_station_status(state.system)
+            metrics.record("multi_poll.%s.fetch" % state.system, time.perf_counter() - start)
+            state.failures = 0
+            delay = get_gbfs_client().next_fetch_delay(feed_url(state.system, "station_status"), interval)
+            if self._active:
+                state.adapter.push_tick(records)
+        except Exception as e:
+            # back off exponentially, up to MAX_BACKOFF
+            state.failures += 1
+            metrics.count("multi_poll.%s.errors" % state.system)
+            log.warning("station_status fetch failed for %s: %s", state.system, e)
+            delay = min(interval * 2 ** state.failures, MAX_BACKOFF)
+        with self._wakeup:
+            state.due = time.time() + delay.total_seconds()
+            state.in_flight = False
+            self._wakeup.notify()
+
+
+class StationStatusPushAdapter(PushInputAdapter):
+    def __init__(self, manager_impl, system):
+        manager_impl.register(system, self)
+
+
+_station_status_adapter = py_push_adapter_def(
+    "StationStatusPushAdapter", StationStatusPushAdapter, ts[[dict]], GBFSPollerManager, system=str
+)
@@ -0,0 +1,192 @@
+import queue as queue_module
+import threading
+import time
+from datetime import timedelta
+
+import csp
+from csp import ts
+from csp.impl.adaptermanager import AdapterManagerImpl
+from csp.impl.pushadapter import PushInputAdapter
+from csp.impl.wiring import py_push_adapter_def
+
+from .metrics import metrics
+
+__all__ = (
+    "SnapshotQueueManager",
+    "enqueue_snapshots",
+    "heartbeat",
+    "put_latest",
+    "queue_depth",
+)
+
+# Pieces for running the poller as separate processes joined by queues.
+#
+# The fetcher process puts (system, fetched_at, records) snapshots on a bounded
+# multiprocessing queue with put_latest, which drops the oldest snapshot when
+# the consumer has fallen behind. The consuming process reads them through a
+# SnapshotQueueManager, which also coalesces whatever is waiting to the newest
+# snapshot per system. Only the newest snapshot matters, because deltas are
+# taken against the previous snapshot that was processed.
+#
+#   enqueue_snapshots(stations, "bkn", queue)                        # fetcher
+#   stations = SnapshotQueueManager(queue).subscribe_all(["bkn"])    # estimator
+#
+# heartbeat() stamps a shared value from inside the csp realtime loop, so a
+# supervisor can tell a stalled loop from one that's just waiting for data.
+
+# seconds between polls of an empty queue. Readers poll with get_nowait rather
+# than blocking in get: a blocked multiprocessing reader holds the queue's lock,
+# and a reader killed while holding it leaves the queue unreadable for good.
+GET_INTERVAL = 0.2
+
+
+def put_latest(queue, item):
+    # put without blocking, making room by dropping the oldest item; returns how
+    # many snapshots were dropped, counting `item` itself if there still is no room
+    try:
+        queue.put_nowait(item)
+        return 0
+    except queue_module.Full:
+        pass
+    dropped = 0
+    try:
+        queue.get_nowait()
+        dropped += 1
+    except queue_module.Empty:
+        # the reader holds the queue's lock
+        pass
+    try:
+        queue.put_nowait(item)
+    except queue_module.Full:
+        dropped += 1
+    return dropped
+
+
+def get_all(queue):
+    # everything waiting on the queue, without blocking
+    items = []
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except queue_module.Empty:
+            return items
+
+
+def queue_depth(queue):
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        # multiprocessing queues on macOS
+        return None
+
+
+@csp.node
+def enqueue_snapshots(stations: ts[[dict]], system: str, queue: object):
+    with csp.state():
+        s_previous = None
+
+    if csp.ticked(stations):
+        # an unchanged feed comes back as the same list, nothing new to send
+        if stations is not s_previous:
+            s_previous = stations
+            dropped = put_latest(queue, (system, time.time(), stations))
+            metrics.count("pipeline.%s.enqueued" % system)
+            if dropped:
+                metrics.count("pipeline.%s.dropped" % system, dropped)
+
+
+@csp.node
+def heartbeat(interval: timedelta, beat: object, metrics_file: str = ""):
+    with csp.alarms():
+        a_beat = csp.alarm(bool)
+
+    with csp.start():
+        csp.schedule_alarm(a_beat, timedelta(), True)
+
+    if csp.ticked(a_beat):
+        # beat: a multiprocessing.Value('d') holding the time of the last beat
+        beat.value = time.time()
+        if metrics_file:
+            metrics.maybe_dump(metrics_file)
+        csp.schedule_alarm(a_beat, interval, True)
+
+
+class SnapshotQueueManager:
+    def __init__(self, queue):
+        self._queue = queue
+        self._systems = []
+
+    def subscribe(self, system, push_mode=csp.PushMode.LAST_VALUE):
+        if system not in self._systems:
+            self._systems.append(system)
+        return _snapshot_adapter(self, system, push_mode=push_mode)
+
+    def subscribe_all(self, systems, push_mode=csp.PushMode.LAST_VALUE):
+        # keyed basket of station_status snapshots, one edge per system
+        return {system: self.subscribe(system, push_mode) for system in systems}
+
+    def _create(self, engine, memo):
+        return SnapshotQueueManagerImpl(engine, self)
+
+
+class SnapshotQueueManagerImpl(AdapterManagerImpl):
+    def __init__(self, engine, rep):
+        super().__init__(engine)
+        self._rep = rep
+        self._adapters = {}
+        self._thread = None
+        self._active = False
+
+    def register(self, system, adapter):
+        self._adapters[system] = adapter
+
+    def process_next_sim_timeslice(self, now):
+        return None
+
+    def start(self, starttime, endtime):
+        self._active = True
+        self._thread = threading.Thread(target=self._run, name="snapshot-queue", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._active = False
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        queue = self._rep._queue
+        while self._active:
+            batch = get_all(queue)
+            if not batch:
+                time.sleep(GET_INTERVAL)
+                continue
+
+            # newest snapshot per system, in arrival order
+            latest = {}
+            for system, fetched_at, records in batch:
+                latest[system] = (fetched_at, records)
+            if len(batch) > len(latest):
+                metrics.count("pipeline.coalesced", len(batch) - len(latest))
+
+            now = time.time()
+            for system, (fetched_at, records) in latest.items():
+                adapter = self._adapters.get(system)
+                if adapter is None:
+                    metrics.count("pipeline.%s.unrouted" % system)
+                    continue
+                # time from the fetch to the graph picking the snapshot up
+                metrics.record("pipeline.%s.lag" % system, now - fetched_at)
+                adapter.push_tick(records)
+            depth = queue_depth(queue)
+            if depth is not None:
+                metrics.gauge("pipeline.queue_depth", depth)
+
+
+class SnapshotQueuePushAdapter(PushInputAdapter):
+    def __init__(self, manager_impl, system):
+        manager_impl.register(system, self)
+
+
+_snapshot_adapter = py_push_adapter_def(
+    "SnapshotQueuePushAdapter", SnapshotQueuePushAdapter, ts[[dict]], SnapshotQueueManager, system=str
+)
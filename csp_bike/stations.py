@@ -1,50 +1,47 @@
-from functools import lru_cache
+from functools import lru_cache, partial
 
-import httpx
 import pandas as pd
 
 from .endpoints import (
-    CITIBIKE_STATION_INFORMATION,
-    CITIBIKE_STATION_STATUS,
-    CITIBIKE_VEHICLE_TYPE,
+    DEFAULT_SYSTEM,
+    feed_url,
 )
+from .gbfs import get_gbfs_client
+from .metadata import get_station_metadata, get_station_metadata_cache, get_vehicle_cache
+from .metrics import metrics
+from .status_columns import station_status_columns
 
 __all__ = (
+    "fetch_station_status",
+    "fetch_station_status_columns",
     "get_stations",
     "get_stations_df",
     "get_station_status",
+    "get_station_status_columns",
     "get_station_status_df",
+    "get_station_status_delay",
     "get_vehicles",
 )
 
 
-@lru_cache
-def get_stations():
-    dat = httpx.get(CITIBIKE_STATION_INFORMATION).json()
-    to_return = {station["station_id"]: station for station in dat["data"]["stations"]}
-    # Let's remove the rental uris
-    for station in to_return.values():
-        station.pop("rental_uris", None)
-    return to_return
+def get_stations(system=None):
+    # TTL-refreshed, shared across processes through the on-disk snapshot
+    return get_station_metadata(system).stations
 
 
-@lru_cache
-def get_stations_df():
-    return pd.json_normalize(get_stations().values())
+def get_stations_df(system=None):
+    return get_station_metadata(system).df()
 
 
-@lru_cache
-def get_vehicles():
-    dat = httpx.get(CITIBIKE_VEHICLE_TYPE).json()
-    return {
-        vehicle["vehicle_type_id"]: vehicle for vehicle in dat["data"]["vehicle_types"]
-    }
+def get_vehicles(system=None):
+    return get_vehicle_cache(system).get()
 
 
-def get_station_status():
-    records = httpx.get(CITIBIKE_STATION_STATUS).json()["data"]["stations"]
-    stations = get_stations()
+def _station_status_records(dat, system=None):
+    index = get_station_metadata(system).index
 
+    # the client shares the decoded document between parsers, so adjust copies
+    records = [dict(record) for record in dat["data"]["stations"]]
     # adjust so that "bikes" means non-ebikes
     for record in records:
         record["total_bikes_available"] = record["num_bikes_available"]
@@ -52,9 +49,60 @@ def get_station_status():
             "num_ebikes_available", 0
         )
         record.pop("vehicle_types_available", None)
-        record.update(stations[record["station_id"]])
+        # refer to the static metadata by its interned index instead of copying it in
+        record["station_index"] = index.get(record["station_id"], -1)
     return records
 
 
-def get_station_status_df():
-    return pd.json_normalize(get_station_status())
\ No newline at end of file
+def _station_status_columns(dat, system=None):
+    return station_status_columns(dat, get_station_metadata(system).index)
+
+
+@lru_cache(maxsize=None)
+def _parser(parse, system):
+    # one long-lived parse function per system, the GBFS client caches results by it
+    return partial(parse, system=system)
+
+
+def fetch_station_status(system=None):
+    # (records, changed); unchanged feeds return the previously parsed records without re-parsing
+    system = system or DEFAULT_SYSTEM
+    with metrics.timer("stations.get_station_status"):
+        records, changed = get_gbfs_client().fetch(feed_url(system, "station_status"),
+                                                   parse=_parser(_station_status_records, system))
+    metrics.count("stations.station_status.changed" if changed else "stations.station_status.unchanged")
+    return records, changed
+
+
+def get_station_status(system=None):
+    return fetch_station_status(system)[0]
+
+
+def fetch_station_status_columns(system=None):
+    # (StationStatusColumns, changed); the typed-array counterpart of fetch_station_status
+    system = system or DEFAULT_SYSTEM
+    with metrics.timer("stations.get_station_status_columns"):
+        columns, changed = get_gbfs_client().fetch(feed_url(system, "station_status"),
+                                                   parse=_parser(_station_status_columns, system))
+    return columns, changed
+
+
+def get_station_status_columns(system=None):
+    return fetch_station_status_columns(system)[0]
+
+
+def get_station_status_delay(default, system=None):
+    # time until station_status is due to change, from the feed's ttl
+    return get_gbfs_client().next_fetch_delay(feed_url(system or DEFAULT_SYSTEM, "station_status"), default)
+
+
+def get_station_status_df(system=None):
+    df = pd.json_normalize(get_station_status(system))
+    metadata = get_station_metadata(system).df().drop(columns=["station_id"]).set_index("station_index")
+    return df.join(metadata, on="station_index")
+
+
+# the caches behind this module, reported with every metrics snapshot
+metrics.register_source("stations.station_information_cache", lambda: get_station_metadata_cache().stats())
+metrics.register_source("stations.vehicle_types_cache", lambda: get_vehicle_cache().stats())
+metrics.register_source("stations.gbfs_client", lambda: get_gbfs_client().stats())
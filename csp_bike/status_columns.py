@@ -0,0 +1,111 @@
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+
+__all__ = (
+    "StationStatusColumns",
+    "station_status_columns",
+)
+
+# station_status as typed numpy columns instead of one record dict per station.
+#
+# The columns are filled straight from the decoded document with np.fromiter,
+# so no per-station records are built, copied or adjusted, and station_id is
+# mapped to the interned station_index with one vectorized searchsorted over
+# the metadata ids. A numpy scan of the raw bytes was tried and was 2-3x slower
+# than orjson's decode, so the document is still decoded once.
+#
+# Columns follow the dict API: num_bikes_available excludes e-bikes and
+# total_bikes_available is the feed's num_bikes_available.
+
+COUNT_DTYPE = np.int32
+
+
+class StationStatusColumns:
+    __slots__ = (
+        "station_id",
+        "station_index",
+        "num_bikes_available",
+        "num_ebikes_available",
+        "num_docks_available",
+        "total_bikes_available",
+        "last_reported",
+        "last_updated",
+        "ttl",
+    )
+
+    def __init__(self, station_id, station_index, num_bikes_available, num_ebikes_available, num_docks_available,
+                 total_bikes_available, last_reported, last_updated=None, ttl=None):
+        self.station_id = station_id
+        self.station_index = station_index
+        self.num_bikes_available = num_bikes_available
+        self.num_ebikes_available = num_ebikes_available
+        self.num_docks_available = num_docks_available
+        self.total_bikes_available = total_bikes_available
+        self.last_reported = last_reported
+        self.last_updated = last_updated
+        self.ttl = ttl
+
+    def __len__(self):
+        return len(self.station_id)
+
+    def df(self):
+        return pd.DataFrame({
+            "station_id": self.station_id,
+            "station_index": self.station_index,
+            "num_bikes_available": self.num_bikes_available,
+            "num_ebikes_available": self.num_ebikes_available,
+            "num_docks_available": self.num_docks_available,
+            "total_bikes_available": self.total_bikes_available,
+            "last_reported": self.last_reported,
+        })
+
+    def records(self):
+        # the dict API's records, for callers that still want them
+        return self.df().to_dict("records")
+
+
+def _column(stations, field, dtype):
+    try:
+        return np.fromiter(map(itemgetter(field), stations), dtype=dtype, count=len(stations))
+    except KeyError:
+        # optional fields (num_ebikes_available on systems without e-bikes) default to 0
+        return np.fromiter((station.get(field, 0) for station in stations), dtype=dtype, count=len(stations))
+
+
+_lookup = (None, None, None)
+
+
+def _station_index(station_id, index):
+    # one searchsorted over the metadata ids, sorted once per metadata index
+    global _lookup
+    if not index:
+        return np.full(len(station_id), -1, dtype=np.int32)
+    if _lookup[0] is not index:
+        ids = np.array(list(index), dtype=str)
+        values = np.fromiter(index.values(), dtype=np.int32, count=len(index))
+        order = np.argsort(ids)
+        _lookup = (index, ids[order], values[order])
+    _, ids, values = _lookup
+    k = np.minimum(np.searchsorted(ids, station_id), len(ids) - 1)
+    return np.where(ids[k] == station_id, values[k], -1).astype(np.int32)
+
+
+def station_status_columns(dat, index=None):
+    # dat: the decoded station_status document; index: station_id -> interned station_index
+    stations = dat["data"]["stations"]
+    station_id = np.array(list(map(itemgetter("station_id"), stations)), dtype=str)
+    total_bikes = _column(stations, "num_bikes_available", COUNT_DTYPE)
+    ebikes = _column(stations, "num_ebikes_available", COUNT_DTYPE)
+    return StationStatusColumns(
+        station_id=station_id,
+        station_index=_station_index(station_id, index),
+        num_bikes_available=total_bikes - ebikes,
+        num_ebikes_available=ebikes,
+        num_docks_available=_column(stations, "num_docks_available", COUNT_DTYPE),
+        total_bikes_available=total_bikes,
+        last_reported=_column(stations, "last_reported", np.int64),
+        last_updated=dat.get("last_updated"),
+        ttl=dat.get("ttl"),
+    )
@@ -0,0 +1,14 @@
+import csp
+
+__all__ = ("StationDelta",)
+
+
+class StationDelta(csp.Struct):
+    # a station whose bike count changed since the previous status snapshot
+    station_id: str
+    last_reported: int
+    num_bikes_available: int
+    num_ebikes_available: int
+    num_docks_available: int
+    total_bikes_available: int
+    prior_bikes_available: int
@@ -1,93 +1,110 @@
 import os
-import googlemaps
-from csp_bike import get_stations_df
-import pandas as pd
+import numpy as np
 import math
+import threading
 from functools import lru_cache
 import datetime
-
-maps_client = googlemaps.Client(key=os.environ['GOOGLE_MAPS_API_KEY'])
+from station_matrix import get_station_matrix
+from maps_batch import MODES, DistanceMatrixBatcher, GoogleMapsTransport
+from estimate_cache import cache_key, get_estimate_cache
+from csp_bike.metrics import metrics
+
+# built on first use, so importing this module needs neither googlemaps nor an API key
+maps_client = None
+# lookups from every caller are coalesced into batched, concurrent matrix requests
+maps_batcher = None
+_maps_lock = threading.Lock()
+
+def get_maps_client():
+    global maps_client
+    with _maps_lock:
+        if maps_client is None:
+            import googlemaps
+            maps_client = googlemaps.Client(key=os.environ['GOOGLE_MAPS_API_KEY'])
+    return maps_client
+
+def get_maps_batcher():
+    global maps_batcher
+    if maps_batcher is None:
+        transport = GoogleMapsTransport(get_maps_client())
+        with _maps_lock:
+            if maps_batcher is None:
+                maps_batcher = DistanceMatrixBatcher(transport)
+    return maps_batcher
+
+# in-process memo size for the haversine distance
+LRU_SIZE = 65536
+
+# Direct Maps lookups for a single trip, through the shared estimate cache and
+# the batcher (so concurrent callers share matrix requests). These block on the
+# network for uncached pairs; the hot path uses the station matrix below, which
+# the supervisor's fill stage fills through the same batcher and cache.
+def _fetch_elements(lookups):
+    return get_maps_batcher().lookup_many(lookups)
+
+def get_maps_element(ori_lat, ori_lng, dest_lat, dest_lng, mode):
+    # the disk cache first, shared with the other processes and kept across restarts
+    mode = MODES.get(mode, mode)
+    lookup = ((ori_lat, ori_lng), (dest_lat, dest_lng), mode)
+    return get_estimate_cache().prefetch([lookup], _fetch_elements)[cache_key(*lookup)]
+
+def prefetch_maps_elements(lookups):
+    # lookups: (origin, destination, mode); only pairs missing from the disk cache are requested
+    lookups = [(tuple(origin), tuple(destination), MODES.get(mode, mode)) for origin, destination, mode in lookups]
+    return get_estimate_cache().prefetch(lookups, _fetch_elements)
 
 # Get biking distance between two locations
-@lru_cache
 def get_distance_by_mode(ori_lat, ori_lng, dest_lat, dest_lng, mode):
-    if mode == 'b':
-        mode = 'bicycling'
-    elif mode == 'd':
-        mode = 'driving'
-
-    distance = maps_client.distance_matrix(
-        origins=(ori_lat, ori_lng),
-        destinations=(dest_lat, dest_lng),
-        mode='bicycling'
-    )
-    return distance['rows'][0]['elements'][0]['distance']['text']
-
-@lru_cache
+    element = get_maps_element(ori_lat, ori_lng, dest_lat, dest_lng, mode)
+    return element['distance']['text']
+
 def get_travel_time_by_mode(ori_lat, ori_lng, dest_lat, dest_lng, mode):
-    if mode == 'b':
-        mode = 'bicycling'
-    elif mode == 'd':
-        mode = 'driving'
-
-    distance = maps_client.distance_matrix(
-        origins=(ori_lat, ori_lng),
-        destinations=(dest_lat, dest_lng),
-        mode=mode,
-    )
-    return distance['rows'][0]['elements'][0]['duration']['text']
-
-@lru_cache
-def estimate_co2_saved(ori_lat, ori_lng, dest_lat, dest_lng):
-    bike_distance = get_distance_by_mode(ori_lat, ori_lng, dest_lat, dest_lng, 'b')
-    driving_distance = get_distance_by_mode(ori_lat, ori_lng, dest_lat, dest_lng, 'd')
+    element = get_maps_element(ori_lat, ori_lng, dest_lat, dest_lng, mode)
+    return element['duration']['text']
 
-    bike_data = bike_distance.split(' ')
-    driving_data = driving_distance.split(' ')
+# emissions estimated in kg per km
+BIKE_EMISSIONS_PER_KM = 0.021
+DRIVING_EMISSIONS_PER_KM = 0.192
 
-    # distances measured in km
-    bike_distance = float(bike_data[0])
-    # adjust for short rides
-    if bike_data[1] == 'm':
-        bike_distance /= 1000
-    
-    # emissions estimated in kg (0.021 kg/km)
-    bike_emissions = bike_distance * 0.021
+# not memoized: a pair's value changes from the fallback to the Maps result once
+# the fill stage reaches it, and the matrix lookup is already O(1)
+def estimate_co2_saved(ori_lat, ori_lng, dest_lat, dest_lng):
+    # O(1) lookup in the precomputed station matrix, haversine fallback if not filled yet
+    bike_distance, driving_distance, _, _ = get_station_matrix().estimate(ori_lat, ori_lng, dest_lat, dest_lng)
 
-    driving_distance = float(driving_data[0])
-    if driving_data[1] == 'm':
-        driving_distance /= 1000
-    
-    # emissions estimated in kg (0.192 kg/km)
-    driving_emissions = driving_distance * 0.192
+    bike_emissions = bike_distance * BIKE_EMISSIONS_PER_KM
+    driving_emissions = driving_distance * DRIVING_EMISSIONS_PER_KM
 
     return driving_emissions - bike_emissions
 
-@lru_cache
 def estimate_delta_time(ori_lat, ori_lng, dest_lat, dest_lng):
-    est_bike_time = get_travel_time_by_mode(ori_lat, ori_lng, dest_lat, dest_lng, 'b')
-    driving_time = get_travel_time_by_mode(ori_lat, ori_lng, dest_lat, dest_lng, 'd')
-
-    bike_data = est_bike_time.split(' ')
-    driving_data = driving_time.split(' ')
+    _, _, est_bike_time, driving_time = get_station_matrix().estimate(ori_lat, ori_lng, dest_lat, dest_lng)
 
     # time measured in minutes
-    if bike_data[1] == 'hour':
-        est_bike_time = int(bike_data[0]) * 60 + int(bike_data[2])
-    else:
-        est_bike_time = int(bike_data[0])
-
-    if driving_data[1] == 'hour':
-        driving_time = int(driving_data[0]) * 60 + int(driving_data[2])
-    else:
-        driving_time = int(driving_data[0])
-
-    return {'bike': est_bike_time, 'drive': driving_time}
+    return {'bike': int(round(est_bike_time)), 'drive': int(round(driving_time))}
+
+def estimate_trips_batch(df):
+    # (4, len(df)) array of bike km, drive km, bike min, drive min for every trip in df
+    return get_station_matrix().estimate_many(df['start_lat'].to_numpy(), df['start_lng'].to_numpy(),
+                                              df['end_lat'].to_numpy(), df['end_lng'].to_numpy())
+
+def estimate_co2_saved_batch(df, estimates=None):
+    # kg of CO2 saved per trip, as a numpy array
+    if estimates is None:
+        estimates = estimate_trips_batch(df)
+    bike_distance, driving_distance = estimates[0], estimates[1]
+    return driving_distance * DRIVING_EMISSIONS_PER_KM - bike_distance * BIKE_EMISSIONS_PER_KM
+
+def estimate_delta_time_batch(df, estimates=None):
+    # minutes by bike and by car per trip, as numpy arrays
+    if estimates is None:
+        estimates = estimate_trips_batch(df)
+    return {'bike': np.rint(estimates[2]).astype(int), 'drive': np.rint(estimates[3]).astype(int)}
 
 # print(estimate_co2_saved(40.746153593,-73.916188598,40.67308,-73.94191))
 # print(estimate_delta_time(40.746153593,-73.916188598,40.67308,-73.94191))
 
-@lru_cache
+@lru_cache(maxsize=LRU_SIZE)
 def estimate_lat_lng_to_km(ori_lat, ori_lng, dest_lat, dest_lng):
     # units in km
     radius = 6371
@@ -103,6 +120,18 @@ def estimate_lat_lng_to_km(ori_lat, ori_lng, dest_lat, dest_lng):
 
     return radius * c
 
+def estimate_lat_lng_to_km_batch(ori_lat, ori_lng, dest_lat, dest_lng):
+    # vectorized haversine over arrays of coordinates, units in km
+    radius = 6371
+
+    ori_lat, ori_lng = np.radians(ori_lat), np.radians(ori_lng)
+    dest_lat, dest_lng = np.radians(dest_lat), np.radians(dest_lng)
+
+    a = (np.sin((dest_lat - ori_lat) / 2) ** 2 +
+         np.cos(ori_lat) * np.cos(dest_lat) * np.sin((dest_lng - ori_lng) / 2) ** 2)
+
+    return 2 * radius * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
 def is_trip_possible(ori_lat, ori_lng, dest_lat, dest_lng, start_time: datetime.datetime, end_time: datetime.datetime):
     est_distance = estimate_lat_lng_to_km(ori_lat, ori_lng, dest_lat, dest_lng)
     time_elapsed = (end_time - start_time).total_seconds() / 3600
@@ -110,35 +139,10 @@ def is_trip_possible(ori_lat, ori_lng, dest_lat, dest_lng, start_time: datetime.
     # fastest reasonable biking speed in the city is 20 km/h
     return est_distance / 20 <= time_elapsed
 
-# def compute_station_matrix():
-#     # pd.read_csv('distance_matrix.csv', delimiter=',')
-
-#     station_df = get_stations_df()
-
-#     station_matrix = {}
-#     for _, row in station_df.iterrows():
-#         station_matrix[row['station_id']] = (row['lat'], row['lon'])
-#     # return station_matrix
-        
-#     distance_matrix = pd.DataFrame()
-#     data = {}
-#     indices = []
-#     for (ori_id, (lat, lon)) in station_matrix.items():
-#         for (dest_id, (dest_lat, dest_lng)) in station_matrix.items():
-#             if dest_id not in data:
-#                 data[dest_id] = []
-#             distance = 1.5 * get_lat_lng_to_km(lat, lon, dest_lat, dest_lng)
-
-#             # distance_matrix.at[ori_id, dest_id] = distance
-#             data[dest_id].append(distance)
-        
-#         indices.append(ori_id)
-#         # break
-    
-#     distance_matrix = pd.Dataframe(data, index=indices)
-            
-#     distance_matrix.to_csv('distance_matrix.csv', sep=',', index=False)
-
+# hit/miss counts of the caches above, and the batcher's request counts
+metrics.register_cache('distance.estimate_lat_lng_to_km', estimate_lat_lng_to_km)
+metrics.register_source('distance.maps_batcher', lambda: maps_batcher.stats() if maps_batcher is not None else {})
+metrics.register_source('distance.estimate_cache', lambda: get_estimate_cache().stats())
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,218 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Persistent cache for Distance Matrix results, shared by the dashboard and the
+# poller. SQLite in WAL mode lets both processes read while one writes; keys are
+# coordinates quantized to QUANTUM degrees (about 11 m) plus the travel mode.
+# Size is bounded by least-recently-used eviction and entries expire after a
+# TTL, since routes and travel times drift.
+#
+# The entry count lives in a one-row table kept by insert/delete triggers, so
+# every writer reads the count across all processes in its own transaction
+# without a COUNT(*) scan; a put that takes it past max_entries evicts right away.
+
+CACHE_FILE = './data/cache/maps_estimates.sqlite'
+QUANTUM = 1e-4
+MAX_ENTRIES = 1_000_000
+TTL = 90 * 24 * 3600
+# reads refresh an entry's access time at most this often, so hits stay read-only
+ACCESS_RESOLUTION = 3600
+# an eviction pass drops this share of max_entries below the limit, so the
+# puts right after it don't each evict again
+EVICT_SLACK = 0.05
+# SQLite's default limit on bound parameters is 999
+QUERY_CHUNK = 150
+
+
+def quantize(lat, lng):
+    return int(round(lat / QUANTUM)), int(round(lng / QUANTUM))
+
+
+def cache_key(origin, destination, mode):
+    return quantize(*origin) + quantize(*destination) + (mode,)
+
+
+class EstimateCache:
+    def __init__(self, path=CACHE_FILE, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_puts = 0
+        self.num_evicted = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = self._connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS estimates (
+                ori_lat INTEGER, ori_lng INTEGER, dest_lat INTEGER, dest_lng INTEGER, mode TEXT,
+                value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL,
+                PRIMARY KEY (ori_lat, ori_lng, dest_lat, dest_lng, mode)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS estimates_accessed ON estimates (accessed)')
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS entry_count (n INTEGER NOT NULL)')
+            if conn.execute('SELECT n FROM entry_count').fetchone() is None:
+                # a new file, or one from before the count was kept
+                conn.execute('INSERT INTO entry_count SELECT COUNT(*) FROM estimates')
+            conn.execute('CREATE TRIGGER IF NOT EXISTS estimates_insert AFTER INSERT ON estimates '
+                         'BEGIN UPDATE entry_count SET n = n + 1; END')
+            conn.execute('CREATE TRIGGER IF NOT EXISTS estimates_delete AFTER DELETE ON estimates '
+                         'BEGIN UPDATE entry_count SET n = n - 1; END')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self.num_entries = self._count(conn)
+
+    def _connection(self):
+        # one connection per thread; SQLite connections are not shared across threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, conn):
+        return conn.execute('SELECT n FROM entry_count').fetchone()[0]
+
+    def get_many(self, keys):
+        # {key: value} for the keys that are cached and fresh; keys from cache_key()
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        found = {}
+        stale = []
+        conn = self._connection()
+        for start in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[start:start + QUERY_CHUNK]
+            where = ' OR '.join(['(ori_lat=? AND ori_lng=? AND dest_lat=? AND dest_lng=? AND mode=?)'] * len(chunk))
+            rows = conn.execute('SELECT ori_lat, ori_lng, dest_lat, dest_lng, mode, value, created, accessed '
+                                'FROM estimates WHERE ' + where, [v for key in chunk for v in key]).fetchall()
+            for row in rows:
+                key, value, created, accessed = tuple(row[:5]), row[5], row[6], row[7]
+                if now - created > self.ttl:
+                    continue
+                found[key] = json.loads(value)
+                if now - accessed > ACCESS_RESOLUTION:
+                    stale.append(key)
+        if stale:
+            conn.executemany('UPDATE estimates SET accessed=? WHERE ori_lat=? AND ori_lng=? AND dest_lat=? '
+                             'AND dest_lng=? AND mode=?', [(now,) + key for key in stale])
+        with self._lock:
+            self.num_hits += len(found)
+            self.num_misses += len(keys) - len(found)
+        return found
+
+    def get(self, origin, destination, mode):
+        key = cache_key(origin, destination, mode)
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items):
+        # items: iterable of (key, value)
+        now = time.time()
+        rows = [key + (json.dumps(value), now, now) for key, value in items]
+        if not rows:
+            return
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # insert new keys first, so the rowcount is the number of entries added
+            inserted = conn.executemany('INSERT OR IGNORE INTO estimates VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        rows).rowcount
+            if inserted < len(rows):
+                conn.executemany('UPDATE estimates SET value=?, created=?, accessed=? WHERE ori_lat=? AND '
+                                 'ori_lng=? AND dest_lat=? AND dest_lng=? AND mode=?',
+                                 [row[5:] + row[:5] for row in rows])
+            # including other processes' inserts
+            entries = self._count(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        with self._lock:
+            self.num_puts += len(rows)
+            self.num_entries = entries
+            evict = entries > self.max_entries
+        if evict:
+            self.evict()
+
+    def put(self, origin, destination, mode, value):
+        self.put_many([(cache_key(origin, destination, mode), value)])
+
+    def evict(self):
+        # drop expired entries, then the least recently used down to EVICT_SLACK below max_entries
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            evicted = conn.execute('DELETE FROM estimates WHERE created < ?', (time.time() - self.ttl,)).rowcount
+            entries = self._count(conn)
+            if entries > self.max_entries:
+                excess = entries - int(self.max_entries * (1 - EVICT_SLACK))
+                removed = conn.execute('DELETE FROM estimates WHERE (ori_lat, ori_lng, dest_lat, dest_lng, mode) IN '
+                                       '(SELECT ori_lat, ori_lng, dest_lat, dest_lng, mode FROM estimates '
+                                       'ORDER BY accessed LIMIT ?)', (excess,)).rowcount
+                evicted += removed
+                entries -= removed
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        with self._lock:
+            self.num_evicted += evicted
+            self.num_entries = entries
+        return evicted
+
+    def prefetch(self, lookups, fetch_many):
+        # lookups: (origin, destination, mode); fetch_many(missing lookups) -> values in order,
+        # None for a lookup that could not be fetched. Fetches only what is not cached, stores
+        # it, and returns {key: value} for every lookup that has a value.
+        lookups = list(lookups)
+        keys = [cache_key(*lookup) for lookup in lookups]
+        found = self.get_many(keys)
+        missing = {}
+        for key, lookup in zip(keys, lookups):
+            if key not in found:
+                missing.setdefault(key, lookup)
+        if missing:
+            values = fetch_many(list(missing.values()))
+            fetched = {key: value for key, value in zip(missing, values) if value is not None}
+            self.put_many(fetched.items())
+            found.update(fetched)
+        return found
+
+    def __len__(self):
+        return self.num_entries
+
+    def stats(self):
+        lookups = self.num_hits + self.num_misses
+        return {
+            'hits': self.num_hits,
+            'misses': self.num_misses,
+            'hit_rate': self.num_hits / lookups if lookups else 0.0,
+            'puts': self.num_puts,
+            'evicted': self.num_evicted,
+            'entries': self.num_entries,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_estimate_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EstimateCache()
+    return _cache
@@ -0,0 +1,177 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import trip_store
+from trip_store import load_trips
+
+# Rider counts for a whole month, pre-aggregated into an (hour, cell) array.
+# A cell is either a start station or a geohash cell of the start coordinates.
+# The array is built in one bincount pass over the trips and saved next to the
+# columnar trip cache, so rendering any hour is a row lookup and the map
+# payload is bounded by the number of cells instead of the number of trips.
+
+HOUR = np.timedelta64(1, 'h')
+GEOHASH_ALPHABET = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+
+
+def geohash_codes(lats, lngs, precision):
+    # geohash of each point as an integer (5 * precision interleaved bits)
+    bits = 5 * precision
+    lng_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    lat_q = np.clip(((np.asarray(lats) + 90) / 180 * (1 << lat_bits)).astype(np.int64), 0, (1 << lat_bits) - 1)
+    lng_q = np.clip(((np.asarray(lngs) + 180) / 360 * (1 << lng_bits)).astype(np.int64), 0, (1 << lng_bits) - 1)
+
+    # bits alternate from the most significant end, starting with longitude
+    codes = np.zeros(len(lat_q), dtype=np.int64)
+    for k in range(bits):
+        if k % 2 == 0:
+            bit = (lng_q >> (lng_bits - 1 - k // 2)) & 1
+        else:
+            bit = (lat_q >> (lat_bits - 1 - k // 2)) & 1
+        codes = (codes << 1) | bit
+    return codes
+
+
+def geohash_centers(codes, precision):
+    # (lat, lng) of the centre of each geohash cell
+    codes = np.asarray(codes, dtype=np.int64)
+    bits = 5 * precision
+    lng_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    lat_q = np.zeros(len(codes), dtype=np.int64)
+    lng_q = np.zeros(len(codes), dtype=np.int64)
+    for k in range(bits):
+        bit = (codes >> (bits - 1 - k)) & 1
+        if k % 2 == 0:
+            lng_q = (lng_q << 1) | bit
+        else:
+            lat_q = (lat_q << 1) | bit
+    lats = (lat_q + 0.5) / (1 << lat_bits) * 180 - 90
+    lngs = (lng_q + 0.5) / (1 << lng_bits) * 360 - 180
+    return lats, lngs
+
+
+def geohash_strings(codes, precision):
+    codes = np.asarray(codes, dtype=np.int64)
+    chars = [GEOHASH_ALPHABET[(codes >> (5 * (precision - 1 - k))) & 31] for k in range(precision)]
+    return np.array([''.join(c) for c in zip(*chars)]) if len(codes) else np.array([], dtype=str)
+
+
+class HeatmapTiles:
+    def __init__(self, counts, start, cell_ids, cell_lat, cell_lng):
+        # counts[h, c]: trips starting in cell c during hour start + h
+        self.counts = counts
+        self.start = np.datetime64(start, 'h')
+        self.cell_ids = cell_ids
+        self.cell_lat = cell_lat
+        self.cell_lng = cell_lng
+
+    @classmethod
+    def from_trips(cls, df, geohash_precision=None):
+        # df: typed trips from trip_store, sorted by started_at
+        started = df['started_at'].to_numpy()
+        start = started[0].astype('datetime64[h]') if len(started) else np.datetime64('1970-01-01T00', 'h')
+        hours = ((started - start) // HOUR).astype(np.int64)
+        num_hours = int(hours[-1]) + 1 if len(hours) else 0
+        lats = df['start_lat'].to_numpy()
+        lngs = df['start_lng'].to_numpy()
+
+        if geohash_precision is None:
+            station_ids = df['start_station_id'].astype('category')
+            cell_ids = station_ids.cat.categories.to_numpy().astype(str)
+            cells = station_ids.cat.codes.to_numpy().astype(np.int64)
+            # representative coordinates for each station: its first trip
+            first = np.unique(cells, return_index=True)[1]
+            cell_lat = np.full(len(cell_ids), np.nan)
+            cell_lng = np.full(len(cell_ids), np.nan)
+            cell_lat[cells[first]] = lats[first]
+            cell_lng[cells[first]] = lngs[first]
+        else:
+            codes, cells = np.unique(geohash_codes(lats, lngs, geohash_precision), return_inverse=True)
+            cell_ids = geohash_strings(codes, geohash_precision)
+            cell_lat, cell_lng = geohash_centers(codes, geohash_precision)
+
+        num_cells = len(cell_ids)
+        counts = np.bincount(hours * num_cells + cells, minlength=num_hours * num_cells)
+        dtype = np.uint16 if counts.max(initial=0) <= np.iinfo(np.uint16).max else np.uint32
+        counts = counts.astype(dtype).reshape(num_hours, num_cells)
+        return cls(counts, start, cell_ids, cell_lat, cell_lng)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, counts=self.counts, start=self.start.astype('datetime64[h]').astype(np.int64),
+                 cell_ids=self.cell_ids, cell_lat=self.cell_lat, cell_lng=self.cell_lng)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['counts'], np.datetime64(int(f['start']), 'h'), f['cell_ids'], f['cell_lat'], f['cell_lng'])
+
+    def __len__(self):
+        return len(self.counts)
+
+    def hour_index(self, curr_timestamp):
+        # the last full hour before curr_timestamp
+        return int((np.datetime64(curr_timestamp).astype('datetime64[h]') - self.start) // HOUR) - 1
+
+    def hour(self, curr_timestamp):
+        # rider counts per cell for the last full hour, all zeros outside the month
+        h = self.hour_index(curr_timestamp)
+        if 0 <= h < len(self.counts):
+            return self.counts[h]
+        return np.zeros(self.counts.shape[1], dtype=self.counts.dtype)
+
+    def heatmap(self, curr_timestamp):
+        # same columns as TripWindow.heatmap, one row per cell with riders
+        counts = self.hour(curr_timestamp)
+        active = np.flatnonzero(counts)
+        return pd.DataFrame({
+            'start_station_id': self.cell_ids[active],
+            'start_lat': self.cell_lat[active],
+            'start_lng': self.cell_lng[active],
+            'riders': counts[active].astype(np.int64),
+        })
+
+
+def tiles_cache_file(csv_file, geohash_precision=None):
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    cells = 'station' if geohash_precision is None else 'geohash%d' % geohash_precision
+    return os.path.join(trip_store.CACHE_DIR, '%s.tiles-%s.npz' % (name, cells))
+
+
+_tiles = {}
+_lock = threading.Lock()
+
+
+def get_heatmap_tiles(csv_file, geohash_precision=None):
+    # built once per trip file and cell kind, reloaded from disk while it is newer than the CSV
+    key = (os.path.abspath(csv_file), os.stat(csv_file).st_mtime_ns, geohash_precision)
+    tiles = _tiles.get(key)
+    if tiles is not None:
+        return tiles
+
+    with _lock:
+        tiles = _tiles.get(key)
+        if tiles is not None:
+            return tiles
+
+        cache_file = tiles_cache_file(csv_file, geohash_precision)
+        if os.path.exists(cache_file) and os.stat(cache_file).st_mtime_ns >= key[1]:
+            tiles = HeatmapTiles.load(cache_file)
+        else:
+            tiles = HeatmapTiles.from_trips(load_trips(csv_file), geohash_precision)
+            try:
+                tiles.save(cache_file)
+            except OSError:
+                pass
+
+        for old_key in [old_key for old_key in _tiles if old_key[0] == key[0] and old_key[2] == key[2]]:
+            del _tiles[old_key]
+        _tiles[key] = tiles
+    return tiles
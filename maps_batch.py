@@ -0,0 +1,304 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Batching layer for Distance Matrix lookups. Callers submit single
+# (origin, destination, mode) lookups; a dispatcher thread collects them for a
+# few milliseconds, dedupes in-flight duplicates and packs them into maximal
+# origins x destinations requests that run on a bounded thread pool.
+
+DISTANCE_MATRIX_URL = 'https://maps.googleapis.com'
+
+# Distance Matrix API limits per request
+MAX_ORIGINS = 25
+MAX_DESTINATIONS = 25
+MAX_ELEMENTS = 100
+
+# Scattered pairs are packed into shared origins x destinations blocks, which
+# also returns (and bills) cells nobody asked for. A block must be at least this
+# full of requested pairs, i.e. at most 4 billed elements per requested one.
+MIN_FILL = 0.25
+
+# response statuses worth retrying
+RETRY_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+
+MODES = {'b': 'bicycling', 'd': 'driving'}
+
+
+class TransportError(Exception):
+    pass
+
+
+class ResponseError(Exception):
+    # the API rejected the request, retrying will not help
+    pass
+
+
+class GoogleMapsTransport:
+    # sends requests through a googlemaps.Client
+    def __init__(self, client):
+        self.client = client
+
+    def __call__(self, origins, destinations, mode):
+        return self.client.distance_matrix(origins=origins, destinations=destinations, mode=mode)
+
+
+class HttpTransport:
+    # talks to the Distance Matrix web service directly; point base_url at a
+    # local fake server for tests and benchmarks
+    def __init__(self, api_key, base_url=DISTANCE_MATRIX_URL, timeout=10.0):
+        import httpx
+
+        self.api_key = api_key
+        self.client = httpx.Client(base_url=base_url, timeout=timeout)
+
+    def __call__(self, origins, destinations, mode):
+        response = self.client.get('/maps/api/distancematrix/json', params={
+            'origins': '|'.join('%s,%s' % latlng for latlng in origins),
+            'destinations': '|'.join('%s,%s' % latlng for latlng in destinations),
+            'mode': mode,
+            'key': self.api_key,
+        })
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.client.close()
+
+
+class RateLimiter:
+    # token bucket, `rate` requests per second with bursts up to `burst`
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def group_requests(pairs, max_origins=MAX_ORIGINS, max_destinations=MAX_DESTINATIONS, max_elements=MAX_ELEMENTS,
+                   min_fill=MIN_FILL):
+    # pack (origin, destination) pairs into (origins, destinations) blocks as
+    # large as the API allows, sharing destinations across origins even when
+    # that requests some extra cells, as long as a block stays min_fill full
+    by_origin = {}
+    for origin, destination in pairs:
+        by_origin.setdefault(origin, set()).add(destination)
+
+    # one row per origin, split when it has more destinations than fit in a request
+    max_destinations = min(max_destinations, max_elements)
+    rows = []
+    for origin, destinations in by_origin.items():
+        destinations = sorted(destinations)
+        for start in range(0, len(destinations), max_destinations):
+            rows.append((origin, destinations[start:start + max_destinations]))
+
+    # first fit, largest rows first: each block starts from the largest row
+    # left and takes every later row that still fits in it
+    rows.sort(key=lambda row: -len(row[1]))
+    blocks = []
+    while rows:
+        origin, destinations = rows[0]
+        origins = [origin]
+        block_destinations = set(destinations)
+        requested = len(destinations)
+        rest = []
+        for other, other_destinations in rows[1:]:
+            union = block_destinations.union(other_destinations)
+            num_origins = len(origins) + 1
+            if (other not in origins and num_origins <= max_origins and len(union) <= max_destinations
+                    and num_origins * len(union) <= max_elements
+                    and requested + len(other_destinations) >= min_fill * num_origins * len(union)):
+                origins.append(other)
+                block_destinations = union
+                requested += len(other_destinations)
+            else:
+                rest.append((other, other_destinations))
+        blocks.append((origins, sorted(block_destinations)))
+        rows = rest
+    return blocks
+
+
+class DistanceMatrixBatcher:
+    def __init__(self, transport, max_workers=4, requests_per_second=10.0, retries=3, backoff=0.5,
+                 linger=0.01, max_origins=MAX_ORIGINS, max_destinations=MAX_DESTINATIONS, max_elements=MAX_ELEMENTS,
+                 min_fill=MIN_FILL):
+        self.transport = transport
+        self.retries = retries
+        self.backoff = backoff
+        self.linger = linger
+        self.max_origins = max_origins
+        self.max_destinations = max_destinations
+        self.max_elements = max_elements
+        self.min_fill = min_fill
+        self.rate_limiter = RateLimiter(requests_per_second) if requests_per_second else None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='distance-matrix')
+
+        # (origin, destination, mode) -> Future, for lookups submitted or in flight
+        self.in_flight = {}
+        self.pending = []
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # counters
+        self.num_lookups = 0
+        self.num_coalesced = 0
+        self.num_requests = 0
+        self.num_elements = 0
+        self.num_retries = 0
+
+        self.dispatcher = threading.Thread(target=self._dispatch_loop, name='distance-matrix-dispatch', daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, origin, destination, mode):
+        # Future resolving to the response element for this pair
+        mode = MODES.get(mode, mode)
+        key = (tuple(origin), tuple(destination), mode)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('batcher is closed')
+            self.num_lookups += 1
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.num_coalesced += 1
+                return future
+            future = Future()
+            self.in_flight[key] = future
+            self.pending.append(key)
+            self.cond.notify()
+        return future
+
+    def lookup(self, origin, destination, mode):
+        return self.submit(origin, destination, mode).result()
+
+    def lookup_many(self, keys):
+        # keys: iterable of (origin, destination, mode); returns elements in order
+        futures = [self.submit(*key) for key in keys]
+        self.flush()
+        return [future.result() for future in futures]
+
+    def try_lookup_many(self, keys):
+        # like lookup_many, with None for the keys whose request failed
+        futures = [self.submit(*key) for key in keys]
+        self.flush()
+        elements = []
+        for future in futures:
+            try:
+                elements.append(future.result())
+            except Exception:
+                elements.append(None)
+        return elements
+
+    def flush(self):
+        # dispatch everything pending now instead of waiting out the linger time
+        with self.cond:
+            batch, self.pending = self.pending, []
+        self._dispatch(batch)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            'lookups': self.num_lookups,
+            'coalesced': self.num_coalesced,
+            'requests': self.num_requests,
+            'elements': self.num_elements,
+            'retries': self.num_retries,
+        }
+
+    def _dispatch_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            # give concurrent callers a moment to pile on before sending
+            time.sleep(self.linger)
+            with self.cond:
+                batch, self.pending = self.pending, []
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        by_mode = {}
+        for origin, destination, mode in batch:
+            by_mode.setdefault(mode, []).append((origin, destination))
+        for mode, pairs in by_mode.items():
+            unassigned = set(pairs)
+            blocks = group_requests(pairs, self.max_origins, self.max_destinations, self.max_elements, self.min_fill)
+            for origins, destinations in blocks:
+                # the pairs this block answers; its other cells belong to no lookup or to another block
+                keys = [(origin, destination, mode) for origin in origins for destination in destinations
+                        if (origin, destination) in unassigned]
+                unassigned.difference_update(key[:2] for key in keys)
+                self.executor.submit(self._run_request, origins, destinations, mode, keys)
+
+    def _run_request(self, origins, destinations, mode, keys):
+        try:
+            response = self._send(origins, destinations, mode)
+            rows = response['rows']
+            results = {}
+            for origin, row in zip(origins, rows):
+                for destination, element in zip(destinations, row['elements']):
+                    results[(origin, destination, mode)] = element
+        except Exception as e:
+            with self.cond:
+                futures = [self.in_flight.pop(key, None) for key in keys]
+            for future in futures:
+                if future is not None:
+                    future.set_exception(e)
+            return
+
+        with self.cond:
+            futures = [(key, self.in_flight.pop(key, None)) for key in keys]
+        for key, future in futures:
+            if future is None:
+                continue
+            if key in results:
+                future.set_result(results[key])
+            else:
+                future.set_exception(TransportError('missing element in response for %s' % (key,)))
+
+    def _send(self, origins, destinations, mode):
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                with self.cond:
+                    self.num_requests += 1
+                    self.num_elements += len(origins) * len(destinations)
+                response = self.transport(list(origins), list(destinations), mode)
+                status = response.get('status', 'OK')
+                if status in RETRY_STATUSES:
+                    raise TransportError(status)
+                if status != 'OK':
+                    # e.g. INVALID_REQUEST / REQUEST_DENIED
+                    raise ResponseError(status)
+                return response
+            except ResponseError:
+                raise
+            except Exception:
+                if attempt >= self.retries:
+                    raise
+                with self.cond:
+                    self.num_retries += 1
+                time.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
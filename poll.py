@@ -1,10 +1,24 @@
 import csp
 from csp import ts
 from datetime import timedelta
-from csp_bike import get_station_status, get_stations
+from csp_bike import get_station_status, get_station_status_delay, get_station_metadata, start_metadata_refresh, StationDelta
+from csp_bike import StationStatusReplay, SnapshotWriter, trip_station_metadata
+from csp_bike import ArchiveReplay, SnapshotArchive
+from csp_bike.archive import ARCHIVE_FILE
+from csp_bike import GBFSPollerManager, DEFAULT_SYSTEM
+from csp_bike import SnapshotQueueManager, enqueue_snapshots, heartbeat
 import distance
-import datetime
 import random
+from bike_pool import BikePool
+from co2_channel import Co2Channel, DEFAULT_NUM_STATIONS
+from trip_store import load_trips
+import numpy as np
+import os
+import time
+from csp_bike.metrics import metrics, profiling, METRICS_DIR
+
+# the poller's metrics, read by the dashboard's debug panel
+METRICS_FILE = os.path.join(METRICS_DIR, "poll.json")
 
 @csp.node
 def poll_data(interval: timedelta) -> ts[[dict]]:
@@ -20,82 +34,148 @@ def poll_data(interval: timedelta) -> ts[[dict]]:
 
     if csp.ticked(a_poll):
         # grab the data
-        to_return = get_station_status()
+        with metrics.timer("poll.poll_data"):
+            to_return = get_station_status()
+        metrics.count("poll.poll_data.records", len(to_return))
 
-        # schedule next poll in `interval`
-        csp.schedule_alarm(a_poll, interval, True)
+        # schedule next poll when the feed's ttl says it may have changed,
+        # but never later than `interval`
+        csp.schedule_alarm(a_poll, get_station_status_delay(interval), True)
         return to_return
 
 @csp.node
-def calculate_total_system_capacity(stations: ts[[dict]]) -> ts[int]:
+def record_snapshots(stations: ts[[dict]], path: str):
+    with csp.state():
+        s_writer = SnapshotWriter(path)
+        s_previous = None
+
+    with csp.stop():
+        s_writer.close()
+
+    if csp.ticked(stations):
+        # an unchanged feed comes back as the same list, nothing new to record
+        if stations is not s_previous:
+            s_previous = stations
+            s_writer.append(csp.now(), stations, get_station_metadata().station_ids)
+
+@csp.node
+def station_deltas(stations: ts[[dict]]) -> ts[[StationDelta]]:
+    with csp.state():
+        # station_id -> (last_reported, total_bikes_available) from the previous snapshot
+        s_previous = {}
+
+    if csp.ticked(stations):
+        # only stations whose bike count changed go downstream; an empty
+        # list still ticks so consumers keep their per-poll cadence
+        deltas = []
+        for station in stations:
+            station_id = station["station_id"]
+            last_reported = station.get("last_reported", 0)
+            total_bikes = station["total_bikes_available"]
+
+            previous = s_previous.get(station_id)
+            if previous is not None:
+                # station has not reported since the last snapshot
+                if last_reported and previous[0] == last_reported:
+                    continue
+                if previous[1] == total_bikes:
+                    s_previous[station_id] = (last_reported, total_bikes)
+                    continue
+
+            s_previous[station_id] = (last_reported, total_bikes)
+            deltas.append(StationDelta(
+                station_id=station_id,
+                last_reported=last_reported,
+                num_bikes_available=station["num_bikes_available"],
+                num_ebikes_available=station.get("num_ebikes_available", 0),
+                num_docks_available=station.get("num_docks_available", 0),
+                total_bikes_available=total_bikes,
+                prior_bikes_available=previous[1] if previous is not None else 0,
+            ))
+        return deltas
+
+@csp.node
+def calculate_total_system_capacity(deltas: ts[[StationDelta]]) -> ts[int]:
     with csp.state():
         # these are stateful variables that will retain their
         # value in between "ticks"
         s_capacity = 0
-        s_stations = {}
 
-    if csp.ticked(stations):
-        # when a new list of stations "ticks", we'll do some
-        # processing and emit a new "tick" as output
-        for station in stations:
-            # subtract prior capacity
-            prior_capacity = s_stations.get(station["station_id"], {}).get("total_bikes_available", 0)
-            s_capacity -= prior_capacity
-    
-            # now update our tracker and capacity
-            s_stations[station["station_id"]] = station
-            s_capacity += station["total_bikes_available"]
+    if csp.ticked(deltas):
+        # only changed stations tick, so apply their difference
+        for delta in deltas:
+            s_capacity += delta.total_bikes_available - delta.prior_bikes_available
     
         # finally, "tick" out the result
         return s_capacity
     
 @csp.node
-def approximate_trips(stations: ts[[dict]]) -> ts[float]:
+def approximate_trips(deltas: ts[[StationDelta]], station_metadata: object = None, publish: bool = True,
+                      system: str = DEFAULT_SYSTEM) -> ts[float]:
     with csp.state():
         # these are stateful variables that will retain their
         # value in between "ticks"
-        station_data = get_stations()
-        # print(station_data)
 
-        # bikes currently in service, stored with time checked out and stationID
-        s_bike_pool = set()
+        # bikes currently in service, spatially indexed by checkout station and time
+        s_bike_pool = BikePool()
 
         # tabulate total CO2 saved
         s_co2_saved = 0
 
-        # stations and their previous capacities, stored to track number of bikes checked out
-        s_stations = {}
+        # bikes available per station, by interned metadata index
+        s_station_counts = np.zeros(DEFAULT_NUM_STATIONS, dtype=np.int32)
+
+        # published to the dashboard
+        s_channel = Co2Channel.create() if publish else None
+
+        # the channel keeps its history across restarts, so the published total
+        # carries on from its last record instead of dropping back to 0
+        s_co2_start = s_channel.latest_total() if s_channel is not None else 0.0
 
         init = True
 
-    if csp.ticked(stations):
-        # when a new list of stations "ticks", we'll do some
+    if csp.ticked(deltas):
+        # when a new list of changed stations "ticks", we'll do some
         # processing and emit a new "tick" as output
+        tick_start = time.perf_counter()
+        metrics.count("poll.approximate_trips.deltas", len(deltas))
         prev_co2_saved = s_co2_saved
 
-        for station in stations:
-            # subtract prior capacity
-            prior_capacity = s_stations.get(station["station_id"], {}).get("total_bikes_available", 0)
-            current_capacity = station["total_bikes_available"]
-            current_lat = station_data[station["station_id"]]["lat"]
-            current_lon = station_data[station["station_id"]]["lon"]
+        # current metadata snapshot, refreshed in the background (or fixed, when replaying)
+        metadata = station_metadata if station_metadata is not None else get_station_metadata(system)
+        station_data = metadata.stations
+
+        # checkouts too old to still be out on a trip
+        s_bike_pool.expire(csp.now())
+
+        for delta in deltas:
+            # previous capacity travels with the delta
+            prior_capacity = delta.prior_bikes_available
+            current_capacity = delta.total_bikes_available
+            station_info = station_data.get(delta.station_id)
+            if station_info is None:
+                # not in station_information yet, picked up on the next refresh
+                continue
+            current_lat = station_info["lat"]
+            current_lon = station_info["lon"]
+
+            station_index = metadata.index[delta.station_id]
+            if station_index < len(s_station_counts):
+                s_station_counts[station_index] = current_capacity
 
             # if the station has less bikes than before, we assume they were checked out
             if current_capacity < prior_capacity:
                 bikes_checked_out = prior_capacity - current_capacity
 
-                s_bike_pool.add((station["station_id"], current_lat, current_lon, datetime.datetime.now() , bikes_checked_out))
+                s_bike_pool.check_out(delta.station_id, current_lat, current_lon, csp.now(), bikes_checked_out)
             
             elif current_capacity > prior_capacity:
-                current_time = datetime.datetime.now()
+                current_time = csp.now()
 
                 bikes_returned = current_capacity - prior_capacity
             
-                # bikes part of a possible trip
-                potential_bikes = [bike_data for bike_data in s_bike_pool if 
-                                     distance.is_trip_possible(bike_data[1], bike_data[2], current_lat, current_lon, bike_data[3], current_time)]
-                
-
+                # bikes part of a possible trip, by radius query around this station
+                potential_bikes = s_bike_pool.candidates(current_lat, current_lon, current_time)
 
                 for _ in range(bikes_returned):
                     if len(potential_bikes) == 0:
@@ -105,37 +185,145 @@ def approximate_trips(stations: ts[[dict]]) -> ts[float]:
                         continue
 
                     # otherwise randomly choose a possible bike for the trip
-                    random_bike = random.choice(potential_bikes)
-                    s_bike_pool.discard(random_bike)
-                    if random_bike[4] > 1:
-                        s_bike_pool.add((random_bike[0], random_bike[1], random_bike[2], current_time, random_bike[4] - 1))
+                    k = random.randrange(len(potential_bikes))
+                    _, bike_lat, bike_lon, _, bikes_left = s_bike_pool.take(potential_bikes[k])
+                    if bikes_left == 0:
+                        potential_bikes[k] = potential_bikes[-1]
+                        potential_bikes.pop()
                     
-                    s_co2_saved += distance.estimate_co2_saved(random_bike[1], random_bike[2], current_lat, current_lon)
-
-            # now update our tracker and capacity
-            s_stations[station["station_id"]] = station
+                    s_co2_saved += distance.estimate_co2_saved(bike_lat, bike_lon, current_lat, current_lon)
 
         if init:
+            # the first snapshot lists every station, its deltas are not trips
             init = False
-            s_co2_saved = 0
+            s_co2_saved = s_co2_start
+            prev_co2_saved = s_co2_start
 
-        print("bike pool: ", sum([bike[4] for bike in s_bike_pool]))
+        metrics.record("poll.approximate_trips", time.perf_counter() - tick_start)
+        metrics.gauge("poll.bike_pool", len(s_bike_pool))
 
-        with open("co2_saved.txt", "w") as f:
-            f.write(str(s_co2_saved - prev_co2_saved) + '\n' + str(s_co2_saved))
+        if s_channel is not None:
+            s_channel.publish(csp.now(), s_co2_saved - prev_co2_saved, s_co2_saved, len(s_bike_pool), s_station_counts)
+            metrics.maybe_dump(METRICS_FILE)
     
         # finally, "tick" out the result
         return s_co2_saved
     
 @csp.graph
-def my_capacity_calculator(interval: timedelta):
+def my_capacity_calculator(interval: timedelta, archive_file: str = ARCHIVE_FILE):
     stations_data = poll_data(interval=interval)
-    # system_capacity = calculate_total_system_capacity(stations_data)
+    if archive_file:
+        record_snapshots(stations_data, archive_file)
+    deltas = station_deltas(stations_data)
+    # system_capacity = calculate_total_system_capacity(deltas)
     # csp.print("Total system capacity", system_capacity)
-    co2_saved = approximate_trips(stations_data)
+    co2_saved = approximate_trips(deltas)
     csp.print("Total CO2 saved", co2_saved)
 
+@csp.graph
+def system_pipeline(system: str, stations_data: ts[[dict]], archive_file: str = ARCHIVE_FILE):
+    if archive_file and system == DEFAULT_SYSTEM:
+        record_snapshots(stations_data, archive_file)
+    deltas = station_deltas(stations_data)
+    # the dashboard shows the default system
+    co2_saved = approximate_trips(deltas, publish=(system == DEFAULT_SYSTEM), system=system)
+    csp.print("Total CO2 saved " + system, co2_saved)
+
+@csp.graph
+def multi_system_calculator(systems: [str], interval: timedelta, archive_file: str = ARCHIVE_FILE):
+    # one pipeline per GBFS system, fed from a keyed basket of concurrently polled snapshots
+    stations_by_system = GBFSPollerManager(systems, interval).subscribe_all()
+    for system, stations_data in stations_by_system.items():
+        system_pipeline(system, stations_data, archive_file)
+
+# The same pipeline split across processes by supervisor.py: a fetcher polls
+# every system, archives and queues the snapshots, and estimator workers each
+# run the pipelines for their share of the systems. Both beat a shared heartbeat
+# from inside the realtime loop so the supervisor can restart a stalled process.
+
+@csp.graph
+def fetcher_graph(systems: [str], interval: timedelta, queues: object, beat: object,
+                  heartbeat_interval: timedelta, archive_file: str = ARCHIVE_FILE, metrics_file: str = ""):
+    # queues: {system: the queue of the estimator that owns it}
+    stations_by_system = GBFSPollerManager(systems, interval).subscribe_all()
+    for system, stations_data in stations_by_system.items():
+        # archived here, before a lagging estimator can drop any snapshots
+        if archive_file and system == DEFAULT_SYSTEM:
+            record_snapshots(stations_data, archive_file)
+        enqueue_snapshots(stations_data, system, queues[system])
+    heartbeat(heartbeat_interval, beat, metrics_file)
+
+@csp.graph
+def estimator_graph(systems: [str], queue: object, beat: object, heartbeat_interval: timedelta,
+                    metrics_file: str = ""):
+    stations_by_system = SnapshotQueueManager(queue).subscribe_all(systems)
+    for system, stations_data in stations_by_system.items():
+        system_pipeline(system, stations_data, archive_file="")
+    heartbeat(heartbeat_interval, beat, metrics_file)
+
+@csp.graph
+def replay_capacity_calculator(trip_file: str, interval: timedelta):
+    # same pipeline as my_capacity_calculator, fed from historical trips
+    stations_data = StationStatusReplay(filename=trip_file, interval=interval)
+    deltas = station_deltas(stations_data)
+    co2_saved = approximate_trips(deltas, station_metadata=trip_station_metadata(trip_file), publish=False)
+    csp.add_graph_output("co2_saved", co2_saved)
+
+def replay(trip_file, interval=timedelta(seconds=28), starttime=None, endtime=None):
+    # run a month of trips through approximate_trips as fast as the engine allows,
+    # returns [(time, total CO2 saved)]
+    trips = load_trips(trip_file)
+    starttime = starttime or trips["started_at"].iloc[0].to_pydatetime()
+    endtime = endtime or trips["ended_at"].max().to_pydatetime()
+    results = csp.run(replay_capacity_calculator, trip_file, interval, starttime=starttime, endtime=endtime)
+    return results["co2_saved"]
+
+@csp.graph
+def archive_capacity_calculator(archive_file: str):
+    # same pipeline as my_capacity_calculator, fed from recorded station_status snapshots
+    stations_data = ArchiveReplay(path=archive_file)
+    deltas = station_deltas(stations_data)
+    co2_saved = approximate_trips(deltas, publish=False)
+    csp.add_graph_output("co2_saved", co2_saved)
+
+def replay_archive(archive_file, starttime=None, endtime=None):
+    # run recorded snapshots through approximate_trips, returns [(time, total CO2 saved)]
+    time_range = SnapshotArchive(archive_file).time_range()
+    if time_range is None:
+        return []
+    starttime = starttime or time_range[0]
+    endtime = endtime or time_range[1]
+    results = csp.run(archive_capacity_calculator, archive_file, starttime=starttime, endtime=endtime)
+    return results["co2_saved"]
+
 if __name__ == "__main__":
-    csp.run(my_capacity_calculator, timedelta(seconds=28), realtime=True)
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay", metavar="TRIP_FILE", help="replay a trip CSV (or its Parquet cache) instead of polling live")
+    parser.add_argument("--replay-archive", metavar="ARCHIVE_FILE", help="replay recorded station_status snapshots instead of polling live")
+    parser.add_argument("--interval", type=float, default=28, help="seconds between station_status snapshots")
+    parser.add_argument("--archive", default=ARCHIVE_FILE, help="station_status archive to record to, empty to disable")
+    parser.add_argument("--systems", help="comma-separated GBFS system ids to poll concurrently, e.g. bkn,bay,chi")
+    args = parser.parse_args()
 
-        
\ No newline at end of file
+    if args.replay:
+        with profiling("poll_replay"):
+            co2_saved = replay(args.replay, timedelta(seconds=args.interval))
+        metrics.dump_json(os.path.join(METRICS_DIR, "poll_replay.json"))
+        print("Replayed", len(co2_saved), "snapshots, total CO2 saved", co2_saved[-1][1] if co2_saved else 0)
+    elif args.replay_archive:
+        with profiling("poll_replay"):
+            co2_saved = replay_archive(args.replay_archive)
+        metrics.dump_json(os.path.join(METRICS_DIR, "poll_replay.json"))
+        print("Replayed", len(co2_saved), "snapshots, total CO2 saved", co2_saved[-1][1] if co2_saved else 0)
+    elif args.systems:
+        systems = args.systems.split(",")
+        start_metadata_refresh(systems)
+        with profiling("poll"):
+            csp.run(multi_system_calculator, systems, timedelta(seconds=args.interval), args.archive, realtime=True)
+    else:
+        # keep station metadata fresh and publish it for the dashboard
+        start_metadata_refresh()
+        with profiling("poll"):
+            csp.run(my_capacity_calculator, timedelta(seconds=args.interval), args.archive, realtime=True)
@@ -0,0 +1,290 @@
+import math
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import trip_store
+
+# Running per-rider CO2 saved and time saved, for this month and all time, with
+# a percentile rank among this month's riders.
+#
+# Riders are interned to slots in growable numpy arrays, so a trip is a dict
+# lookup plus a few array updates. Rankings come from a log-bucketed quantile
+# sketch (DDSketch-style, 1% relative accuracy): a rider's total moving from
+# one value to another is a decrement in one bucket and an increment in
+# another, so ranks stay exact to within a bucket while totals keep changing,
+# and a percentile query is a cumulative sum over a few hundred buckets.
+#
+# The public Citi Bike trip files have no rider id; trips are attributed
+# through a RIDER_COLUMN column wherever one is provided. trip_aggregates.ingest
+# builds one index per such file next to its aggregate checkpoints and merges
+# them into the index saved at index_file(), which the dashboard loads.
+
+RIDER_COLUMN = 'rider_id'
+INITIAL_CAPACITY = 1024
+RELATIVE_ACCURACY = 0.01
+# values at or below this land in the zero bucket
+MIN_VALUE = 1e-3
+MAX_VALUE = 1e5
+
+FIELDS = ('month_rides', 'month_co2', 'month_time', 'total_rides', 'total_co2', 'total_time')
+
+
+def index_file():
+    return os.path.join(trip_store.CACHE_DIR, 'rider_index.npz')
+
+
+class QuantileSketch:
+    # counts of values in log-spaced buckets; values can be removed as well as added
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY, min_value=MIN_VALUE, max_value=MAX_VALUE):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.offset = math.ceil(math.log(min_value) / self.log_gamma)
+        num_buckets = math.ceil(math.log(max_value) / self.log_gamma) - self.offset + 2
+        self.counts = np.zeros(num_buckets, dtype=np.int64)
+
+    def bucket(self, values):
+        # bucket 0 holds everything <= min_value
+        values = np.maximum(np.asarray(values, dtype=np.float64), self.min_value)
+        buckets = np.ceil(np.log(values) / self.log_gamma).astype(np.int64) - self.offset
+        return np.clip(buckets, 0, len(self.counts) - 1)
+
+    def bucket_of(self, value):
+        # scalar bucket(), without the array round trip
+        if value <= self.min_value:
+            return 0
+        return min(math.ceil(math.log(value) / self.log_gamma) - self.offset, len(self.counts) - 1)
+
+    def add(self, values, sign=1):
+        np.add.at(self.counts, self.bucket(values), sign)
+
+    def add_one(self, value, sign=1):
+        self.counts[self.bucket_of(value)] += sign
+
+    def remove(self, values):
+        self.add(values, -1)
+
+    def clear(self):
+        self.counts[:] = 0
+
+    def merge(self, other):
+        # add another sketch's values; both need the same accuracy and range
+        if other.gamma != self.gamma or len(other.counts) != len(self.counts):
+            raise ValueError('sketches with different buckets')
+        self.counts += other.counts
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def rank(self, value):
+        # fraction of values below value, counting half of its own bucket
+        total = self.counts.sum()
+        if not total:
+            return 0.0
+        b = self.bucket_of(value)
+        return float((self.counts[:b].sum() + 0.5 * self.counts[b]) / total)
+
+    def quantile(self, q):
+        total = self.counts.sum()
+        if not total:
+            return 0.0
+        b = int(np.searchsorted(np.cumsum(self.counts), q * total, side='left'))
+        if b == 0:
+            return 0.0
+        # midpoint of the bucket, within relative_accuracy of every value in it
+        return 2 * self.gamma ** (b + self.offset) / (self.gamma + 1)
+
+
+class RiderIndex:
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.slots = {}
+        self.rider_ids = []
+        self.month = None
+        for name in FIELDS:
+            setattr(self, name, np.zeros(capacity))
+        self.month_sketch = QuantileSketch()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rider_ids)
+
+    def __getstate__(self):
+        # picklable, so ingest workers can hand their file's index back
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _grow(self, size):
+        capacity = len(self.month_co2)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name in FIELDS:
+            values = np.zeros(capacity)
+            old = getattr(self, name)
+            values[:len(old)] = old
+            setattr(self, name, values)
+
+    def _slots(self, rider_ids):
+        # intern new riders, amortized O(1) each
+        slots = np.empty(len(rider_ids), dtype=np.int64)
+        for k, rider_id in enumerate(rider_ids):
+            slot = self.slots.get(rider_id)
+            if slot is None:
+                slot = self.slots[rider_id] = len(self.rider_ids)
+                self.rider_ids.append(rider_id)
+            slots[k] = slot
+        self._grow(len(self.rider_ids))
+        return slots
+
+    def _roll_month(self, month):
+        # trips are expected roughly in time order; a later month starts the monthly totals over
+        if self.month is None or month > self.month:
+            self.month = month
+            self.month_rides[:] = 0
+            self.month_co2[:] = 0
+            self.month_time[:] = 0
+            self.month_sketch.clear()
+
+    def add_trips(self, rider_ids, times, co2_saved, time_saved):
+        # batch of trips: rider ids, end times, kg of CO2 and minutes saved per trip
+        if not len(rider_ids):
+            return
+        times = pd.DatetimeIndex(times)
+        months = (times.year * 12 + times.month - 1).to_numpy()
+        co2_saved = np.asarray(co2_saved, dtype=np.float64)
+        time_saved = np.asarray(time_saved, dtype=np.float64)
+        with self.lock:
+            self._roll_month(int(months.max()))
+            slots = self._slots(rider_ids)
+            np.add.at(self.total_rides, slots, 1)
+            np.add.at(self.total_co2, slots, co2_saved)
+            np.add.at(self.total_time, slots, time_saved)
+
+            current = months == self.month
+            if not current.any():
+                return
+            slots, co2_saved, time_saved = slots[current], co2_saved[current], time_saved[current]
+            touched = np.unique(slots)
+            # riders already ranked this month leave their old bucket for the new one
+            ranked = touched[self.month_rides[touched] > 0]
+            self.month_sketch.remove(self.month_co2[ranked])
+            np.add.at(self.month_rides, slots, 1)
+            np.add.at(self.month_co2, slots, co2_saved)
+            np.add.at(self.month_time, slots, time_saved)
+            self.month_sketch.add(self.month_co2[touched])
+
+    def add_trip(self, rider_id, t, co2_saved, time_saved):
+        # one trip, as it finishes
+        t = pd.Timestamp(t)
+        month = t.year * 12 + t.month - 1
+        with self.lock:
+            self._roll_month(month)
+            slot = self.slots.get(rider_id)
+            if slot is None:
+                slot = int(self._slots([rider_id])[0])
+            self.total_rides[slot] += 1
+            self.total_co2[slot] += co2_saved
+            self.total_time[slot] += time_saved
+            if month != self.month:
+                return
+            if self.month_rides[slot]:
+                self.month_sketch.add_one(self.month_co2[slot], -1)
+            self.month_rides[slot] += 1
+            self.month_co2[slot] += co2_saved
+            self.month_time[slot] += time_saved
+            self.month_sketch.add_one(self.month_co2[slot])
+
+    def merge(self, other):
+        # add another index's riders; its monthly totals count if it is at this
+        # index's month or later (a later month starts the monthly totals over)
+        n = len(other)
+        if not n:
+            return
+        with self.lock:
+            if other.month is not None:
+                self._roll_month(other.month)
+            slots = self._slots(other.rider_ids)
+            for name in ('total_rides', 'total_co2', 'total_time'):
+                getattr(self, name)[slots] += getattr(other, name)[:n]
+            if other.month != self.month:
+                return
+            ranked = slots[self.month_rides[slots] > 0]
+            self.month_sketch.remove(self.month_co2[ranked])
+            for name in ('month_rides', 'month_co2', 'month_time'):
+                getattr(self, name)[slots] += getattr(other, name)[:n]
+            self.month_sketch.add(self.month_co2[slots[self.month_rides[slots] > 0]])
+
+    def rider(self, rider_id):
+        slot = self.slots.get(rider_id)
+        if slot is None:
+            return None
+        rider = {name: float(getattr(self, name)[slot]) for name in FIELDS}
+        # share of this month's riders who saved less
+        rider['month_percentile'] = self.month_sketch.rank(rider['month_co2']) * 100 if rider['month_rides'] else 0.0
+        return rider
+
+    def percentile(self, q):
+        # this month's CO2 saved at quantile q among riders
+        return self.month_sketch.quantile(q)
+
+    def save(self, path=None):
+        path = path or index_file()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        n = len(self.rider_ids)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, rider_ids=np.array(self.rider_ids, dtype=str),
+                 month=self.month if self.month is not None else -1,
+                 **{name: getattr(self, name)[:n] for name in FIELDS})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=None):
+        with np.load(path or index_file()) as f:
+            index = cls(max(INITIAL_CAPACITY, len(f['rider_ids'])))
+            index.rider_ids = f['rider_ids'].tolist()
+            index.slots = {rider_id: slot for slot, rider_id in enumerate(index.rider_ids)}
+            index.month = int(f['month']) if int(f['month']) >= 0 else None
+            n = len(index.rider_ids)
+            for name in FIELDS:
+                getattr(index, name)[:n] = f[name]
+        index.month_sketch.add(index.month_co2[:n][index.month_rides[:n] > 0])
+        return index
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_rider_index():
+    # the saved index if there is one, otherwise an empty one; reloaded when the file is rewritten
+    global _index
+    path = index_file()
+    mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+    with _lock:
+        if _index is None or _index[0] != mtime:
+            _index = (mtime, RiderIndex.load(path) if mtime is not None else RiderIndex())
+    return _index[1]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the per-rider contribution index from trip CSVs with a %s column'
+                                                 % RIDER_COLUMN)
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    # the same per-file checkpoints the supervisor's ingest keeps
+    from trip_aggregates import ingest
+    ingest(args.files)
+    index = get_rider_index()
+    print(len(index), 'riders, median this month', round(index.percentile(0.5), 3), 'kg')
@@ -1,26 +1,11 @@
 #!/bin/bash
 
-ctrl_c() {
-    echo "Ctrl+C received. Terminating both processes..."
-    # Terminate both Python scripts by sending SIGINT
-    kill -SIGINT $pid1 $pid2
-    exit 1
-}
-
-# Trap Ctrl+C and call the ctrl_c function
-trap ctrl_c SIGINT
-
-# Run the first Python script (web app) in the background
-python3 -m streamlit run MainPage.py &
-
-pid1=$!
-
-# Run the second Python script (infinite poller) in the background
-python3 poll.py &
-
-pid2=$!
-
-# Wait for both processes to finish
-wait $pid1 $pid2
-
-echo "Done."
\ No newline at end of file
+# Runs the poller pipeline (fetcher and estimator workers) and the dashboard
+# as supervised processes; see supervisor.py. Extra arguments are passed on,
+# e.g. ./run.sh --systems bkn,bay --workers 2
+# Each system's estimation runs in a single process (its trips are matched
+# against one bike pool), so --workers beyond the number of systems is unused.
+# With GOOGLE_MAPS_API_KEY set, a fill stage also fills the station matrix from
+# Maps, --fill-pairs pairs a minute (0 disables it).
+# Ctrl+C stops every process.
+exec python3 supervisor.py "$@"
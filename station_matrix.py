@@ -0,0 +1,450 @@
+import atexit
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from estimate_cache import QUANTUM, cache_key, get_estimate_cache, quantize
+
+# Persistent station-to-station matrix of Maps results, so the hot path never
+# has to wait on a network round trip. Layout on disk:
+#   stations.json  - station ids and coordinates, in matrix index order
+#   matrix.npy     - float32 (4, N, N) memmap, NaN where a pair is not filled yet
+#                    and FAILED where Maps has no route for it
+#   pending.sqlite - station id pairs that missed on lookup in any process,
+#                    filled first by the next fill run, and off-grid trips
+#                    (an end further than MAX_SNAP_KM from any station) that
+#                    missed in the estimate cache, by quantized coordinates
+#
+# Off-grid trips have no matrix cell; their Maps results live in the shared
+# estimate cache, which estimate and estimate_many read before falling back.
+
+MATRIX_DIR = './data/station_matrix'
+
+BIKE_DISTANCE, DRIVE_DISTANCE, BIKE_TIME, DRIVE_TIME = range(4)
+# distances stored in km, times stored in minutes
+FIELDS = ('bike_distance', 'drive_distance', 'bike_time', 'drive_time')
+
+# street distance is longer than the straight line between two points
+DETOUR_FACTOR = 1.5
+# average trip length: 12 minutes, 1.75 miles = 2.8 km -> ~14 km/h
+AVG_BIKE_KMH = 14.0
+# average midtown driving speed
+AVG_DRIVE_KMH = 12.0
+
+# coordinates further than this from any station are not snapped
+MAX_SNAP_KM = 0.25
+
+# stored in every field of a pair whose Maps element was not OK (e.g. ZERO_RESULTS),
+# so it falls back to the estimate without being requested again
+FAILED = -1.0
+
+# seconds between writes of new lookup misses to pending.sqlite
+PENDING_SAVE_INTERVAL = 30.0
+
+# the supervised fill stage requests at most FILL_PAIRS pairs (two Maps elements
+# each) every FILL_INTERVAL seconds, which caps its Maps usage
+FILL_PAIRS = 250
+FILL_INTERVAL = 60.0
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def element_values(bike, drive):
+    # a matrix row from a pair's bicycling and driving Maps elements
+    if bike.get('status') != 'OK' or drive.get('status') != 'OK':
+        return (FAILED,) * len(FIELDS)
+    return (bike['distance']['value'] / 1000, drive['distance']['value'] / 1000,
+            bike['duration']['value'] / 60, drive['duration']['value'] / 60)
+
+
+def fallback_estimate(straight_km):
+    # estimate (bike km, drive km, bike min, drive min) from the straight-line distance
+    street_km = straight_km * DETOUR_FACTOR
+    return (street_km, street_km, street_km / AVG_BIKE_KMH * 60, street_km / AVG_DRIVE_KMH * 60)
+
+
+class StationMatrix:
+    def __init__(self, station_ids, lats, lngs, path=MATRIX_DIR, cache=None):
+        self.path = path
+        # the estimate cache for off-grid trips, the shared one if None
+        self.cache = cache
+        self.station_ids = [str(station_id) for station_id in station_ids]
+        self.index = {station_id: i for i, station_id in enumerate(self.station_ids)}
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self._cos_lat = np.cos(np.radians(self.lats.mean())) if len(self.lats) else 1.0
+
+        # pairs and off-grid trips that missed on lookup since the last save_pending
+        self.pending = {}
+        self.pending_offgrid = {}
+        self._pending_saved = time.monotonic()
+
+        self.values = self._open_matrix()
+
+    @classmethod
+    def from_stations_df(cls, station_df=None, path=MATRIX_DIR, cache=None):
+        if station_df is None:
+            from csp_bike import get_stations_df
+            station_df = get_stations_df()
+        return cls(station_df['station_id'], station_df['lat'], station_df['lon'], path=path, cache=cache)
+
+    def _estimate_cache(self):
+        return self.cache if self.cache is not None else get_estimate_cache()
+
+    def _open_matrix(self):
+        os.makedirs(self.path, exist_ok=True)
+        n = len(self.station_ids)
+        stations_file = os.path.join(self.path, 'stations.json')
+        matrix_file = os.path.join(self.path, 'matrix.npy')
+
+        old_ids = None
+        if os.path.exists(stations_file) and os.path.exists(matrix_file):
+            with open(stations_file, 'r') as f:
+                old_ids = json.load(f)['station_ids']
+            if old_ids == self.station_ids:
+                return np.load(matrix_file, mmap_mode='r+')
+
+        # station list changed (or first run): build a new matrix and carry over
+        # every pair we already paid for
+        # per-process temp names, two processes may rebuild at the same time
+        tmp_file = '%s.%d.tmp' % (matrix_file, os.getpid())
+        values = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(len(FIELDS), n, n))
+        values[:] = np.nan
+        if old_ids is not None:
+            old_values = np.load(matrix_file, mmap_mode='r')
+            old_pos = np.array([self.index.get(station_id, -1) for station_id in old_ids])
+            keep_old = np.flatnonzero(old_pos >= 0)
+            keep_new = old_pos[keep_old]
+            for field in range(len(FIELDS)):
+                values[field][np.ix_(keep_new, keep_new)] = old_values[field][np.ix_(keep_old, keep_old)]
+            del old_values
+        values.flush()
+        del values
+        os.replace(tmp_file, matrix_file)
+
+        tmp_file = '%s.%d.tmp' % (stations_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({
+                'station_ids': self.station_ids,
+                'lats': self.lats.tolist(),
+                'lngs': self.lngs.tolist(),
+            }, f)
+        os.replace(tmp_file, stations_file)
+
+        return np.load(matrix_file, mmap_mode='r+')
+
+    def snap(self, lat, lng, max_km=MAX_SNAP_KM):
+        # index of the nearest station to (lat, lng), or -1 if none is close enough
+        if not len(self.station_ids):
+            return -1
+        # equirectangular projection is plenty accurate at city scale
+        dx = (self.lngs - lng) * self._cos_lat
+        dy = self.lats - lat
+        sq_dist = dx * dx + dy * dy
+        i = int(np.argmin(sq_dist))
+        if np.sqrt(sq_dist[i]) * np.radians(1) * EARTH_RADIUS_KM > max_km:
+            return -1
+        return i
+
+    def snap_many(self, lats, lngs, max_km=MAX_SNAP_KM, chunk_size=4096):
+        # vectorized snap: station index per coordinate, -1 where none is close enough
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        if not len(self.station_ids):
+            return np.full(len(lats), -1, dtype=np.int64)
+
+        # trips start and end at a few thousand distinct points, so only snap those
+        coords, inverse = np.unique(np.stack([lats, lngs], axis=1), axis=0, return_inverse=True)
+        nearest = np.empty(len(coords), dtype=np.int64)
+        nearest_sq = np.empty(len(coords), dtype=np.float64)
+        for start in range(0, len(coords), chunk_size):
+            chunk = coords[start:start + chunk_size]
+            dx = (self.lngs[None, :] - chunk[:, 1:2]) * self._cos_lat
+            dy = self.lats[None, :] - chunk[:, 0:1]
+            sq_dist = dx * dx + dy * dy
+            nearest[start:start + chunk_size] = np.argmin(sq_dist, axis=1)
+            nearest_sq[start:start + chunk_size] = sq_dist[np.arange(len(chunk)), nearest[start:start + chunk_size]]
+
+        too_far = np.sqrt(nearest_sq) * np.radians(1) * EARTH_RADIUS_KM > max_km
+        nearest[too_far | np.isnan(nearest_sq)] = -1
+        return nearest[inverse.reshape(-1)]
+
+    def estimate_many(self, ori_lat, ori_lng, dest_lat, dest_lng):
+        # (4, M) array of bike km, drive km, bike min, drive min for M trips,
+        # from the matrix where filled, the estimate cache for off-grid trips
+        # and the haversine fallback elsewhere
+        from distance import estimate_lat_lng_to_km_batch
+
+        ori_lat, ori_lng = np.asarray(ori_lat, dtype=np.float64), np.asarray(ori_lng, dtype=np.float64)
+        dest_lat, dest_lng = np.asarray(dest_lat, dtype=np.float64), np.asarray(dest_lng, dtype=np.float64)
+        i = self.snap_many(ori_lat, ori_lng)
+        j = self.snap_many(dest_lat, dest_lng)
+        found = (i >= 0) & (j >= 0)
+
+        result = np.empty((len(FIELDS), len(i)), dtype=np.float64)
+        result[:, found] = self.values[:, i[found], j[found]]
+        if not found.all():
+            offgrid = ~found
+            result[:, offgrid] = self.cached_estimates(ori_lat[offgrid], ori_lng[offgrid],
+                                                       dest_lat[offgrid], dest_lng[offgrid])
+
+        unfilled = np.isnan(result).any(axis=0)
+        missing = unfilled | (result[0] == FAILED)
+        if missing.any():
+            straight_km = estimate_lat_lng_to_km_batch(ori_lat[missing], ori_lng[missing],
+                                                       dest_lat[missing], dest_lng[missing])
+            result[:, missing] = fallback_estimate(straight_km)
+            for pair in zip(i[unfilled & found].tolist(), j[unfilled & found].tolist()):
+                self._add_pending(pair)
+        return result
+
+    def cached_estimates(self, ori_lat, ori_lng, dest_lat, dest_lng):
+        # (4, M) Maps results for M off-grid trips from the estimate cache, NaN
+        # where it has none yet; those are queued for the fill stage
+        result = np.full((len(FIELDS), len(ori_lat)), np.nan)
+        trips = [quantize(*origin) + quantize(*destination) for origin, destination in
+                 zip(zip(np.asarray(ori_lat).tolist(), np.asarray(ori_lng).tolist()),
+                     zip(np.asarray(dest_lat).tolist(), np.asarray(dest_lng).tolist()))]
+        elements = self._estimate_cache().get_many([trip + (mode,) for trip in trips
+                                                    for mode in ('bicycling', 'driving')])
+        for k, trip in enumerate(trips):
+            bike, drive = elements.get(trip + ('bicycling',)), elements.get(trip + ('driving',))
+            if bike is None or drive is None:
+                self._add_pending_offgrid(trip)
+            else:
+                result[:, k] = element_values(bike, drive)
+        return result
+
+    def _lookup(self, i, j):
+        row = self.values[:, i, j]
+        if np.isnan(row).any():
+            self._add_pending((i, j))
+            return None
+        if row[0] == FAILED:
+            return None
+        return tuple(float(value) for value in row)
+
+    def lookup(self, ori_lat, ori_lng, dest_lat, dest_lng):
+        # (bike km, drive km, bike min, drive min) from the matrix, or None if the pair is not filled
+        i = self.snap(ori_lat, ori_lng)
+        j = self.snap(dest_lat, dest_lng)
+        if i < 0 or j < 0:
+            return None
+        return self._lookup(i, j)
+
+    def estimate(self, ori_lat, ori_lng, dest_lat, dest_lng):
+        # O(1) lookup, the estimate cache for off-grid trips, and haversine x
+        # detour factor for anything not filled yet
+        i = self.snap(ori_lat, ori_lng)
+        j = self.snap(dest_lat, dest_lng)
+        if i >= 0 and j >= 0:
+            found = self._lookup(i, j)
+        else:
+            row = self.cached_estimates([ori_lat], [ori_lng], [dest_lat], [dest_lng])[:, 0]
+            found = None if np.isnan(row).any() or row[0] == FAILED else tuple(float(value) for value in row)
+        if found is not None:
+            return found
+        from distance import estimate_lat_lng_to_km
+        return fallback_estimate(estimate_lat_lng_to_km(ori_lat, ori_lng, dest_lat, dest_lng))
+
+    def _pending_db(self):
+        conn = sqlite3.connect(os.path.join(self.path, 'pending.sqlite'), timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS pending (origin_id TEXT, destination_id TEXT, '
+                     'PRIMARY KEY (origin_id, destination_id)) WITHOUT ROWID')
+        conn.execute('CREATE TABLE IF NOT EXISTS pending_offgrid (ori_lat INTEGER, ori_lng INTEGER, '
+                     'dest_lat INTEGER, dest_lng INTEGER, '
+                     'PRIMARY KEY (ori_lat, ori_lng, dest_lat, dest_lng)) WITHOUT ROWID')
+        return conn
+
+    def _add_pending(self, pair):
+        self.pending[pair] = None
+        if time.monotonic() - self._pending_saved >= PENDING_SAVE_INTERVAL:
+            self.save_pending()
+
+    def _add_pending_offgrid(self, trip):
+        # trip: quantized (ori_lat, ori_lng, dest_lat, dest_lng)
+        self.pending_offgrid[trip] = None
+        if time.monotonic() - self._pending_saved >= PENDING_SAVE_INTERVAL:
+            self.save_pending()
+
+    def save_pending(self):
+        # hand this process's lookup misses to whichever process runs the next fill
+        self._pending_saved = time.monotonic()
+        if not self.pending and not self.pending_offgrid:
+            return
+        rows = [(self.station_ids[i], self.station_ids[j]) for i, j in self.pending]
+        conn = self._pending_db()
+        try:
+            conn.executemany('INSERT OR IGNORE INTO pending VALUES (?, ?)', rows)
+            conn.executemany('INSERT OR IGNORE INTO pending_offgrid VALUES (?, ?, ?, ?)', list(self.pending_offgrid))
+        finally:
+            conn.close()
+        self.pending.clear()
+        self.pending_offgrid.clear()
+
+    def load_pending(self):
+        # pairs missed by any process, by current matrix index
+        conn = self._pending_db()
+        try:
+            rows = conn.execute('SELECT origin_id, destination_id FROM pending').fetchall()
+        finally:
+            conn.close()
+        pairs = dict.fromkeys((self.index[origin_id], self.index[destination_id]) for origin_id, destination_id in rows
+                              if origin_id in self.index and destination_id in self.index)
+        pairs.update(self.pending)
+        return list(pairs)
+
+    def load_pending_offgrid(self, limit=None):
+        # off-grid trips missed by any process, as quantized coordinates
+        conn = self._pending_db()
+        try:
+            rows = conn.execute('SELECT * FROM pending_offgrid LIMIT ?', (-1 if limit is None else limit,)).fetchall()
+        finally:
+            conn.close()
+        trips = dict.fromkeys(map(tuple, rows))
+        trips.update(self.pending_offgrid)
+        return list(trips)[:limit]
+
+    def _remove_pending(self, pairs):
+        for pair in pairs:
+            self.pending.pop(pair, None)
+        conn = self._pending_db()
+        try:
+            conn.executemany('DELETE FROM pending WHERE origin_id = ? AND destination_id = ?',
+                             [(self.station_ids[i], self.station_ids[j]) for i, j in pairs])
+        finally:
+            conn.close()
+
+    def _remove_pending_offgrid(self, trips):
+        for trip in trips:
+            self.pending_offgrid.pop(trip, None)
+        conn = self._pending_db()
+        try:
+            conn.executemany('DELETE FROM pending_offgrid WHERE ori_lat = ? AND ori_lng = ? AND dest_lat = ? '
+                             'AND dest_lng = ?', trips)
+        finally:
+            conn.close()
+
+    def is_filled(self, i, j):
+        # filled from Maps, or marked FAILED
+        return not np.isnan(self.values[:, i, j]).any()
+
+    def unfilled_pairs(self, limit=None):
+        # pending pairs first, then the rest of the matrix in row order
+        pairs = [pair for pair in self.load_pending() if not self.is_filled(*pair)]
+        if limit is not None and len(pairs) >= limit:
+            return pairs[:limit]
+        seen = set(pairs)
+        missing = np.isnan(self.values).any(axis=0)
+        for i in np.flatnonzero(missing.any(axis=1)):
+            for j in np.flatnonzero(missing[i]):
+                pair = (int(i), int(j))
+                if pair in seen:
+                    continue
+                pairs.append(pair)
+                if limit is not None and len(pairs) >= limit:
+                    return pairs
+        return pairs
+
+    def fill(self, pairs, batch_size=500, batcher=None, cache=None):
+        # query Maps for each (origin index, destination index) pair; elements
+        # already in the shared estimate cache are not requested again, the
+        # batcher packs the rest into maximal matrix requests, and we flush to
+        # disk after every batch_size pairs so progress survives an interrupted run
+        pairs = list(pairs)
+        filled = 0
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            endpoints = [((float(self.lats[i]), float(self.lngs[i])), (float(self.lats[j]), float(self.lngs[j])))
+                         for i, j in batch]
+            done = []
+            for (i, j), elements in zip(batch, self._fetch(endpoints, batcher, cache)):
+                if elements is None:
+                    # transport error, left NaN for the next run
+                    continue
+                done.append((i, j))
+                row = self.values[:, i, j] = element_values(*elements)
+                filled += row[0] != FAILED
+            self.values.flush()
+            self._remove_pending(done)
+        return filled
+
+    def fill_offgrid(self, trips, batch_size=500, batcher=None, cache=None):
+        # fetch Maps results for quantized off-grid trips into the estimate
+        # cache, where estimate and estimate_many find them
+        trips = list(trips)
+        filled = 0
+        for start in range(0, len(trips), batch_size):
+            batch = trips[start:start + batch_size]
+            endpoints = [((ori_lat * QUANTUM, ori_lng * QUANTUM), (dest_lat * QUANTUM, dest_lng * QUANTUM))
+                         for ori_lat, ori_lng, dest_lat, dest_lng in batch]
+            done = [trip for trip, elements in zip(batch, self._fetch(endpoints, batcher, cache)) if elements is not None]
+            self._remove_pending_offgrid(done)
+            filled += len(done)
+        return filled
+
+    def _fetch(self, endpoints, batcher=None, cache=None):
+        # (bicycling, driving) Maps elements per (origin, destination), None
+        # where the transport failed; cached elements are not requested again
+        if batcher is None:
+            from distance import get_maps_batcher
+            batcher = get_maps_batcher()
+        if cache is None:
+            cache = self._estimate_cache()
+        lookups = [(origin, destination, mode) for origin, destination in endpoints
+                   for mode in ('bicycling', 'driving')]
+        elements = cache.prefetch(lookups, batcher.try_lookup_many)
+        result = []
+        for k in range(len(endpoints)):
+            bike = elements.get(cache_key(*lookups[2 * k]))
+            drive = elements.get(cache_key(*lookups[2 * k + 1]))
+            result.append(None if bike is None or drive is None else (bike, drive))
+        return result
+
+    def fill_pending(self, max_pairs=1000, batch_size=500, batcher=None):
+        # off-grid misses take up to half of max_pairs, station pairs the rest
+        offgrid = self.load_pending_offgrid(limit=max_pairs // 2)
+        filled = self.fill_offgrid(offgrid, batch_size=batch_size, batcher=batcher) if offgrid else 0
+        return filled + self.fill(self.unfilled_pairs(limit=max_pairs - len(offgrid)), batch_size=batch_size,
+                                  batcher=batcher)
+
+    def coverage(self):
+        # share of pairs filled or marked FAILED
+        return float((~np.isnan(self.values).any(axis=0)).mean()) if len(self.station_ids) else 0.0
+
+
+def run_filler(max_pairs=FILL_PAIRS, interval=FILL_INTERVAL):
+    # fill pending, then unfilled, pairs every `interval` seconds, for the supervisor
+    matrix = get_station_matrix()
+    while True:
+        matrix.fill_pending(max_pairs=max_pairs)
+        time.sleep(interval)
+
+
+_station_matrix = None
+
+
+def get_station_matrix():
+    global _station_matrix
+    if _station_matrix is None:
+        _station_matrix = StationMatrix.from_stations_df()
+        # misses since the last periodic save
+        atexit.register(_station_matrix.save_pending)
+    return _station_matrix
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Incrementally fill the station distance/time matrix')
+    parser.add_argument('--pairs', type=int, default=1000, help='number of station pairs to fill this run')
+    parser.add_argument('--batch-size', type=int, default=500, help='pairs written to disk per batch')
+    args = parser.parse_args()
+
+    matrix = get_station_matrix()
+    filled = matrix.fill_pending(max_pairs=args.pairs, batch_size=args.batch_size)
+    print('filled', filled, 'pairs, coverage', round(matrix.coverage() * 100, 3), '%')
@@ -0,0 +1,263 @@
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from datetime import timedelta
+
+from csp_bike.endpoints import DEFAULT_SYSTEM
+from csp_bike.metrics import metrics, METRICS_DIR
+
+# Runs the app as supervised processes, replacing run.sh's two background jobs:
+#
+#   fetcher        polls station_status for every system and queues snapshots
+#   estimator-N    the station delta / trip estimation / CO2 pipeline for its
+#                  share of the systems, fed from its own queue
+#   aggregates     checkpoints the trip aggregates for new and changed trip files
+#                  (trip_aggregates.py), so the dashboard only loads them
+#   fill           fills the station matrix from Maps, pairs the estimators
+#                  missed on first, a rate-limited batch at a time (station_matrix.py)
+#   dashboard      streamlit run MainPage.py
+#
+# A stage that exits is restarted with exponential backoff. The fetcher and
+# estimators also beat a shared heartbeat from inside their csp realtime loop,
+# so a stage whose loop is blocked (a hung fetch, a slow Maps call) is restarted
+# even though its process is still alive. Queues are bounded: when an estimator
+# falls behind, the oldest snapshots are dropped and whatever is still waiting
+# is coalesced to the newest per system (see csp_bike/pipeline.py).
+#
+#   python supervisor.py --systems bkn,bay --workers 2
+
+POLL_INTERVAL = timedelta(seconds=28)
+HEARTBEAT_INTERVAL = timedelta(seconds=2)
+# a loop that hasn't beaten for this long is restarted
+STALL_TIMEOUT = timedelta(seconds=90)
+# time allowed for a stage to import csp, fetch metadata and beat for the first time
+STARTUP_TIMEOUT = timedelta(seconds=180)
+# snapshots waiting per system before the oldest are dropped
+QUEUE_SIZE = 2
+RESTART_BACKOFF = 1.0
+MAX_BACKOFF = 300.0
+# a stage that ran this long before exiting starts over from RESTART_BACKOFF
+STABLE_AFTER = 60.0
+# seconds between checks of the stages
+CHECK_INTERVAL = 1.0
+# grace period for a stage to stop on SIGINT before it is killed
+STOP_TIMEOUT = 10.0
+METRICS_FILE = os.path.join(METRICS_DIR, "supervisor.json")
+
+log = logging.getLogger(__name__)
+
+
+def run_fetcher(systems, queues, interval, archive_file, beat):
+    import csp
+    import poll
+    from csp_bike import start_metadata_refresh
+
+    start_metadata_refresh(systems)
+    csp.run(poll.fetcher_graph, systems, interval, queues, beat, HEARTBEAT_INTERVAL, archive_file,
+            os.path.join(METRICS_DIR, "fetcher.json"), realtime=True)
+
+
+def run_estimator(index, systems, queue, beat):
+    import csp
+    import poll
+    from csp_bike import start_metadata_refresh
+
+    start_metadata_refresh(systems)
+    csp.run(poll.estimator_graph, systems, queue, beat, HEARTBEAT_INTERVAL,
+            os.path.join(METRICS_DIR, "estimator-%d.json" % index), realtime=True)
+
+
+def run_aggregates():
+    from trip_aggregates import run_ingester
+
+    run_ingester()
+
+
+def run_fill(max_pairs):
+    from station_matrix import run_filler
+
+    run_filler(max_pairs)
+
+
+def run_dashboard(args):
+    # become streamlit, so the supervisor tracks (and signals) the server itself
+    os.execv(sys.executable, [sys.executable, "-m", "streamlit", "run", "MainPage.py"] + list(args))
+
+
+class Stage:
+    def __init__(self, name, target, args=(), beat=None, stall_timeout=STALL_TIMEOUT,
+                 startup_timeout=STARTUP_TIMEOUT):
+        self.name = name
+        self.target = target
+        self.args = args
+        # shared time of the last heartbeat, None for stages without one
+        self.beat = beat
+        self.stall_timeout = stall_timeout.total_seconds()
+        self.startup_timeout = startup_timeout.total_seconds()
+        self.process = None
+        self.started = None
+        self.failures = 0
+        self.restart_at = None
+
+    def start(self, context):
+        if self.beat is not None:
+            # zero until the stage has imported csp, built its graph and beaten once
+            self.beat.value = 0.0
+        self.process = context.Process(target=self.target, args=self.args, name=self.name)
+        self.process.start()
+        self.started = time.time()
+        self.restart_at = None
+
+    def heartbeat_age(self):
+        # None for stages without a heartbeat and while starting
+        if self.beat is None or not self.beat.value:
+            return None
+        return time.time() - self.beat.value
+
+    def check(self):
+        # why the stage needs a restart, None while it is healthy
+        if not self.process.is_alive():
+            return "exited with %s" % self.process.exitcode
+        if self.beat is None:
+            return None
+        if not self.beat.value:
+            if time.time() - self.started > self.startup_timeout:
+                return "did not start in %.0fs" % self.startup_timeout
+            return None
+        age = self.heartbeat_age()
+        if age > self.stall_timeout:
+            return "stalled for %.0fs" % age
+        return None
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        if self.process is None or not self.process.is_alive():
+            return
+        # SIGINT first, so csp stops its graph and closes the archive
+        os.kill(self.process.pid, signal.SIGINT)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class Supervisor:
+    def __init__(self, stages, queues, context):
+        self.stages = stages
+        # {name: queue}, for depth metrics
+        self.queues = queues
+        self.context = context
+        self._running = False
+
+    def run(self):
+        from csp_bike.pipeline import queue_depth
+
+        self._running = True
+        signal.signal(signal.SIGTERM, self._shutdown)
+        for stage in self.stages:
+            stage.start(self.context)
+        try:
+            while self._running:
+                now = time.time()
+                for stage in self.stages:
+                    if stage.restart_at is not None:
+                        if now >= stage.restart_at:
+                            log.info("restarting %s", stage.name)
+                            stage.start(self.context)
+                        continue
+                    reason = stage.check()
+                    if reason is not None:
+                        self._schedule_restart(stage, reason)
+                    age = stage.heartbeat_age()
+                    if stage.beat is not None:
+                        metrics.gauge("supervisor.%s.heartbeat_age" % stage.name, age and round(age, 3))
+                for name, queue in self.queues.items():
+                    depth = queue_depth(queue)
+                    if depth is not None:
+                        metrics.gauge("supervisor.%s.queue_depth" % name, depth)
+                metrics.maybe_dump(METRICS_FILE)
+                time.sleep(CHECK_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def _schedule_restart(self, stage, reason):
+        log.warning("%s %s", stage.name, reason)
+        metrics.count("supervisor.%s.restarts" % stage.name)
+        stage.stop()
+        if time.time() - stage.started >= STABLE_AFTER:
+            stage.failures = 0
+        stage.failures += 1
+        stage.restart_at = time.time() + min(RESTART_BACKOFF * 2 ** (stage.failures - 1), MAX_BACKOFF)
+
+    def _shutdown(self, signum, frame):
+        self._running = False
+
+    def stop(self):
+        log.info("stopping %s", ", ".join(stage.name for stage in self.stages))
+        for stage in reversed(self.stages):
+            stage.stop()
+        metrics.dump_json(METRICS_FILE)
+
+
+def build(systems, workers, interval=POLL_INTERVAL, archive_file="", dashboard=True, dashboard_args=(),
+          aggregates=True, fill_pairs=None):
+    # spawn, not fork: children import csp themselves instead of inheriting a parent with threads
+    context = multiprocessing.get_context("spawn")
+    # at most one estimator per system: a system's returns are matched against a
+    # single bike pool, so its pipeline cannot be split by station across processes
+    workers = max(1, min(workers, len(systems)))
+    stages = []
+    queues = {}
+    owner = {}
+    for index in range(workers):
+        owned = systems[index::workers]
+        name = "estimator-%d" % index
+        queue = queues[name] = context.Queue(maxsize=QUEUE_SIZE * len(owned))
+        owner.update((system, queue) for system in owned)
+        beat = context.Value("d", 0.0)
+        stages.append(Stage(name, run_estimator, (index, owned, queue, beat), beat=beat))
+    beat = context.Value("d", 0.0)
+    stages.insert(0, Stage("fetcher", run_fetcher, (systems, owner, interval, archive_file, beat), beat=beat))
+    if aggregates:
+        stages.append(Stage("aggregates", run_aggregates))
+    if fill_pairs:
+        stages.append(Stage("fill", run_fill, (fill_pairs,)))
+    if dashboard:
+        stages.append(Stage("dashboard", run_dashboard, (list(dashboard_args),)))
+    return Supervisor(stages, queues, context)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from csp_bike.archive import ARCHIVE_FILE
+    from station_matrix import FILL_PAIRS
+
+    parser = argparse.ArgumentParser(description="Run the poller pipeline and the dashboard as supervised processes",
+                                     epilog="Other arguments are passed on to streamlit run.")
+    parser.add_argument("--systems", default=DEFAULT_SYSTEM, help="comma-separated GBFS system ids, e.g. bkn,bay,chi")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="estimator processes, each owns a share of the systems; capped at the number "
+                             "of systems (default: one per core)")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL.total_seconds(),
+                        help="seconds between station_status snapshots")
+    parser.add_argument("--archive", default=ARCHIVE_FILE, help="station_status archive to record to, empty to disable")
+    parser.add_argument("--no-dashboard", action="store_true")
+    parser.add_argument("--no-aggregates", action="store_true", help="don't ingest trip files for the dashboard's totals")
+    parser.add_argument("--fill-pairs", type=int, default=FILL_PAIRS,
+                        help="station matrix pairs requested from Maps per fill run, 0 to disable the fill stage")
+    args, dashboard_args = parser.parse_known_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    fill_pairs = args.fill_pairs
+    if fill_pairs and "GOOGLE_MAPS_API_KEY" not in os.environ:
+        log.warning("GOOGLE_MAPS_API_KEY is not set, not filling the station matrix")
+        fill_pairs = 0
+    supervisor = build(args.systems.split(","), args.workers, timedelta(seconds=args.interval), args.archive,
+                       dashboard=not args.no_dashboard, dashboard_args=dashboard_args,
+                       aggregates=not args.no_aggregates, fill_pairs=fill_pairs)
+    supervisor.run()
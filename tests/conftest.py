@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# the app's modules live at the repository root, next to csp_bike
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def trip_file(tmp_path, monkeypatch):
+    # a small monthly trip CSV, rows out of time order, with its own columnar cache dir
+    import trip_store
+    from benchmarks import synthetic
+
+    monkeypatch.setattr(trip_store, 'CACHE_DIR', str(tmp_path / 'cache'))
+    trip_store.clear_cache()
+    df = synthetic.make_trips(2000, synthetic.make_stations(50)).sample(frac=1, random_state=0)
+    path = tmp_path / '202403-citibike-tripdata_1.csv'
+    df.to_csv(path, index=False, date_format='%Y-%m-%d %H:%M:%S.%f')
+    yield str(path)
+    trip_store.clear_cache()
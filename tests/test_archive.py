@@ -0,0 +1,99 @@
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from csp_bike import SnapshotArchive, SnapshotWriter
+
+START = datetime(2024, 3, 27, 8, 0)
+STATION_IDS = ['s%d' % i for i in range(12)]
+
+
+def snapshot(k, station_ids):
+    # every station reports a count that depends on the poll, except one that drops out
+    return [
+        {'station_id': station_id, 'station_index': i, 'num_bikes_available': (k + i) % 20,
+         'num_ebikes_available': i % 3, 'num_docks_available': 20 - (k + i) % 20}
+        for i, station_id in enumerate(station_ids) if (k + i) % 5
+    ]
+
+
+def write(path, num_snapshots, station_ids=STATION_IDS, first=0, **kwargs):
+    writer = SnapshotWriter(path, chunk_snapshots=4, **kwargs)
+    for k in range(first, first + num_snapshots):
+        writer.append(START + timedelta(seconds=28 * k), snapshot(k, station_ids), station_ids)
+    writer.close()
+
+
+def bikes_by_station(records):
+    return {record['station_id']: record['num_bikes_available'] for record in records}
+
+
+@pytest.fixture
+def archive_file(tmp_path):
+    path = str(tmp_path / 'status.gbfsarc')
+    write(path, 30)
+    return path
+
+
+def test_read_returns_every_snapshot(archive_file):
+    archive = SnapshotArchive(archive_file)
+    assert len(archive) == 30
+    assert archive.time_range() == (START, START + timedelta(seconds=28 * 29))
+    snapshots = list(archive.read_records())
+    assert [timestamp for timestamp, _ in snapshots] == [START + timedelta(seconds=28 * k) for k in range(30)]
+    for k, (_, records) in enumerate(snapshots):
+        assert bikes_by_station(records) == bikes_by_station(snapshot(k, STATION_IDS))
+
+
+@pytest.mark.parametrize('first, last', [(0, 29), (5, 5), (7, 21), (13, 40)])
+def test_seek_matches_a_filter(archive_file, first, last):
+    archive = SnapshotArchive(archive_file)
+    start, end = START + timedelta(seconds=28 * first - 3), START + timedelta(seconds=28 * last)
+    times = [timestamp for timestamp, _ in archive.read(start, end)]
+    assert times == [START + timedelta(seconds=28 * k) for k in range(first, min(last, 29) + 1)]
+
+
+def test_missing_index_is_rebuilt_from_the_chunks(archive_file):
+    index = SnapshotArchive(archive_file).index
+    os.remove(archive_file + '.idx')
+    rebuilt = SnapshotArchive(archive_file)
+    assert np.array_equal(rebuilt.index, index)
+    assert len(list(rebuilt.read(START + timedelta(seconds=28 * 10)))) == 20
+
+
+def test_appends_survive_reopening_with_a_new_station_order(tmp_path):
+    path = str(tmp_path / 'status.gbfsarc')
+    write(path, 6)
+    # the next writer sees the stations in another order, plus a new one
+    reordered = ['s99'] + STATION_IDS[::-1]
+    write(path, 6, station_ids=reordered, first=6)
+
+    archive = SnapshotArchive(path)
+    assert archive.station_ids == STATION_IDS + ['s99']
+    snapshots = list(archive.read_records())
+    assert len(snapshots) == 12
+    for k, (_, records) in enumerate(snapshots):
+        station_ids = STATION_IDS if k < 6 else reordered
+        assert bikes_by_station(records) == bikes_by_station(snapshot(k, station_ids))
+
+
+def test_buffered_snapshots_are_flushed_on_a_time_bound(tmp_path):
+    path = str(tmp_path / 'status.gbfsarc')
+    writer = SnapshotWriter(path, chunk_snapshots=32, flush_interval=0)
+    writer.append(START, snapshot(0, STATION_IDS), STATION_IDS)
+    # readable before the writer is closed
+    assert len(SnapshotArchive(path)) == 1
+    writer.close()
+
+
+def test_archive_path_and_reader_do_not_import_csp():
+    # the supervisor reads ARCHIVE_FILE without paying for the csp import
+    code = ('import sys; from csp_bike.archive import ARCHIVE_FILE, SnapshotArchive; '
+            'print(any(name.split(".")[0] == "csp" for name in sys.modules))')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == 'False'
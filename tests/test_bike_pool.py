@@ -0,0 +1,63 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import distance
+from bike_pool import BikePool
+
+START = datetime(2024, 3, 27, 8, 0)
+
+
+def random_pool(seed, num_checkouts=300, **kwargs):
+    rng = random.Random(seed)
+    pool = BikePool(**kwargs)
+    for k in range(num_checkouts):
+        lat, lng = rng.uniform(40.63, 40.82), rng.uniform(-74.03, -73.88)
+        pool.check_out('s%d' % k, lat, lng, START + timedelta(seconds=10 * k), rng.randint(1, 3))
+    return pool, rng
+
+
+def brute_force_candidates(pool, lat, lng, now):
+    return sorted(entry_id for entry_id, (_, entry_lat, entry_lng, time, _, _) in pool.entries.items()
+                  if distance.is_trip_possible(entry_lat, entry_lng, lat, lng, time, now))
+
+
+@pytest.mark.parametrize('cell_km', [0.25, 1.0, 5.0])
+def test_candidates_match_a_scan_of_every_checkout(cell_km):
+    pool, rng = random_pool(0, cell_km=cell_km)
+    for minutes in (1, 10, 30, 55):
+        now = START + timedelta(minutes=minutes)
+        for _ in range(20):
+            lat, lng = rng.uniform(40.63, 40.82), rng.uniform(-74.03, -73.88)
+            assert sorted(pool.candidates(lat, lng, now)) == brute_force_candidates(pool, lat, lng, now)
+
+
+def test_empty_pool_has_no_candidates():
+    assert BikePool().candidates(40.75, -73.98, START) == []
+
+
+def test_expire_drops_checkouts_older_than_max_age():
+    pool, _ = random_pool(1, num_checkouts=100, max_age=timedelta(minutes=5))
+    now = START + timedelta(minutes=10)
+    cutoff = now - timedelta(minutes=5)
+    kept = {entry_id: entry[4] for entry_id, entry in pool.entries.items() if entry[3] >= cutoff}
+    dropped = len(pool) - sum(kept.values())
+
+    assert pool.expire(now) == dropped
+    assert set(pool.entries) == set(kept)
+    assert len(pool) == sum(kept.values())
+    # the grid holds exactly the remaining checkouts
+    assert sorted(entry_id for cell in pool.cells.values() for entry_id in cell) == sorted(kept)
+    assert pool.expire(now) == 0
+
+
+def test_take_removes_a_checkout_with_its_last_bike():
+    pool = BikePool()
+    entry_id = pool.check_out('a', 40.75, -73.98, START, 2)
+    assert len(pool) == 2
+    assert pool.take(entry_id) == ('a', 40.75, -73.98, START, 1)
+    assert pool.take(entry_id)[-1] == 0
+    assert len(pool) == 0 and pool.entries == {} and pool.cells == {}
+    # expiring later skips the already removed entry
+    assert pool.expire(START + timedelta(hours=2)) == 0
@@ -0,0 +1,53 @@
+import os
+from collections import defaultdict
+
+import pandas as pd
+
+import trip_store
+from bike_tracking import get_bike_df, load_bike_df
+
+
+def brute_force_net_bikes(df):
+    # station -> [(minute, net change, running net bikes)], one trip at a time
+    changes = defaultdict(lambda: defaultdict(int))
+    for trip in df.itertuples():
+        changes[str(trip.start_station_id)][trip.started_at.round('min')] -= 1
+        changes[str(trip.end_station_id)][trip.ended_at.round('min')] += 1
+    expected = {}
+    for station, by_minute in changes.items():
+        running, rows = 0, []
+        for minute in sorted(by_minute):
+            running += by_minute[minute]
+            rows.append((minute, by_minute[minute], running))
+        expected[station] = rows
+    return expected
+
+
+def as_rows(df_bike):
+    return {
+        str(station): list(zip(group['timestamp'], group['net_change'], group['num_net_bikes']))
+        for station, group in df_bike.groupby('station_id', observed=True, sort=False)
+    }
+
+
+def test_net_bikes_match_a_per_trip_count(trip_file):
+    df = trip_store.load_trips(trip_file).iloc[:500]
+    df_bike = get_bike_df(df, out_file=None)
+    assert as_rows(df_bike) == brute_force_net_bikes(df)
+
+
+def test_processes_give_the_same_result(trip_file):
+    df = trip_store.load_trips(trip_file)
+    serial = get_bike_df(df, out_file=None)
+    parallel = get_bike_df(df, processes=2, out_file=None)
+    pd.testing.assert_frame_equal(parallel.astype({'station_id': str}), serial.astype({'station_id': str}))
+
+
+def test_saved_result_is_reused(trip_file, tmp_path):
+    df = trip_store.load_trips(trip_file)
+    out_file = str(tmp_path / 'bike_net_change.parquet')
+    built = load_bike_df(df, out_file=out_file)
+    assert os.path.exists(out_file)
+    # the saved copy is returned without looking at the trips
+    loaded = load_bike_df(df.iloc[:0], out_file=out_file)
+    pd.testing.assert_frame_equal(loaded.astype({'station_id': str}), built.astype({'station_id': str}))
@@ -0,0 +1,75 @@
+from datetime import datetime
+
+import numpy as np
+
+from co2_channel import Co2Channel
+
+
+def publish(channel, k):
+    channel.publish(1_700_000_000 + 28 * k, float(k), float(k * (k + 1) / 2), k % 7, np.arange(k, k + 5))
+
+
+def test_empty_channel(tmp_path):
+    path = str(tmp_path / 'co2.bin')
+    assert Co2Channel.open(path) is None
+    channel = Co2Channel.create(path, capacity=8, num_stations=16)
+    assert len(channel) == 0
+    assert channel.latest() is None
+    assert channel.latest_total() == 0.0
+    assert len(channel.history()) == 0
+
+
+def test_latest_is_the_last_published_record(tmp_path):
+    path = str(tmp_path / 'co2.bin')
+    writer = Co2Channel.create(path, capacity=8, num_stations=16)
+    reader = Co2Channel.open(path)
+    for k in range(3):
+        publish(writer, k)
+        latest = reader.latest()
+        assert latest['delta_co2'] == k and latest['total_co2'] == k * (k + 1) / 2
+        assert list(latest['station_counts'][:6]) == [k, k + 1, k + 2, k + 3, k + 4, 0]
+    assert reader.latest_total() == 3.0
+    writer.publish(datetime(2024, 3, 27, 8, 0), 0.5, 3.5, 1)
+    assert reader.latest()['timestamp'] == datetime(2024, 3, 27, 8, 0).timestamp()
+
+
+def test_history_wraps_around_the_ring(tmp_path):
+    path = str(tmp_path / 'co2.bin')
+    writer = Co2Channel.create(path, capacity=8, num_stations=16)
+    for k in range(21):
+        publish(writer, k)
+    reader = Co2Channel.open(path)
+    assert len(reader) == 8
+    history = reader.history()
+    # the last capacity records, oldest first
+    assert list(history['delta_co2']) == list(range(13, 21))
+    assert list(reader.history(3)['delta_co2']) == [18, 19, 20]
+    assert reader.latest()['delta_co2'] == 20
+    stations = reader.history(2, with_stations=True)['station_counts']
+    assert list(stations[-1][:5]) == [20, 21, 22, 23, 24]
+
+
+def test_history_survives_a_restart(tmp_path):
+    path = str(tmp_path / 'co2.bin')
+    writer = Co2Channel.create(path, capacity=8, num_stations=16)
+    for k in range(5):
+        publish(writer, k)
+    # a restarted poller reopens the same ring and carries on from its total
+    restarted = Co2Channel.create(path, capacity=8, num_stations=16)
+    assert restarted.latest_total() == 10.0
+    publish(restarted, 5)
+    assert list(Co2Channel.open(path).history()['delta_co2']) == [0, 1, 2, 3, 4, 5]
+    # a different layout starts a new channel
+    assert len(Co2Channel.create(path, capacity=16, num_stations=16)) == 0
+
+
+def test_torn_records_are_dropped(tmp_path):
+    path = str(tmp_path / 'co2.bin')
+    writer = Co2Channel.create(path, capacity=8, num_stations=16)
+    for k in range(4):
+        publish(writer, k)
+    # a writer stopped mid-record leaves its slot's sequence number odd
+    writer.records['seq'][2] += 1
+    reader = Co2Channel.open(path)
+    assert list(reader.history()['delta_co2']) == [0, 1, 3]
+    assert reader.latest()['delta_co2'] == 3
@@ -0,0 +1,30 @@
+import pytest
+
+import distance
+import estimate_cache
+from benchmarks.fake_maps import FakeTransport
+from estimate_cache import EstimateCache
+from maps_batch import DistanceMatrixBatcher
+
+
+@pytest.fixture
+def transport(tmp_path, monkeypatch):
+    transport = FakeTransport()
+    batcher = DistanceMatrixBatcher(transport, requests_per_second=None, backoff=0, linger=0)
+    monkeypatch.setattr(distance, 'maps_batcher', batcher)
+    monkeypatch.setattr(estimate_cache, '_cache', EstimateCache(str(tmp_path / 'estimates.sqlite')))
+    yield transport
+    batcher.close()
+
+
+def test_maps_lookups_go_through_the_batcher_and_the_cache(transport):
+    element = distance.get_maps_element(40.70, -73.95, 40.72, -73.95, 'b')
+    assert element['status'] == 'OK'
+    assert distance.get_distance_by_mode(40.70, -73.95, 40.72, -73.95, 'b') == element['distance']['text']
+    assert distance.get_travel_time_by_mode(40.70, -73.95, 40.72, -73.95, 'bicycling') == element['duration']['text']
+    # one request; the repeats were served from the estimate cache
+    assert transport.client.num_calls == 1
+
+    found = distance.prefetch_maps_elements([((40.70, -73.95), (40.72, -73.95), 'd'),
+                                             ((40.70, -73.95), (40.72, -73.95), 'b')])
+    assert len(found) == 2 and transport.client.num_calls == 2
@@ -0,0 +1,123 @@
+import multiprocessing
+import sqlite3
+
+import estimate_cache
+from estimate_cache import ACCESS_RESOLUTION, EstimateCache, cache_key
+
+
+def key(k, mode='bicycling'):
+    return cache_key((40.7 + k * 1e-3, -73.9), (40.8, -73.95 - k * 1e-3), mode)
+
+
+def element(k):
+    return {'status': 'OK', 'distance': {'value': 1000 + k}, 'duration': {'value': 60 + k}}
+
+
+class Clock:
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_round_trip_and_quantized_keys(tmp_path):
+    cache = EstimateCache(str(tmp_path / 'estimates.sqlite'))
+    cache.put((40.71234, -73.95678), (40.8, -73.9), 'driving', element(1))
+    # within the ~11 m quantum the same entry is found
+    assert cache.get((40.71231, -73.95681), (40.8, -73.9), 'driving') == element(1)
+    assert cache.get((40.71234, -73.95678), (40.8, -73.9), 'bicycling') is None
+    assert len(cache) == 1 and cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_entries_expire_after_the_ttl(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(estimate_cache.time, 'time', clock)
+    cache = EstimateCache(str(tmp_path / 'estimates.sqlite'), ttl=100)
+    cache.put_many([(key(0), element(0))])
+    clock.now += 50
+    cache.put_many([(key(1), element(1))])
+
+    clock.now += 60
+    assert cache.get_many([key(0), key(1)]) == {key(1): element(1)}
+    # an expired entry is fetched again by prefetch and refreshed
+    fetched = []
+    found = cache.prefetch([((40.7, -73.9), (40.8, -73.95), 'bicycling')],
+                           lambda lookups: fetched.extend(lookups) or [element(2)] * len(lookups))
+    assert len(fetched) == 1 and list(found.values()) == [element(2)]
+    assert cache.get_many([key(0)]) == {key(0): element(2)}
+
+    # eviction drops expired rows
+    clock.now += 200
+    assert cache.evict() == 2
+    assert len(cache) == 0
+
+
+def test_eviction_drops_the_least_recently_used(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(estimate_cache.time, 'time', clock)
+    cache = EstimateCache(str(tmp_path / 'estimates.sqlite'), max_entries=10)
+    cache.put_many([(key(k), element(k)) for k in range(10)])
+    assert len(cache) == 10
+
+    # reads refresh the access time once it is ACCESS_RESOLUTION old
+    clock.now += ACCESS_RESOLUTION + 1
+    assert len(cache.get_many([key(k) for k in range(5)])) == 5
+    clock.now += 1
+    cache.put_many([(key(10), element(10))])
+
+    # 11 > 10 entries: evicted down to 5% below the limit, oldest access first
+    assert len(cache) == 9
+    kept = cache.get_many([key(k) for k in range(11)])
+    assert all(key(k) in kept for k in list(range(5)) + [10])
+    assert sum(key(k) not in kept for k in range(5, 10)) == 2
+    assert cache.stats()['evicted'] == 2
+
+
+def write_entries(path, worker, count, max_entries):
+    cache = EstimateCache(path, max_entries=max_entries)
+    for start in range(0, count, 25):
+        cache.put_many([(key(worker * count + k), element(k)) for k in range(start, start + 25)])
+
+
+def test_concurrent_writers_share_one_file(tmp_path):
+    path = str(tmp_path / 'estimates.sqlite')
+    EstimateCache(path)
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=write_entries, args=(path, worker, 200, 10_000)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join(60)
+        assert process.exitcode == 0
+
+    cache = EstimateCache(path)
+    assert len(cache) == 800
+    assert len(cache.get_many([key(k) for k in range(800)])) == 800
+
+
+def test_concurrent_writers_stay_within_max_entries(tmp_path):
+    path = str(tmp_path / 'estimates.sqlite')
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=write_entries, args=(path, worker, 200, 300)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join(60)
+        assert process.exitcode == 0
+
+    # every writer sees the shared count, so whichever one passes the limit evicts
+    assert len(EstimateCache(path, max_entries=300)) <= 300
+
+
+def test_count_is_kept_for_files_without_one(tmp_path):
+    path = str(tmp_path / 'estimates.sqlite')
+    EstimateCache(path).put_many([(key(k), element(k)) for k in range(5)])
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript('DROP TRIGGER estimates_insert; DROP TRIGGER estimates_delete; DROP TABLE entry_count;')
+    conn.close()
+
+    cache = EstimateCache(path)
+    assert len(cache) == 5
+    cache.put_many([(key(k), element(k)) for k in range(3, 8)])
+    assert len(EstimateCache(path)) == 8
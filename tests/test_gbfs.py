@@ -0,0 +1,121 @@
+import json
+from datetime import timedelta
+
+import httpx
+import pytest
+
+from csp_bike import gbfs
+from csp_bike.gbfs import MIN_FETCH_INTERVAL, GBFSClient
+
+URL = "https://gbfs.example/station_status.json"
+NOW = 1_711_500_000.0
+
+
+class Feed:
+    # a GBFS endpoint that answers conditional requests unless ignore_conditional is set
+    def __init__(self, last_updated=NOW, ttl=60, ignore_conditional=False):
+        self.document = {"last_updated": last_updated, "ttl": ttl, "data": {"stations": []}}
+        self.version = 1
+        self.ignore_conditional = ignore_conditional
+        self.requests = []
+
+    def headers(self):
+        return {"ETag": '"v%d"' % self.version, "Last-Modified": "Wed, 27 Mar 2024 00:00:%02d GMT" % self.version}
+
+    def __call__(self, request):
+        self.requests.append(request)
+        headers = self.headers()
+        if not self.ignore_conditional and (request.headers.get("If-None-Match") == headers["ETag"] or
+                                            request.headers.get("If-Modified-Since") == headers["Last-Modified"]):
+            return httpx.Response(304, headers=headers)
+        return httpx.Response(200, headers=headers, content=json.dumps(self.document).encode())
+
+    def update(self, **document):
+        self.document.update(document)
+        self.version += 1
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [NOW]
+    monkeypatch.setattr(gbfs.time, "time", lambda: now[0])
+    return now
+
+
+def client(feed):
+    return GBFSClient(transport=httpx.MockTransport(feed))
+
+
+def test_not_modified_reuses_the_parsed_result(clock):
+    feed = Feed()
+    gbfs_client = client(feed)
+    parsed = []
+
+    def parse(dat):
+        parsed.append(dat)
+        return len(parsed)
+
+    assert gbfs_client.fetch(URL, parse) == (1, True)
+    assert "If-None-Match" not in feed.requests[0].headers
+    assert gbfs_client.fetch(URL, parse) == (1, False)
+    assert feed.requests[1].headers["If-None-Match"] == '"v1"'
+    assert feed.requests[1].headers["If-Modified-Since"] == "Wed, 27 Mar 2024 00:00:01 GMT"
+    assert len(parsed) == 1
+
+    feed.update(last_updated=NOW + 60)
+    assert gbfs_client.fetch(URL, parse) == (2, True)
+    assert gbfs_client.stats() == {"requests": 3, "not_modified": 1, "unchanged": 0}
+
+
+def test_unchanged_body_skips_the_parse(clock, monkeypatch):
+    # a CDN that ignores conditional headers and sends a new ETag with the same body
+    feed = Feed(ignore_conditional=True)
+    gbfs_client = client(feed)
+    decoded = []
+    monkeypatch.setattr(gbfs, "loads", lambda content: decoded.append(content) or json.loads(content))
+
+    first, changed = gbfs_client.fetch(URL)
+    assert changed
+    feed.version += 1
+    again, changed = gbfs_client.fetch(URL)
+    assert again is first and not changed
+    assert len(decoded) == 1
+    assert gbfs_client.stats()["unchanged"] == 1
+    # the new validators are still sent next time
+    gbfs_client.fetch(URL)
+    assert feed.requests[-1].headers["If-None-Match"] == '"v2"'
+
+
+def test_next_fetch_delay_follows_the_ttl(clock):
+    feed = Feed(last_updated=NOW - 20, ttl=60)
+    gbfs_client = client(feed)
+    default = timedelta(seconds=300)
+    assert gbfs_client.next_fetch_delay(URL, default) == default
+
+    gbfs_client.fetch(URL)
+    # fresh until last_updated + ttl
+    assert gbfs_client.next_fetch_delay(URL, default) == timedelta(seconds=40)
+    assert gbfs_client.next_fetch_delay(URL, timedelta(seconds=10)) == timedelta(seconds=10)
+    # the publisher is late: poll every ttl from now
+    clock[0] += 100
+    assert gbfs_client.next_fetch_delay(URL, default) == timedelta(seconds=60)
+    # never faster than MIN_FETCH_INTERVAL
+    clock[0] = NOW + 39.9
+    assert gbfs_client.next_fetch_delay(URL, default) == MIN_FETCH_INTERVAL
+
+
+def test_falls_back_to_http1_without_h2(monkeypatch):
+    clients = []
+
+    class Client(httpx.Client):
+        def __init__(self, http2=False, **kwargs):
+            if http2:
+                raise ImportError("Using http2=True, but the 'h2' package is not installed")
+            clients.append(kwargs)
+            super().__init__(**kwargs)
+
+    monkeypatch.setattr(gbfs.httpx, "Client", Client)
+    feed = Feed()
+    gbfs_client = GBFSClient(http2=True, transport=httpx.MockTransport(feed))
+    assert len(clients) == 1 and clients[0]["headers"]["Accept-Encoding"] == "gzip, deflate"
+    assert gbfs_client.fetch(URL)[0]["ttl"] == 60
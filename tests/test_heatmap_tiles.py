@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from heatmap_tiles import (HeatmapTiles, geohash_centers, geohash_codes, geohash_strings, get_heatmap_tiles,
+                           tiles_cache_file)
+from trip_store import load_trips
+
+# published examples of (lat, lng) and their geohash
+VECTORS = [
+    (42.605, -5.603, 'ezs42'),
+    (57.64911, 10.40744, 'u4pruydqqvj'),
+    (-25.382708, -49.265506, '6gkzwgjzn820'),
+]
+
+
+@pytest.mark.parametrize('lat, lng, expected', VECTORS)
+def test_geohash_known_vectors(lat, lng, expected):
+    precision = len(expected)
+    codes = geohash_codes([lat], [lng], precision)
+    assert geohash_strings(codes, precision).tolist() == [expected]
+    # the cell centre is within half a cell of the point
+    bits = 5 * precision
+    center_lat, center_lng = geohash_centers(codes, precision)
+    assert abs(center_lat[0] - lat) <= 90 / (1 << (bits // 2))
+    assert abs(center_lng[0] - lng) <= 180 / (1 << ((bits + 1) // 2))
+
+
+def test_geohash_decodes_to_the_cell_centre():
+    codes = geohash_codes([42.605], [-5.603], 5)
+    center_lat, center_lng = geohash_centers(codes, 5)
+    # ezs42 spans 42.583-42.627 N, 5.625-5.581 W
+    assert center_lat[0] == pytest.approx(42.605, abs=1e-3)
+    assert center_lng[0] == pytest.approx(-5.603, abs=1e-3)
+    assert geohash_codes(center_lat, center_lng, 5).tolist() == codes.tolist()
+
+
+def brute_force(df, cells):
+    return df.assign(hour=df['started_at'].dt.floor('h'), cell=cells).groupby(['hour', 'cell']).size()
+
+
+@pytest.mark.parametrize('precision', [None, 6])
+def test_tiles_match_a_groupby(trip_file, precision):
+    df = load_trips(trip_file)
+    tiles = HeatmapTiles.from_trips(df, precision)
+    if precision is None:
+        cells = df['start_station_id'].astype(str)
+    else:
+        cells = geohash_strings(geohash_codes(df['start_lat'], df['start_lng'], precision), precision)
+    expected = brute_force(df, cells)
+
+    assert tiles.counts.sum() == len(df)
+    hours = pd.DatetimeIndex(tiles.start + np.arange(len(tiles)))
+    h, c = np.nonzero(tiles.counts)
+    actual = pd.Series(tiles.counts[h, c].astype(np.int64),
+                       index=pd.MultiIndex.from_arrays([hours[h], tiles.cell_ids[c]], names=['hour', 'cell']))
+    pd.testing.assert_series_equal(actual.sort_index(), expected.sort_index(), check_names=False,
+                                   check_index_type=False)
+
+    # the heatmap at t is the last full hour before t
+    t = expected.index[len(expected) // 2][0] + pd.Timedelta(minutes=90)
+    heatmap = tiles.heatmap(t).set_index('start_station_id')['riders']
+    last_hour = expected.xs(t.floor('h') - pd.Timedelta(hours=1), level='hour')
+    pd.testing.assert_series_equal(heatmap.sort_index(), last_hour.sort_index(), check_names=False,
+                                   check_index_type=False)
+    assert not tiles.hour(tiles.start - np.timedelta64(5, 'h')).any()
+
+
+def test_tiles_are_cached_next_to_the_trips(trip_file):
+    tiles = get_heatmap_tiles(trip_file, 6)
+    assert get_heatmap_tiles(trip_file, 6) is tiles
+    loaded = HeatmapTiles.load(tiles_cache_file(trip_file, 6))
+    assert np.array_equal(loaded.counts, tiles.counts) and loaded.start == tiles.start
+    assert loaded.cell_ids.tolist() == tiles.cell_ids.tolist()
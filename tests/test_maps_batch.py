@@ -0,0 +1,118 @@
+import threading
+
+import pytest
+
+from benchmarks.fake_maps import FakeTransport
+from maps_batch import DistanceMatrixBatcher, ResponseError, TransportError, group_requests
+
+
+class FlakyTransport(FakeTransport):
+    # fails the first `failures` calls with `status`
+    def __init__(self, failures, status='OVER_QUERY_LIMIT'):
+        super().__init__()
+        self.failures = failures
+        self.status = status
+        self.calls = []
+
+    def __call__(self, origins, destinations, mode):
+        self.calls.append((origins, destinations, mode))
+        if len(self.calls) <= self.failures:
+            return {'status': self.status, 'rows': []}
+        return super().__call__(origins, destinations, mode)
+
+
+class BlockingTransport(FakeTransport):
+    # holds every request until released, so lookups pile up while one is in flight
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def __call__(self, origins, destinations, mode):
+        self.release.wait(5)
+        return super().__call__(origins, destinations, mode)
+
+
+def point(k):
+    return (40.7 + k * 1e-3, -73.9 - k * 1e-3)
+
+
+def make_batcher(transport, **kwargs):
+    return DistanceMatrixBatcher(transport, requests_per_second=None, backoff=0, linger=0, **kwargs)
+
+
+def test_group_requests_covers_every_pair_within_limits():
+    pairs = [(point(i), point(100 + (i * 7 + j) % 40)) for i in range(30) for j in range(3)]
+    blocks = group_requests(pairs)
+    covered = set()
+    for origins, destinations in blocks:
+        assert len(origins) <= 25 and len(destinations) <= 25
+        assert len(origins) * len(destinations) <= 100
+        requested = sum((o, d) in set(pairs) for o in origins for d in destinations)
+        assert requested >= 0.25 * len(origins) * len(destinations)
+        covered.update((o, d) for o in origins for d in destinations)
+    assert set(pairs) <= covered
+    # scattered pairs share blocks instead of one request per origin
+    assert len(blocks) < 30
+
+
+def test_duplicate_lookups_share_one_element():
+    transport = BlockingTransport()
+    batcher = make_batcher(transport)
+    first = batcher.submit(point(0), point(1), 'bicycling')
+    second = batcher.submit(point(0), point(1), 'b')
+    assert second is first
+    transport.release.set()
+    assert first.result(5)['status'] == 'OK'
+    assert batcher.stats()['coalesced'] == 1
+    assert transport.client.num_elements == 1
+    batcher.close()
+
+
+def test_lookup_many_packs_one_request_per_mode():
+    transport = FakeTransport()
+    batcher = make_batcher(transport)
+    keys = [(point(i), point(10 + j), mode) for i in range(4) for j in range(5) for mode in ('bicycling', 'driving')]
+    elements = batcher.lookup_many(keys)
+    assert len(elements) == len(keys)
+    assert all(element['status'] == 'OK' for element in elements)
+    assert transport.client.num_calls == 2
+    # the same pair answers faster by bike than by car
+    assert elements[0]['duration']['value'] < elements[1]['duration']['value']
+    batcher.close()
+
+
+def test_retries_transient_statuses():
+    transport = FlakyTransport(failures=2)
+    batcher = make_batcher(transport, retries=3)
+    assert batcher.lookup(point(0), point(1), 'driving')['status'] == 'OK'
+    assert batcher.stats()['retries'] == 2
+    assert len(transport.calls) == 3
+    batcher.close()
+
+
+def test_gives_up_after_retries():
+    transport = FlakyTransport(failures=10)
+    batcher = make_batcher(transport, retries=2)
+    with pytest.raises(TransportError):
+        batcher.lookup(point(0), point(1), 'driving')
+    assert len(transport.calls) == 3
+    # the failed key is not left in flight, a new lookup sends a new request
+    assert batcher.in_flight == {}
+    batcher.close()
+
+
+def test_does_not_retry_rejected_requests():
+    transport = FlakyTransport(failures=1, status='REQUEST_DENIED')
+    batcher = make_batcher(transport, retries=3)
+    with pytest.raises(ResponseError):
+        batcher.lookup(point(0), point(1), 'driving')
+    assert len(transport.calls) == 1
+    assert batcher.try_lookup_many([(point(0), point(1), 'driving')])[0]['status'] == 'OK'
+    batcher.close()
+
+
+def test_try_lookup_many_returns_none_for_failed_lookups():
+    transport = FlakyTransport(failures=10)
+    batcher = make_batcher(transport, retries=0)
+    assert batcher.try_lookup_many([(point(0), point(1), 'driving')]) == [None]
+    batcher.close()
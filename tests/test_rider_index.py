@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rider_index import FIELDS, RELATIVE_ACCURACY, RIDER_COLUMN, QuantileSketch, RiderIndex
+
+
+def trips(n, seed=0, month='2024-03'):
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(month + '-01')
+    return pd.DataFrame({
+        'rider_id': rng.integers(0, 200, n).astype(str),
+        'ended_at': start + pd.to_timedelta(np.sort(rng.integers(0, 28 * 86400, n)), unit='s'),
+        'co2_saved': rng.lognormal(-1, 1, n),
+        'time_saved': rng.normal(5, 3, n),
+    })
+
+
+def add(index, df):
+    index.add_trips(df['rider_id'].to_numpy(), df['ended_at'].to_numpy(), df['co2_saved'], df['time_saved'])
+    return index
+
+
+def assert_same(a, b):
+    assert a.month == b.month
+    assert sorted(a.rider_ids) == sorted(b.rider_ids)
+    for rider_id in a.rider_ids:
+        assert a.rider(rider_id) == pytest.approx(b.rider(rider_id))
+    assert np.array_equal(a.month_sketch.counts, b.month_sketch.counts)
+
+
+def test_sketch_add_and_remove():
+    sketch = QuantileSketch()
+    sketch.add([0.5, 2.0, 2.0, 40.0])
+    sketch.add_one(0.0)
+    assert len(sketch) == 5
+    sketch.remove([2.0])
+    sketch.add_one(40.0, -1)
+    assert len(sketch) == 3
+    assert sketch.counts[sketch.bucket_of(2.0)] == 1
+    assert sketch.counts[0] == 1
+    sketch.remove([0.0, 0.5, 2.0])
+    assert not sketch.counts.any()
+
+
+def test_sketch_quantiles_are_within_the_relative_accuracy():
+    values = np.random.default_rng(0).lognormal(0, 2, 10_000)
+    values = values[values > 1e-3]
+    sketch = QuantileSketch()
+    sketch.add(values)
+    for q in (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99):
+        exact = np.quantile(values, q, method='inverted_cdf')
+        assert sketch.quantile(q) == pytest.approx(exact, rel=RELATIVE_ACCURACY)
+
+
+def test_sketch_merge():
+    values = np.random.default_rng(1).lognormal(0, 1, 1000)
+    whole, first, second = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    whole.add(values)
+    first.add(values[:300])
+    second.add(values[300:])
+    first.merge(second)
+    assert np.array_equal(first.counts, whole.counts)
+    with pytest.raises(ValueError):
+        first.merge(QuantileSketch(relative_accuracy=0.05))
+
+
+def test_add_trip_matches_add_trips():
+    df = trips(500)
+    one_by_one = RiderIndex(capacity=16)
+    for row in df.itertuples():
+        one_by_one.add_trip(row.rider_id, row.ended_at, row.co2_saved, row.time_saved)
+    assert_same(one_by_one, add(RiderIndex(), df))
+
+
+def test_index_merge_matches_one_index():
+    df = pd.concat([trips(400, seed=0, month='2024-02'), trips(600, seed=1)], ignore_index=True)
+    merged = RiderIndex()
+    # an earlier month after a later one only adds to the all-time totals
+    for part in (df[400:], df[:400]):
+        merged.merge(add(RiderIndex(), part))
+    whole = add(RiderIndex(), df)
+    assert_same(merged, whole)
+    assert merged.percentile(0.5) == whole.percentile(0.5)
+
+
+def test_save_and_load(tmp_path):
+    index = add(RiderIndex(), trips(300))
+    index.save(str(tmp_path / 'riders.npz'))
+    assert_same(RiderIndex.load(str(tmp_path / 'riders.npz')), index)
+
+
+def test_ingest_builds_the_rider_index(trip_file, tmp_path, monkeypatch):
+    import station_matrix
+    import trip_aggregates
+    from benchmarks import synthetic
+    from distance import estimate_co2_saved_batch
+    from estimate_cache import EstimateCache
+    from rider_index import get_rider_index
+    from station_matrix import StationMatrix
+    from trip_store import clean_trips
+
+    stations = synthetic.make_stations(50)
+    matrix = StationMatrix(stations['station_id'].tolist(), stations['lat'].to_numpy(), stations['lon'].to_numpy(),
+                           path=str(tmp_path / 'matrix'), cache=EstimateCache(str(tmp_path / 'estimates.sqlite')))
+    monkeypatch.setattr(station_matrix, '_station_matrix', matrix)
+
+    df = pd.read_csv(trip_file)
+    df[RIDER_COLUMN] = np.random.default_rng(0).integers(0, 30, len(df)).astype(str)
+    # a trip without a rider still counts towards the aggregates
+    df.loc[0, RIDER_COLUMN] = None
+    df.to_csv(trip_file, index=False)
+
+    aggregates = trip_aggregates.ingest([trip_file])
+    index = get_rider_index()
+    cleaned = clean_trips(df.fillna({RIDER_COLUMN: ''}))
+    assert aggregates.monthly()['rides'].sum() == len(cleaned)
+
+    expected = cleaned[cleaned[RIDER_COLUMN] != ''].copy()
+    expected['co2_saved'] = estimate_co2_saved_batch(expected)
+    totals = expected.groupby(RIDER_COLUMN)['co2_saved'].agg(['size', 'sum'])
+    assert sorted(index.rider_ids) == sorted(totals.index)
+    for rider_id, (rides, co2) in totals.iterrows():
+        rider = index.rider(rider_id)
+        assert rider['total_rides'] == rides
+        assert rider['total_co2'] == pytest.approx(co2)
+        assert set(FIELDS) <= set(rider)
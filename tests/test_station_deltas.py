@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+import csp
+
+from benchmarks import synthetic
+from csp_bike import StationDelta
+from poll import station_deltas
+
+START = datetime(2024, 3, 27, 8, 0)
+
+
+def records(doc):
+    # station_status records as the dict API hands them to the graph
+    return [
+        {
+            'station_id': station['station_id'],
+            'last_reported': station['last_reported'],
+            'num_bikes_available': station['num_bikes_available'] - station['num_ebikes_available'],
+            'num_ebikes_available': station['num_ebikes_available'],
+            'num_docks_available': station['num_docks_available'],
+            'total_bikes_available': station['num_bikes_available'],
+        }
+        for station in doc['data']['stations']
+    ]
+
+
+def run_deltas(snapshots):
+    @csp.graph
+    def graph():
+        stations = csp.curve([dict], [(START + timedelta(seconds=28 * k), snapshot)
+                                      for k, snapshot in enumerate(snapshots)])
+        csp.add_graph_output('deltas', station_deltas(stations))
+
+    results = csp.run(graph, starttime=START, endtime=timedelta(seconds=28 * len(snapshots)))
+    return [deltas for _, deltas in results['deltas']]
+
+
+def test_deltas_are_the_stations_whose_bikes_changed():
+    stations = synthetic.make_stations(60)
+    snapshots = [records(doc) for doc in synthetic.station_status_snapshots(stations, 12, changes_per_snapshot=10)]
+    ticks = run_deltas(snapshots)
+    assert len(ticks) == len(snapshots)
+
+    previous = {}
+    for snapshot, deltas in zip(snapshots, ticks):
+        expected = [
+            (record['station_id'], previous.get(record['station_id'], 0), record['total_bikes_available'])
+            for record in snapshot
+            if record['station_id'] not in previous or previous[record['station_id']] != record['total_bikes_available']
+        ]
+        assert [(d.station_id, d.prior_bikes_available, d.total_bikes_available) for d in deltas] == expected
+        assert all(isinstance(d, StationDelta) for d in deltas)
+        previous.update((record['station_id'], record['total_bikes_available']) for record in snapshot)
+
+
+def test_a_station_that_has_not_reported_is_skipped():
+    first = [{'station_id': 'a', 'last_reported': 100, 'num_bikes_available': 3, 'num_ebikes_available': 0,
+              'num_docks_available': 7, 'total_bikes_available': 3}]
+    # same report, bikes differ: a stale record, not a change
+    stale = [dict(first[0], num_bikes_available=5, total_bikes_available=5)]
+    fresh = [dict(first[0], last_reported=130, num_bikes_available=5, total_bikes_available=5)]
+    ticks = run_deltas([first, stale, fresh])
+    assert [len(deltas) for deltas in ticks] == [1, 0, 1]
+    assert (ticks[2][0].prior_bikes_available, ticks[2][0].total_bikes_available) == (3, 5)
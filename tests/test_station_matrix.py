@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+from benchmarks.fake_maps import FakeTransport
+from estimate_cache import EstimateCache, quantize
+from maps_batch import DistanceMatrixBatcher
+from station_matrix import (DETOUR_FACTOR, FAILED, MAX_SNAP_KM, StationMatrix, element_values,
+                            fallback_estimate)
+
+
+# three stations about 1.1 km apart on a north-south line
+IDS = ['a', 'b', 'c']
+LATS = [40.70, 40.71, 40.72]
+LNGS = [-73.95, -73.95, -73.95]
+# further than MAX_SNAP_KM from every station
+OFF_GRID = (40.70, -73.90)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EstimateCache(str(tmp_path / 'estimates.sqlite'))
+
+
+@pytest.fixture
+def batcher():
+    batcher = DistanceMatrixBatcher(FakeTransport(), requests_per_second=None, backoff=0, linger=0)
+    yield batcher
+    batcher.close()
+
+
+def make_matrix(tmp_path, cache, ids=IDS, lats=LATS, lngs=LNGS):
+    return StationMatrix(ids, lats, lngs, path=str(tmp_path / 'matrix'), cache=cache)
+
+
+def test_off_grid_trips_read_through_the_estimate_cache(tmp_path, cache, batcher):
+    matrix = make_matrix(tmp_path, cache)
+    fallback = matrix.estimate(OFF_GRID[0], OFF_GRID[1], LATS[2], LNGS[2])
+    assert fallback == pytest.approx(fallback_estimate(fallback[0] / 1.5))
+    # the miss is queued by quantized coordinates, not as a station pair
+    trip = quantize(*OFF_GRID) + quantize(LATS[2], LNGS[2])
+    assert list(matrix.pending_offgrid) == [trip] and not matrix.pending
+
+    matrix.save_pending()
+    assert matrix.load_pending_offgrid() == [trip]
+    assert matrix.fill_pending(max_pairs=2, batcher=batcher) >= 1
+    assert matrix.load_pending_offgrid() == []
+
+    # now served from the cache, for the scalar and the batch path alike
+    bike_km, drive_km, bike_min, drive_min = matrix.estimate(OFF_GRID[0], OFF_GRID[1], LATS[2], LNGS[2])
+    element = cache.get(OFF_GRID, (LATS[2], LNGS[2]), 'bicycling')
+    assert bike_km == pytest.approx(element['distance']['value'] / 1000)
+    assert bike_min == pytest.approx(element['duration']['value'] / 60)
+    many = matrix.estimate_many([OFF_GRID[0], LATS[0]], [OFF_GRID[1], LNGS[0]], [LATS[2], LATS[1]], [LNGS[2], LNGS[1]])
+    assert many[:, 0] == pytest.approx([bike_km, drive_km, bike_min, drive_min])
+    assert not matrix.pending_offgrid
+
+
+def fill(matrix, i, j, value):
+    matrix.values[:, i, j] = value
+    matrix.values.flush()
+
+
+def test_rebuild_carries_values_over_by_station_id(tmp_path, cache):
+    matrix = make_matrix(tmp_path, cache)
+    fill(matrix, 0, 2, 1.0)
+    fill(matrix, 2, 0, 2.0)
+    fill(matrix, 1, 2, 3.0)
+    del matrix
+
+    # 'b' closed, 'd' opened, and the order changed
+    matrix = make_matrix(tmp_path, cache, ['c', 'd', 'a'], [40.72, 40.73, 40.70], [-73.95] * 3)
+    assert matrix.values.shape == (4, 3, 3)
+    assert (matrix.values[:, 2, 0] == 1.0).all() and (matrix.values[:, 0, 2] == 2.0).all()
+    assert np.isnan(matrix.values[:, 1, :]).all() and np.isnan(matrix.values[:, :, 1]).all()
+    assert not matrix.is_filled(0, 0)
+    # the same list again opens the file as is
+    assert make_matrix(tmp_path, cache, ['c', 'd', 'a'], [40.72, 40.73, 40.70], [-73.95] * 3).values[0, 2, 0] == 1.0
+
+
+def test_coordinates_beyond_max_snap_km_are_not_snapped(tmp_path, cache):
+    matrix = make_matrix(tmp_path, cache)
+    # 0.001 degrees of latitude is about 0.11 km
+    near, far = 40.72 + 0.002, 40.72 + 0.003
+    assert matrix.snap(near, -73.95) == 2
+    assert matrix.snap(far, -73.95) == -1
+    assert matrix.snap(far, -73.95, max_km=MAX_SNAP_KM * 2) == 2
+    assert matrix.snap_many([near, far, 40.7001], [-73.95] * 3).tolist() == [2, -1, 0]
+    assert matrix.lookup(far, -73.95, LATS[0], LNGS[0]) is None
+
+
+def test_failed_pairs_use_the_fallback(tmp_path, cache):
+    matrix = make_matrix(tmp_path, cache)
+    ok = {'status': 'OK', 'distance': {'value': 2000}, 'duration': {'value': 600}}
+    assert element_values(ok, {'status': 'ZERO_RESULTS'}) == (FAILED,) * 4
+    fill(matrix, 0, 2, element_values({'status': 'NOT_FOUND'}, ok))
+
+    fallback = matrix.estimate(LATS[0], LNGS[0], LATS[2], LNGS[2])
+    assert fallback == pytest.approx(fallback_estimate(fallback[0] / DETOUR_FACTOR))
+    assert matrix.lookup(LATS[0], LNGS[0], LATS[2], LNGS[2]) is None
+    many = matrix.estimate_many([LATS[0]], [LNGS[0]], [LATS[2]], [LNGS[2]])
+    assert many[:, 0] == pytest.approx(fallback)
+    # filled as far as the fill stage is concerned, so never requested again
+    assert matrix.is_filled(0, 2) and not matrix.pending
+    assert (0, 2) not in matrix.unfilled_pairs()
+
+
+def test_pending_pairs_round_trip_through_pending_sqlite(tmp_path, cache, batcher):
+    matrix = make_matrix(tmp_path, cache)
+    matrix.estimate(LATS[0], LNGS[0], LATS[2], LNGS[2])
+    matrix.estimate_many([LATS[1]], [LNGS[1]], [LATS[0]], [LNGS[0]])
+    assert list(matrix.pending) == [(0, 2), (1, 0)]
+    matrix.save_pending()
+    assert not matrix.pending
+
+    # another process, after 'b' closed, sees the misses by station id
+    other = make_matrix(tmp_path, cache, ['a', 'c'], [LATS[0], LATS[2]], [LNGS[0], LNGS[2]])
+    assert other.load_pending() == [(0, 1)]
+    assert other.unfilled_pairs(limit=1) == [(0, 1)]
+    assert other.fill_pending(max_pairs=1, batcher=batcher) == 1
+    assert other.is_filled(0, 1) and other.load_pending() == []
+    assert other.estimate(LATS[0], LNGS[0], LATS[2], LNGS[2]) == pytest.approx(tuple(other.values[:, 0, 1]))
@@ -0,0 +1,45 @@
+import copy
+
+import numpy as np
+
+from csp_bike.stations import _station_status_records
+from csp_bike.status_columns import station_status_columns
+
+
+def status_document():
+    stations = [
+        {"station_id": "72", "num_bikes_available": 10, "num_ebikes_available": 3, "num_docks_available": 20,
+         "last_reported": 1711500000,
+         "vehicle_types_available": [{"vehicle_type_id": "1", "count": 7}, {"vehicle_type_id": "2", "count": 3}]},
+        {"station_id": "4000.00", "num_bikes_available": 0, "num_docks_available": 15, "last_reported": 1711500060},
+        {"station_id": "gone", "num_bikes_available": 4, "num_ebikes_available": 4, "num_docks_available": 0,
+         "last_reported": 1711499000},
+    ]
+    return {"last_updated": 1711500100, "ttl": 60, "data": {"stations": stations}}
+
+
+def test_columns_match_the_dict_api(monkeypatch):
+    index = {"4000.00": 0, "72": 1, "79": 2}
+    monkeypatch.setattr("csp_bike.stations.get_station_metadata", lambda system=None: type("M", (), {"index": index}))
+    dat = status_document()
+    records = _station_status_records(copy.deepcopy(dat))
+    columns = station_status_columns(dat, index)
+
+    assert len(columns) == 3
+    assert columns.last_updated == 1711500100 and columns.ttl == 60
+    assert columns.num_bikes_available.dtype == np.int32
+    # an unknown station maps to -1, a missing num_ebikes_available to 0
+    assert list(columns.station_index) == [1, 0, -1]
+    for row, record in zip(columns.records(), records):
+        assert row == {key: record.get(key, 0) for key in row}
+
+
+def test_records_leave_the_shared_document_untouched(monkeypatch):
+    monkeypatch.setattr("csp_bike.stations.get_station_metadata", lambda system=None: type("M", (), {"index": {}}))
+    dat = status_document()
+    _station_status_records(dat)
+    # the GBFS client hands the same decoded document to every parser
+    columns = station_status_columns(dat)
+    assert list(columns.total_bikes_available) == [10, 0, 4]
+    assert list(columns.num_bikes_available) == [7, 0, 0]
+    assert "vehicle_types_available" in dat["data"]["stations"][0]
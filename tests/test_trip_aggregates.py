@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+from trip_aggregates import GOAL_GROWTH, SUM_COLUMNS, TripAggregates, _empty
+
+
+def aggregates(days, co2):
+    daily = pd.DataFrame({'rides': 1, 'co2_saved': co2, 'time_saved': 0.0},
+                         index=pd.DatetimeIndex(pd.to_datetime(days), name='day'))[SUM_COLUMNS]
+    return TripAggregates(daily, _empty()[1])
+
+
+def test_goal_beats_last_month():
+    trips = aggregates(['2024-02-10', '2024-02-20', '2024-03-01'], [40.0, 60.0, 5.0])
+    assert trips.goal_basis('2024-03-15') == 'previous_month'
+    assert trips.goal('2024-03-15') == pytest.approx(100.0 * (1 + GOAL_GROWTH))
+
+
+def test_goal_projects_the_first_month_from_its_daily_rate():
+    trips = aggregates(['2024-03-01', '2024-03-02', '2024-03-03', '2024-03-04'], [10.0, 20.0, 30.0, 99.0])
+    # three full days before March 4th: 60 kg at 20 kg/day over 31 days
+    assert trips.projected_total('2024-03-04 12:00') == pytest.approx(620.0)
+    assert trips.goal_basis('2024-03-04 12:00') == 'projected'
+    assert trips.goal('2024-03-04 12:00') == pytest.approx(620.0 * (1 + GOAL_GROWTH))
+
+
+def test_no_goal_before_a_full_day_of_data():
+    trips = aggregates(['2024-03-01'], [10.0])
+    assert trips.goal('2024-03-01 18:00') is None
+    assert trips.goal_basis('2024-03-01 18:00') is None
+    assert aggregates([], []).goal('2024-03-10') is None
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import trip_store
+
+
+def raw_trips(trip_file):
+    # the CSV as pandas reads it untyped, trips without both stations dropped
+    df = pd.read_csv(trip_file, usecols=trip_store.TRIP_COLUMNS, dtype=str).dropna()
+    return df.astype({'start_lat': float, 'start_lng': float, 'end_lat': float, 'end_lng': float})
+
+
+def test_load_trips_types_and_sorts(trip_file):
+    df = trip_store.load_trips(trip_file)
+    raw = raw_trips(trip_file)
+
+    assert list(df.columns) == trip_store.TRIP_COLUMNS
+    assert len(df) == len(raw)
+    assert df['started_at'].dtype.kind == 'M' and df['ended_at'].dtype.kind == 'M'
+    assert isinstance(df['start_station_id'].dtype, pd.CategoricalDtype)
+    assert df['started_at'].is_monotonic_increasing
+    assert sorted(df['start_station_id'].astype(str)) == sorted(raw['start_station_id'])
+
+
+def test_load_trips_writes_and_reuses_the_columnar_cache(trip_file):
+    first = trip_store.load_trips(trip_file)
+    cache_file = trip_store.columnar_cache_file(trip_file)
+    assert os.path.exists(cache_file)
+    # shared within the process
+    assert trip_store.load_trips(trip_file) is first
+
+    trip_store.clear_cache()
+    mtime = os.stat(cache_file).st_mtime_ns
+    second = trip_store.load_trips(trip_file)
+    assert os.stat(cache_file).st_mtime_ns == mtime
+    pd.testing.assert_frame_equal(second, first)
+    # a columnar cache file loads directly too
+    pd.testing.assert_frame_equal(trip_store.load_trips(cache_file), first)
+
+
+def test_rewritten_csv_is_reparsed(trip_file):
+    before = trip_store.load_trips(trip_file)
+    raw = pd.read_csv(trip_file)
+    raw.iloc[:100].to_csv(trip_file, index=False)
+    os.utime(trip_file, ns=(os.stat(trip_file).st_atime_ns, os.stat(trip_file).st_mtime_ns + 10 ** 9))
+
+    after = trip_store.load_trips(trip_file)
+    assert after is not before
+    assert len(after) == len(raw.iloc[:100].dropna(subset=trip_store.TRIP_COLUMNS))
+
+
+def test_get_trips_between_matches_a_filter(trip_file):
+    df = trip_store.load_trips(trip_file)
+    start, end = pd.Timestamp('2024-03-10 06:00'), pd.Timestamp('2024-03-12 18:30')
+    expected = df[(df['started_at'] >= start) & (df['started_at'] <= end)]
+    got = trip_store.get_trips_between(df, start, end)
+    assert np.array_equal(got.index, expected.index)
+    assert len(trip_store.get_trips_between(df, end, start)) == 0
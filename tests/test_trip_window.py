@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import trip_store
+from trip_window import get_trip_window
+
+
+@pytest.mark.parametrize('when', ['2024-03-01 00:05', '2024-03-01 09:00', '2024-03-15 12:34:56', '2024-04-02'])
+@pytest.mark.parametrize('n', [1, 30])
+def test_last_finished_matches_a_filter(trip_file, when, n):
+    df = trip_store.load_trips(trip_file)
+    when = pd.Timestamp(when)
+    finished = df[df['ended_at'] <= when].sort_values('ended_at', kind='stable')
+    expected = finished.iloc[max(0, len(finished) - n):]
+
+    got = get_trip_window(trip_file).last_finished(n, when)
+    assert np.array_equal(got.index, expected.index)
+    assert got['ended_at'].is_monotonic_increasing
+
+
+def test_last_finished_before_the_first_trip_is_empty(trip_file):
+    df = trip_store.load_trips(trip_file)
+    got = get_trip_window(trip_file).last_finished(30, df['ended_at'].min() - pd.Timedelta(seconds=1))
+    assert len(got) == 0
+
+
+def test_window_follows_the_trip_store(trip_file):
+    window = get_trip_window(trip_file)
+    assert get_trip_window(trip_file) is window
+    trip_store.clear_cache()
+    assert get_trip_window(trip_file) is not window
+
+
+def test_advance_matches_a_filter_and_returns_a_copy(trip_file):
+    df = trip_store.load_trips(trip_file)
+    window = get_trip_window(trip_file, width=timedelta(minutes=90))
+    stations = window.station_ids.astype(str)
+    # forwards, overlapping backwards, and a jump with no overlap
+    ticks = ['2024-03-02 08:00', '2024-03-02 08:20', '2024-03-02 09:45', '2024-03-02 09:00', '2024-03-20 17:30']
+    previous = None
+    for tick in ticks:
+        t = pd.Timestamp(tick)
+        counts = window.advance(t)
+        started = df[(df['started_at'] >= t - pd.Timedelta(minutes=90)) & (df['started_at'] <= t)]
+        expected = started['start_station_id'].astype(str).value_counts()
+        assert dict(zip(stations[counts > 0], counts[counts > 0])) == expected.to_dict()
+        assert len(window.trips()) == len(started)
+        if previous is not None:
+            # earlier results are not changed by later ticks
+            assert previous[1].tolist() == previous[0]
+        previous = (counts.tolist(), counts)
+
+    heatmap = window.heatmap(pd.Timestamp(ticks[0]))
+    assert heatmap['riders'].sum() == window.advance(pd.Timestamp(ticks[0])).sum()
+    assert list(heatmap.columns) == ['start_station_id', 'start_lat', 'start_lng', 'riders']
@@ -0,0 +1,308 @@
+import glob
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import trip_store
+from rider_index import RIDER_COLUMN, RiderIndex
+from trip_store import TRIP_COLUMNS, clean_trips, read_columnar, write_columnar
+
+# CO2 / ride / time-saved totals over every monthly trip file, built out of core.
+# Each CSV is streamed in chunks through the vectorized distance model and
+# reduced to per-day and per-(month, station) sums, so memory is bounded by the
+# chunk size. Each file's result is checkpointed with the file's mtime and size;
+# a new month only processes the new file, and files can be spread over processes.
+#
+# Trip files that carry a rider id (rider_index.RIDER_COLUMN) also get a
+# per-file RiderIndex, fed from the same estimates and checkpointed alongside;
+# ingest merges them into the index the dashboard loads.
+#
+# Ingestion runs from supervisor.py (or `python trip_aggregates.py`); readers such
+# as the dashboard only load the checkpoints, see get_trip_aggregates.
+
+TRIP_DATA_GLOB = './data/*citibike-tripdata*.csv'
+CHUNK_SIZE = 500_000
+
+# a month's goal: the previous month's total plus this much. A month without a
+# previous one (the first month of data) projects its own total from its daily
+# rate so far instead, plus the same growth.
+GOAL_GROWTH = 0.05
+
+SUM_COLUMNS = ['rides', 'co2_saved', 'time_saved']
+
+# seconds between ingestion passes under the supervisor
+INGEST_INTERVAL = 3600
+
+
+def aggregates_dir():
+    return os.path.join(trip_store.CACHE_DIR, 'aggregates')
+
+
+def _empty():
+    daily = pd.DataFrame(columns=SUM_COLUMNS, index=pd.DatetimeIndex([], name='day'))
+    stations = pd.DataFrame(columns=SUM_COLUMNS,
+                            index=pd.MultiIndex.from_tuples([], names=['month', 'start_station_id']))
+    return daily, stations
+
+
+def _aggregate_chunk(df, riders=None):
+    from distance import estimate_trips_batch, estimate_co2_saved_batch, estimate_delta_time_batch
+    from station_matrix import get_station_matrix
+
+    estimates = estimate_trips_batch(df)
+    # hand this chunk's matrix misses to the fill stage right away, so the
+    # in-memory pending set holds one chunk's worth, not the whole ingest's
+    get_station_matrix().save_pending()
+    times = estimate_delta_time_batch(df, estimates)
+    values = pd.DataFrame({
+        'day': df['started_at'].dt.floor('D').to_numpy(),
+        'start_station_id': df['start_station_id'].astype(str).to_numpy(),
+        'rides': 1,
+        'co2_saved': estimate_co2_saved_batch(df, estimates),
+        # minutes saved compared to driving
+        'time_saved': times['drive'] - times['bike'],
+    })
+    if riders is not None:
+        # trips without a rider id still count towards the totals below
+        known = (df[RIDER_COLUMN] != '').to_numpy()
+        riders.add_trips(df[RIDER_COLUMN].to_numpy()[known], df['ended_at'].to_numpy()[known],
+                         values['co2_saved'].to_numpy()[known], values['time_saved'].to_numpy()[known])
+    daily = values.groupby('day', sort=False)[SUM_COLUMNS].sum()
+    values['month'] = values['day'].dt.to_period('M').astype(str)
+    stations = values.groupby(['month', 'start_station_id'], sort=False)[SUM_COLUMNS].sum()
+    return daily, stations
+
+
+def aggregate_file(csv_file, chunksize=CHUNK_SIZE):
+    # (daily sums, (month, station) sums, rows, riders) for one trip CSV, one
+    # chunk in memory at a time; riders is a RiderIndex if the file has a
+    # RIDER_COLUMN column, else None
+    usecols, dtype = list(TRIP_COLUMNS), {'start_station_id': str, 'end_station_id': str}
+    riders = None
+    if RIDER_COLUMN in pd.read_csv(csv_file, nrows=0).columns:
+        usecols.append(RIDER_COLUMN)
+        dtype[RIDER_COLUMN] = str
+        riders = RiderIndex()
+    daily, stations, rows = [], [], 0
+    for chunk in pd.read_csv(csv_file, usecols=usecols, chunksize=chunksize, dtype=dtype):
+        if riders is not None:
+            # clean_trips drops rows with missing values; a missing rider id isn't a bad trip
+            chunk[RIDER_COLUMN] = chunk[RIDER_COLUMN].fillna('')
+        chunk = clean_trips(chunk)
+        rows += len(chunk)
+        if len(chunk):
+            chunk_daily, chunk_stations = _aggregate_chunk(chunk, riders)
+            daily.append(chunk_daily)
+            stations.append(chunk_stations)
+    if not rows:
+        return (*_empty(), 0, riders)
+    # chunk results are small, combine them once at the end
+    return (pd.concat(daily).groupby(level=0).sum(),
+            pd.concat(stations).groupby(level=[0, 1]).sum(), rows, riders)
+
+
+class TripAggregates:
+    def __init__(self, daily, stations):
+        # daily: sums per day; stations: sums per (month, start station)
+        self.daily = daily.sort_index()
+        self.stations = stations.sort_index()
+
+    def monthly(self):
+        return self.daily.groupby(self.daily.index.to_period('M')).sum()
+
+    def month_total(self, month, column='co2_saved'):
+        monthly = self.monthly()
+        month = pd.Period(month, 'M')
+        return float(monthly[column].get(month, 0.0))
+
+    def month_to_date(self, t, column='co2_saved'):
+        # sum over the days of t's month before t's day
+        t = pd.Timestamp(t)
+        start = t.to_period('M').start_time
+        days = self.daily.loc[(self.daily.index >= start) & (self.daily.index < t.floor('D')), column]
+        return float(days.sum())
+
+    def goal(self, t, column='co2_saved', growth=GOAL_GROWTH):
+        # beat last month by `growth`; without last month's data, beat this
+        # month's projected total by `growth`. None when neither is available.
+        basis = self.goal_basis(t, column)
+        if basis == 'previous_month':
+            return self.month_total(pd.Timestamp(t).to_period('M') - 1, column) * (1 + growth)
+        if basis == 'projected':
+            return self.projected_total(t, column) * (1 + growth)
+        return None
+
+    def goal_basis(self, t, column='co2_saved'):
+        # what goal() is based on: 'previous_month', 'projected' or None
+        if self.month_total(pd.Timestamp(t).to_period('M') - 1, column) > 0:
+            return 'previous_month'
+        if self.projected_total(t, column):
+            return 'projected'
+        return None
+
+    def projected_total(self, t, column='co2_saved'):
+        # t's month at the daily rate of its full days before t; None before the first full day
+        t = pd.Timestamp(t)
+        days = (t.floor('D') - t.to_period('M').start_time).days
+        so_far = self.month_to_date(t, column)
+        if days <= 0 or so_far <= 0:
+            return None
+        return so_far / days * t.days_in_month
+
+    def top_stations(self, month, n=10, column='co2_saved'):
+        return self.stations.loc[str(pd.Period(month, 'M'))].nlargest(n, column)
+
+
+class AggregateStore:
+    # per-file checkpoints of aggregate_file results, keyed on the file's mtime and size
+    def __init__(self, path=None):
+        self.path = path or aggregates_dir()
+        self.manifest_file = os.path.join(self.path, 'manifest.json')
+        self.manifest = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                self.manifest = json.load(f)
+
+    def _files(self, csv_file):
+        name = os.path.splitext(os.path.basename(csv_file))[0]
+        return (os.path.join(self.path, name + '.daily.parquet'),
+                os.path.join(self.path, name + '.stations.parquet'))
+
+    def _riders_file(self, csv_file):
+        name = os.path.splitext(os.path.basename(csv_file))[0]
+        return os.path.join(self.path, name + '.riders.npz')
+
+    def is_current(self, csv_file):
+        entry = self.manifest.get(os.path.abspath(csv_file))
+        stat = os.stat(csv_file)
+        return entry is not None and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+
+    def save(self, csv_file, daily, stations, rows, riders=None):
+        daily_file, stations_file = self._files(csv_file)
+        write_columnar(daily.reset_index(), daily_file)
+        write_columnar(stations.reset_index(), stations_file)
+        riders_file = self._riders_file(csv_file)
+        if riders is not None:
+            riders.save(riders_file)
+        elif os.path.exists(riders_file):
+            # the file was rewritten without rider ids
+            os.remove(riders_file)
+        stat = os.stat(csv_file)
+        self.manifest[os.path.abspath(csv_file)] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'rows': rows}
+        # manifest last, so a checkpoint only counts once both files are written
+        tmp_file = '%s.%d.tmp' % (self.manifest_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_file, self.manifest_file)
+
+    def load(self, csv_file):
+        daily_file, stations_file = self._files(csv_file)
+        daily = read_columnar(daily_file).set_index('day')
+        stations = read_columnar(stations_file).set_index(['month', 'start_station_id'])
+        return daily, stations
+
+    def load_riders(self, csv_file):
+        # the file's RiderIndex, or None if it has no rider ids
+        riders_file = self._riders_file(csv_file)
+        return RiderIndex.load(riders_file) if os.path.exists(riders_file) else None
+
+    def checkpointed_files(self):
+        return sorted(self.manifest)
+
+
+def combine(results):
+    # a month can span files (tripdata_1, _2, ...), so sum across them
+    if not results:
+        return TripAggregates(*_empty())
+    daily = pd.concat([daily for daily, _ in results]).groupby(level=0).sum()
+    stations = pd.concat([stations for _, stations in results]).groupby(level=[0, 1]).sum()
+    return TripAggregates(daily, stations)
+
+
+def trip_files(pattern=TRIP_DATA_GLOB):
+    return sorted(glob.glob(pattern))
+
+
+def ingest(files=None, processes=1, chunksize=CHUNK_SIZE, store=None):
+    # aggregate every file without a current checkpoint, then combine all checkpoints
+    files = trip_files() if files is None else files
+    store = store or AggregateStore()
+    pending = [csv_file for csv_file in files if not store.is_current(csv_file)]
+
+    if processes > 1 and len(pending) > 1:
+        # create or migrate the station matrix here, so workers only open it
+        from station_matrix import get_station_matrix
+        get_station_matrix()
+
+        # files are independent, checkpoint each as it finishes
+        with ProcessPoolExecutor(max_workers=min(processes, len(pending))) as executor:
+            futures = {csv_file: executor.submit(aggregate_file, csv_file, chunksize) for csv_file in pending}
+            for csv_file, future in futures.items():
+                store.save(csv_file, *future.result())
+    else:
+        for csv_file in pending:
+            store.save(csv_file, *aggregate_file(csv_file, chunksize))
+
+    if pending:
+        save_rider_index(files, store)
+    return combine([store.load(csv_file) for csv_file in files])
+
+
+def save_rider_index(files, store):
+    # merge the files' rider checkpoints, in time order, into the index get_rider_index loads
+    indexes = [riders for riders in map(store.load_riders, files) if riders is not None]
+    if not indexes:
+        return
+    index = RiderIndex()
+    for riders in sorted(indexes, key=lambda riders: -1 if riders.month is None else riders.month):
+        index.merge(riders)
+    index.save()
+
+
+def run_ingester(pattern=TRIP_DATA_GLOB, processes=1, interval=INGEST_INTERVAL):
+    # checkpoint new and changed trip files every `interval` seconds, for the supervisor
+    while True:
+        ingest(trip_files(pattern), processes=processes)
+        time.sleep(interval)
+
+
+_aggregates = {}
+_lock = threading.Lock()
+
+
+def get_trip_aggregates(path=None):
+    # the combined checkpoints, without ingesting anything; None until the first
+    # file has been checkpointed. Shared within the process and reloaded when the
+    # manifest changes.
+    path = path or aggregates_dir()
+    manifest_file = os.path.join(path, 'manifest.json')
+    try:
+        key = os.stat(manifest_file).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _lock:
+        aggregates = _aggregates.get(path)
+        if aggregates is None or aggregates[0] != key:
+            store = AggregateStore(path)
+            files = store.checkpointed_files()
+            if not files:
+                return None
+            aggregates = _aggregates[path] = (key, combine([store.load(csv_file) for csv_file in files]))
+    return aggregates[1]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Aggregate CO2 saved, rides and time saved over all trip files')
+    parser.add_argument('files', nargs='*', help='trip CSVs (default: %s)' % TRIP_DATA_GLOB)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    aggregates = ingest(args.files or None, processes=args.processes, chunksize=args.chunksize)
+    print(aggregates.monthly().round(1).to_string())
@@ -0,0 +1,113 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Shared, typed trip-data loader. Each monthly Citi Bike CSV is parsed once
+# into a Parquet file with datetime64 columns and categorical station ids;
+# after that loads come from the columnar copy, and within a process the
+# frame is kept in memory keyed on (file, mtime) so Streamlit reruns just slice.
+
+CACHE_DIR = './data/cache'
+DEFAULT_TRIP_FILE = './data/202403-citibike-tripdata_1.csv'
+
+TRIP_COLUMNS = ['started_at', 'ended_at', 'start_station_id', 'end_station_id',
+                'start_lat', 'start_lng', 'end_lat', 'end_lng']
+
+_trips = {}
+_lock = threading.Lock()
+
+
+def columnar_cache_file(csv_file):
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    return os.path.join(CACHE_DIR, name + '.parquet')
+
+
+def write_columnar(df, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    try:
+        df.to_parquet(tmp_path, index=False)
+    except ImportError:
+        # no parquet engine installed, a pickle keeps the dtypes just as well
+        df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def read_columnar(path):
+    try:
+        return pd.read_parquet(path)
+    except ImportError:
+        return pd.read_pickle(path)
+
+
+def parse_trip_csv(csv_file, usecols=TRIP_COLUMNS, **read_csv_kwargs):
+    # read a raw trip CSV into typed columns, dropping trips without both stations
+    df = pd.read_csv(csv_file, usecols=usecols, dtype={'start_station_id': str, 'end_station_id': str},
+                     **read_csv_kwargs)
+    return clean_trips(df)
+
+
+def clean_trips(df):
+    df = df.dropna()
+    return df.assign(
+        started_at=pd.to_datetime(df['started_at'], format='ISO8601'),
+        ended_at=pd.to_datetime(df['ended_at'], format='ISO8601'),
+        start_station_id=df['start_station_id'].astype(str).astype('category'),
+        end_station_id=df['end_station_id'].astype(str).astype('category'),
+    )
+
+
+def convert_trip_csv(csv_file, cache_file=None):
+    # parse the CSV once and write the typed, started_at-sorted columnar copy
+    cache_file = cache_file or columnar_cache_file(csv_file)
+    df = parse_trip_csv(csv_file)
+    df = df.sort_values('started_at', kind='stable').reset_index(drop=True)
+    write_columnar(df, cache_file)
+    return df
+
+
+def load_trips(csv_file=DEFAULT_TRIP_FILE):
+    # typed trip frame sorted by started_at, shared by every caller in the process
+    key = (os.path.abspath(csv_file), os.stat(csv_file).st_mtime_ns)
+    df = _trips.get(key)
+    if df is not None:
+        return df
+
+    with _lock:
+        df = _trips.get(key)
+        if df is not None:
+            return df
+
+        cache_file = columnar_cache_file(csv_file)
+        if csv_file.endswith('.parquet'):
+            # already a columnar copy
+            df = read_columnar(csv_file)
+        elif os.path.exists(cache_file) and os.stat(cache_file).st_mtime_ns >= key[1]:
+            df = read_columnar(cache_file)
+        else:
+            df = convert_trip_csv(csv_file, cache_file)
+
+        # drop frames for older versions of the same file
+        for old_key in [old_key for old_key in _trips if old_key[0] == key[0]]:
+            del _trips[old_key]
+        _trips[key] = df
+    return df
+
+
+def get_trips_between(df, start, end, column='started_at'):
+    # rows with start <= df[column] <= end, by binary search on the sorted column
+    values = df[column].to_numpy()
+    lo = np.searchsorted(values, np.datetime64(start), side='left')
+    hi = np.searchsorted(values, np.datetime64(end), side='right')
+    return df.iloc[lo:hi]
+
+
+def load_trips_between(start, end, csv_file=DEFAULT_TRIP_FILE):
+    return get_trips_between(load_trips(csv_file), start, end)
+
+
+def clear_cache():
+    with _lock:
+        _trips.clear()
@@ -0,0 +1,114 @@
+import threading
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from trip_store import load_trips
+
+# Sliding [t - width, t] window over a month of trips. Trips are kept sorted
+# by started_at (and an ended_at ordering is computed once), window bounds are
+# found by binary search, and per-station rider counts are updated by adding
+# and evicting only the trips that entered or left the window since the last
+# tick. The dashboard's hourly map reads the pre-aggregated heatmap_tiles;
+# the window serves windows that don't fall on hour boundaries, and the
+# finished-trip lookups behind the live feed.
+
+
+class TripWindow:
+    def __init__(self, df, width=timedelta(hours=1)):
+        # df: typed trips from trip_store, sorted by started_at
+        self.df = df
+        self.width = np.timedelta64(width)
+        self.started = df['started_at'].to_numpy()
+
+        station_ids = df['start_station_id'].astype('category')
+        self.station_ids = station_ids.cat.categories
+        self.codes = station_ids.cat.codes.to_numpy().astype(np.int64)
+
+        # representative coordinates for each station: its first trip
+        first = np.unique(self.codes, return_index=True)[1]
+        self.station_lat = np.full(len(self.station_ids), np.nan)
+        self.station_lng = np.full(len(self.station_ids), np.nan)
+        self.station_lat[self.codes[first]] = df['start_lat'].to_numpy()[first]
+        self.station_lng[self.codes[first]] = df['start_lng'].to_numpy()[first]
+
+        # ended_at ordering, computed once instead of sorting on every feed request
+        ended = df['ended_at'].to_numpy()
+        self.ended_order = np.argsort(ended, kind='stable')
+        self.ended_sorted = ended[self.ended_order]
+
+        # current window is started[lo:hi]
+        self.lo = 0
+        self.hi = 0
+        self.counts = np.zeros(len(self.station_ids), dtype=np.int64)
+        self.lock = threading.Lock()
+
+    def _bounds(self, curr_timestamp):
+        t = np.datetime64(curr_timestamp)
+        lo = int(np.searchsorted(self.started, t - self.width, side='left'))
+        hi = int(np.searchsorted(self.started, t, side='right'))
+        return lo, max(lo, hi)
+
+    def _add(self, start, end, sign):
+        if end > start:
+            self.counts += sign * np.bincount(self.codes[start:end], minlength=len(self.counts))
+
+    def advance(self, curr_timestamp):
+        # move the window to end at curr_timestamp, touching only the delta;
+        # returns a copy of the counts, the window moves on under other callers
+        with self.lock:
+            lo, hi = self._bounds(curr_timestamp)
+            if lo >= self.hi or hi <= self.lo:
+                # no overlap with the current window, start over
+                self.counts[:] = 0
+                self._add(lo, hi, 1)
+            else:
+                # trips that entered or left at the top of the window
+                if hi > self.hi:
+                    self._add(self.hi, hi, 1)
+                else:
+                    self._add(hi, self.hi, -1)
+                # trips that entered or left at the bottom of the window
+                if lo > self.lo:
+                    self._add(self.lo, lo, -1)
+                else:
+                    self._add(lo, self.lo, 1)
+            self.lo, self.hi = lo, hi
+            return self.counts.copy()
+
+    def heatmap(self, curr_timestamp):
+        # riders per start station over the window ending at curr_timestamp
+        counts = self.advance(curr_timestamp)
+        active = np.flatnonzero(counts)
+        return pd.DataFrame({
+            'start_station_id': self.station_ids[active],
+            'start_lat': self.station_lat[active],
+            'start_lng': self.station_lng[active],
+            'riders': counts[active],
+        })
+
+    def trips(self):
+        # the trips currently in the window
+        with self.lock:
+            return self.df.iloc[self.lo:self.hi]
+
+    def last_finished(self, n, curr_timestamp):
+        # last n trips with ended_at <= curr_timestamp, oldest first
+        k = int(np.searchsorted(self.ended_sorted, np.datetime64(curr_timestamp), side='right'))
+        return self.df.iloc[self.ended_order[max(0, k - n):k]]
+
+
+_windows = {}
+_lock = threading.Lock()
+
+
+def get_trip_window(csv_file, width=timedelta(hours=1)):
+    # one window per (trip frame, width), rebuilt when the store reloads the file
+    df = load_trips(csv_file)
+    key = (csv_file, width)
+    with _lock:
+        window = _windows.get(key)
+        if window is None or window.df is not df:
+            window = _windows[key] = TripWindow(df, width)
+    return window